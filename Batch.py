@@ -0,0 +1,99 @@
+#
+# Batch messages, whose body is a list of small sub-tasks that share one pre_process and post_process
+#
+# Work that only runs for seconds still pays for a round trip to the queue, a pre_process and post_process and
+# starting an interpreter.  Publishing many of them in one message spreads those fixed costs over the batch.
+# A batch message has the batch attribute set and a json list as its body.  Each item is either the body of a
+# sub-task, or a dict with a body and attributes of the sub-task, e.g.,
+#	[{"body": "seed 1", "attributes": {"docker_id": "bug-world"}}, "seed 2", "seed 3"]
+# Sub-tasks get the attributes of the batch message and their own on top of them.
+#
+import json
+import logging
+
+import WorkSpawnerConfig
+from PubSub import Message
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class Task(Message):
+	"""
+	A sub-task of a batch message.  It is never pulled or acked itself, the batch message is
+	"""
+
+	def __init__(self, body='', attributes=None, index=0, item=None):
+		"""
+		:param body: body of the sub-task
+		:param attributes: attributes of the batch message with the ones of the sub-task on top
+		:param index: position of the sub-task in the batch
+		:param item: the item in the body of the batch message the sub-task came from
+		"""
+		super().__init__(body, attributes)
+		self.index = index
+		self.item = item
+
+
+def is_batch(message):
+	return message.is_attribute_set(WorkSpawnerConfig.BATCH_ATTRIBUTE)
+
+
+def get_tasks(message):
+	"""
+	:param message: batch message
+	:return: list of its sub-tasks as Tasks
+	:raises ValueError: if the body isn't a list of sub-tasks
+	"""
+	items = json.loads(message.body)
+	if not isinstance(items, list):
+		raise ValueError('body of a batch must be a list of sub-tasks')
+
+	# sub-tasks are not batches, and only the batch message itself identifies work for dedupe
+	base_attributes = dict(message.attributes)
+	base_attributes.pop(WorkSpawnerConfig.BATCH_ATTRIBUTE, None)
+	base_attributes.pop(WorkSpawnerConfig.IDEMPOTENCY_KEY_ATTRIBUTE, None)
+
+	tasks = []
+	for index, item in enumerate(items):
+		if isinstance(item, dict):
+			if 'body' not in item:
+				raise ValueError('sub-task ' + str(index) + ' has no body')
+			body = item['body']
+			attributes = dict(base_attributes)
+			attributes.update({key: str(value) for key, value in item.get('attributes', {}).items()})
+		else:
+			body = item
+			attributes = dict(base_attributes)
+
+		task = Task(str(body), attributes, index, item)
+		task.topic = message.topic
+		if message.message_id:
+			task.message_id = str(message.message_id) + '/' + str(index)
+		tasks.append(task)
+
+	return tasks
+
+
+def make_message(items, attributes=None):
+	"""
+	:param items: bodies of the sub-tasks, or dicts with a body and attributes
+	:param attributes: attributes of the batch message
+	:return: batch message to publish
+	"""
+	attributes = dict(attributes) if attributes else {}
+	attributes[WorkSpawnerConfig.BATCH_ATTRIBUTE] = 'true'
+	return Message(json.dumps(items), attributes)
+
+
+def make_retry_message(message, tasks):
+	"""
+	:param message: batch message the tasks came from
+	:param tasks: Tasks to run again
+	:return: batch message of just those sub-tasks, with the attributes of the original batch.  it is new work, so
+			the idempotency key of the original isn't carried over
+	"""
+	attributes = dict(message.attributes)
+	attributes.pop(WorkSpawnerConfig.IDEMPOTENCY_KEY_ATTRIBUTE, None)
+	return make_message([task.item for task in tasks], attributes)
@@ -0,0 +1,316 @@
+#
+# Claim checks for message bodies that are too big to send through the queue
+#
+# Pub/Sub caps messages at 10 MB and bills by size, so a body over CLAIM_CHECK_THRESHOLD is put in a blob store
+# and the message only carries a claim_check attribute with where it is, e.g., gs://bucket/claim-checks/<name>
+# or /path/to/state/claim-checks/<name>.  After a pull the body is only fetched the first time it is used.
+# Each blob counts the published messages that refer to it.  Republishing a message that was pulled (e.g., the
+# prioritizer moving it to a work topic) adds a reference instead of uploading the body again, and every ack
+# takes one away.  The blob is deleted when the last one is acked.  A reference is only taken away once the ack went
+# through.  Pub/Sub delivers at least once though: a message whose lease ran out can be acked by two spawners, and
+# both acks take a reference away.  Another message referring to the same body, e.g., one republished from it, can
+# then find it gone and is dead lettered.  The spawners keep leases alive while work runs to make that rare.
+#
+import fcntl
+import logging
+import os
+import time
+import uuid
+
+import WorkSpawnerConfig
+import Codec
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class ClaimCheckError(Exception):
+	"""
+	The body of a pulled message could not be fetched from its blob store
+	"""
+
+	def __init__(self, ref, error, missing):
+		"""
+		:param ref: the claim check
+		:param error: what went wrong
+		:param missing: True if the blob doesn't exist any more, e.g., it was pruned or released too often.
+				False if it may still be there, e.g., the store couldn't be reached
+		"""
+		super().__init__('could not fetch the body in claim check: ' + ref + ' ' + str(error))
+		self.ref = ref
+		self.missing = missing
+
+
+class LocalBlobStore:
+	"""
+	Blobs in a local directory, for the queue backends that run on a single host.  the reference count of a blob is
+	in a .refs file next to it, updated under a file lock so every process on the host can share the directory
+	"""
+
+	def __init__(self, directory, retention=None):
+		"""
+		:param directory: directory the blobs are kept in
+		:param retention: seconds after which blobs are deleted even if they are still referenced, e.g., by
+				messages that expired without being acked.  defaults to WorkSpawnerConfig.CLAIM_CHECK_RETENTION
+		"""
+		if retention is None:
+			retention = WorkSpawnerConfig.CLAIM_CHECK_RETENTION
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		self.prune(retention)
+
+	def _get_path(self, name):
+		return os.path.join(self.directory, name)
+
+	def put(self, name, data, refs=1):
+		"""
+		:param name: name of the blob
+		:param data: bytes to store
+		:param refs: number of messages that refer to it
+		:return: None
+		"""
+		path = self._get_path(name)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(data)
+		os.replace(path + '.tmp', path)
+		with open(path + '.refs', 'w') as f:
+			f.write(str(refs))
+
+	def get(self, name):
+		with open(self._get_path(name), 'rb') as f:
+			return f.read()
+
+	def open(self, name):
+		"""
+		:return: binary file object to stream the blob from
+		"""
+		return open(self._get_path(name), 'rb')
+
+	def add_ref(self, name, delta):
+		"""
+		:param name: name of the blob
+		:param delta: number of references to add, negative to take them away
+		:return: number of references left.  the blob is deleted when there are none
+		"""
+		path = self._get_path(name)
+		with open(path + '.refs', 'a+') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+			f.seek(0)
+			text = f.read().strip()
+			refs = (int(text) if text else 0) + delta
+			if refs <= 0:
+				self._remove(path)
+				return 0
+			f.seek(0)
+			f.truncate()
+			f.write(str(refs))
+		return refs
+
+	@staticmethod
+	def _remove(path):
+		for filename in (path, path + '.refs'):
+			try:
+				os.remove(filename)
+			except FileNotFoundError:
+				pass
+
+	def prune(self, retention):
+		cutoff = time.time() - retention
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith('.refs') or not entry.is_file():
+				continue
+			try:
+				if entry.stat().st_mtime < cutoff:
+					logging.info('deleting claim check that was never released: ' + entry.path)
+					self._remove(entry.path)
+			except FileNotFoundError:
+				pass  # released by another process
+
+
+class GCSBlobStore:
+	"""
+	Blobs in a GCS bucket, for queues shared between hosts.  the reference count is in the metadata of the object
+	and updated with a metageneration precondition, so concurrent updates from different spawners aren't lost.
+	give the bucket a lifecycle rule to delete blobs of messages that expired without being acked
+	"""
+
+	def __init__(self, bucket_name, prefix=''):
+		"""
+		:param bucket_name: bucket the blobs are kept in
+		:param prefix: path in the bucket the blobs are named under
+		"""
+		# only needed when there is a large body on a gcp queue
+		from google.cloud import storage
+		self.bucket = storage.Client().bucket(bucket_name)
+		self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+	def _get_blob(self, name):
+		return self.bucket.blob(self.prefix + name)
+
+	def put(self, name, data, refs=1):
+		blob = self._get_blob(name)
+		blob.metadata = {'refs': str(refs)}
+		blob.upload_from_string(data, content_type='application/octet-stream')
+
+	def get(self, name):
+		from google.api_core.exceptions import NotFound
+
+		try:
+			return self._get_blob(name).download_as_bytes()
+		except NotFound as error:  # the same as a local store, so callers can tell a missing blob apart
+			raise FileNotFoundError(str(error))
+
+	def open(self, name):
+		return self._get_blob(name).open('rb')
+
+	def add_ref(self, name, delta):
+		from google.api_core.exceptions import NotFound, PreconditionFailed
+
+		blob = self._get_blob(name)
+		while True:
+			try:
+				blob.reload()
+			except NotFound:
+				return 0
+			refs = int((blob.metadata or {}).get('refs', '1')) + delta
+			try:
+				if refs <= 0:
+					blob.delete(if_metageneration_match=blob.metageneration)
+					return 0
+				blob.metadata = {'refs': str(refs)}
+				blob.patch(if_metageneration_match=blob.metageneration)
+				return refs
+			except PreconditionFailed:  # someone else changed the count first, try again with theirs
+				continue
+			except NotFound:
+				return 0
+
+
+# location: blob store, so each is only created once per process
+stores = {}
+
+
+def get_store(location):
+	"""
+	:param location: gs://bucket/prefix for GCS, otherwise a local directory
+	:return: blob store for the location
+	"""
+	if location not in stores:
+		if location.startswith('gs://'):
+			bucket_name, _, prefix = location[len('gs://'):].partition('/')
+			stores[location] = GCSBlobStore(bucket_name, prefix)
+		else:
+			stores[location] = LocalBlobStore(location)
+	return stores[location]
+
+
+class Claim:
+	"""
+	Reference to the body of a pulled message that is in a blob store
+	"""
+
+	def __init__(self, ref, codec_attributes=None):
+		"""
+		:param ref: value of the claim check attribute, the location of the store and the name of the blob
+		:param codec_attributes: from Codec.pop_attributes(), how the body in the blob is encoded
+		"""
+		self.ref = ref
+		self.location, _, self.name = ref.rpartition('/')
+		self.codec_attributes = codec_attributes if codec_attributes is not None else {}
+		self.loaded = False
+
+	def get_store(self):
+		return get_store(self.location)
+
+	def fetch(self):
+		"""
+		:return: the body as it was published.  raises ClaimCheckError if it can't be fetched
+		"""
+		try:
+			data = self.get_store().get(self.name)
+		except FileNotFoundError as error:
+			raise ClaimCheckError(self.ref, error, True)
+		except Exception as error:  # e.g., the store can't be reached
+			raise ClaimCheckError(self.ref, error, False)
+		self.loaded = True
+		logging.debug('fetched ' + str(len(data)) + ' bytes of claim check: ' + self.ref)
+		return Codec.decode(data, self.codec_attributes)
+
+	def open(self):
+		"""
+		:return: binary file object to stream the body from instead of reading it all into memory.  it is still
+				compressed if the codec attribute was set
+		"""
+		return self.get_store().open(self.name)
+
+
+def check_in(body, attributes, location, threshold=None, copies=1):
+	"""
+	:param body: string or bytes body of a message about to be published, after Codec.encode()
+	:param attributes: attributes of the message, they aren't changed
+	:param location: blob store to put a large body in, see get_store()
+	:param threshold: bodies over this many bytes are put in the blob store.
+			defaults to WorkSpawnerConfig.CLAIM_CHECK_THRESHOLD
+	:param copies: number of subscriptions the message is delivered to, each will ack it
+	:return: (body, attributes) to put on the queue
+	"""
+	if threshold is None:
+		threshold = WorkSpawnerConfig.CLAIM_CHECK_THRESHOLD
+
+	data = body.encode('utf-8') if isinstance(body, str) else body
+	if len(data) <= threshold:
+		return body, attributes
+
+	name = uuid.uuid4().hex
+	get_store(location).put(name, data, copies)
+	ref = location.rstrip('/') + '/' + name
+	attributes = dict(attributes)
+	attributes[WorkSpawnerConfig.CLAIM_CHECK_ATTRIBUTE] = ref
+	logging.debug('put ' + str(len(data)) + ' byte body in claim check: ' + ref)
+	return '', attributes
+
+
+def add_ref(message, copies=1):
+	"""
+	republish a pulled message whose body hasn't changed by pointing at the same blob instead of storing it again
+	:param message: message with a Claim
+	:param copies: number of subscriptions the message is delivered to, each will ack it
+	:return: (body, attributes) to put on the queue
+	"""
+	claim = message.claim
+	claim.get_store().add_ref(claim.name, copies)
+	attributes = dict(message.attributes)
+	attributes.update(claim.codec_attributes)
+	attributes[WorkSpawnerConfig.CLAIM_CHECK_ATTRIBUTE] = claim.ref
+	return '', attributes
+
+
+def check_out(message, codec_attributes=None):
+	"""
+	replace the claim check attribute of a pulled message with a Claim, so its body is fetched when it is used
+	:param message: message that was pulled
+	:param codec_attributes: from Codec.pop_attributes(), how the body in the blob is encoded
+	:return: True if the body is in a blob store
+	"""
+	ref = message.attributes.pop(WorkSpawnerConfig.CLAIM_CHECK_ATTRIBUTE, None)
+	if not ref:
+		return False
+	message.claim = Claim(ref, codec_attributes)
+	return True
+
+
+def release(message):
+	"""
+	take away the reference of a message that was acked
+	:param message: message that was acked
+	:return: None
+	"""
+	claim = message.claim
+	if claim is None:
+		return
+	try:
+		if not claim.get_store().add_ref(claim.name, -1):
+			logging.debug('deleted claim check: ' + claim.ref)
+	except Exception as error:  # e.g., the store can't be reached.  left for the retention or lifecycle rule
+		logging.error('could not release claim check: ' + claim.ref + ' ' + str(error))
@@ -0,0 +1,160 @@
+#
+# Compression of message bodies
+#
+# Bodies over COMPRESSION_THRESHOLD bytes are compressed with COMPRESSION_CODEC when they are published and the
+# codec is recorded in the codec attribute, so a pull decompresses with whatever codec the publisher used.
+# JSON configs and score vectors shrink 5-10x.  Bodies can be bytes as well as strings, a bytes body is marked
+# with the body_type attribute so it is handed back as bytes instead of being decoded as utf-8.
+#	zlib  always available
+#	zstd  needs the zstandard package.  can use a dictionary trained on sample bodies, see benchmark_codecs.py
+#	lz4   needs the lz4 package.  fastest, compresses least
+#
+import logging
+import zlib
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# value of the body type attribute for bytes bodies
+BODY_TYPE_BYTES = 'bytes'
+
+
+class Codec:
+	"""
+	Compressor and decompressor of one kind
+	"""
+
+	def __init__(self, name, compress, decompress):
+		"""
+		:param name: name recorded in the codec attribute
+		:param compress: function of bytes that returns them compressed
+		:param decompress: function of compressed bytes that returns the original
+		"""
+		self.name = name
+		self.compress = compress
+		self.decompress = decompress
+
+
+def make_zlib(level=None):
+	level = level if level is not None else -1  # zlib's default, 6
+	return Codec('zlib', lambda data: zlib.compress(data, level), zlib.decompress)
+
+
+def make_zstd(level=None, dictionary_file=None):
+	"""
+	:param level: compression level, None for the default
+	:param dictionary_file: file with a dictionary from zstandard.train_dictionary, None to not use one.  every
+			daemon that pulls the messages needs the same file
+	"""
+	import zstandard
+
+	dictionary = None
+	if dictionary_file:
+		with open(dictionary_file, 'rb') as f:
+			dictionary = zstandard.ZstdCompressionDict(f.read())
+	compressor = zstandard.ZstdCompressor(level=level if level is not None else 3, dict_data=dictionary)
+	decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+	return Codec('zstd', compressor.compress, decompressor.decompress)
+
+
+def make_lz4(level=None):
+	import lz4.frame
+
+	level = level if level is not None else 0
+	return Codec('lz4', lambda data: lz4.frame.compress(data, compression_level=level), lz4.frame.decompress)
+
+
+# name: function that makes the codec.  the packages of the codecs are only imported when they are first used
+makers = {
+	'zlib': lambda: make_zlib(WorkSpawnerConfig.COMPRESSION_LEVEL),
+	'zstd': lambda: make_zstd(WorkSpawnerConfig.COMPRESSION_LEVEL, WorkSpawnerConfig.COMPRESSION_DICTIONARY_FILE),
+	'lz4': lambda: make_lz4(WorkSpawnerConfig.COMPRESSION_LEVEL),
+}
+
+# name: Codec that has been made
+codecs = {}
+
+
+def get_codec(name):
+	"""
+	:param name: one of the keys in makers
+	:return: Codec for the name
+	:raises ValueError: if there is no such codec
+	:raises ImportError: if the package the codec needs isn't installed
+	"""
+	if name not in codecs:
+		if name not in makers:
+			raise ValueError('unknown codec: ' + str(name) + ', choose from: ' + str(sorted(makers)))
+		codecs[name] = makers[name]()
+	return codecs[name]
+
+
+def encode(body, attributes, codec=None, threshold=None):
+	"""
+	:param body: string or bytes body of a message about to be published
+	:param attributes: attributes of the message, they aren't changed
+	:param codec: name of the codec to compress with.  defaults to WorkSpawnerConfig.COMPRESSION_CODEC
+	:param threshold: bodies over this many bytes are compressed.  defaults to WorkSpawnerConfig.COMPRESSION_THRESHOLD
+	:return: (body, attributes) to put on the queue.  the body is bytes if it was compressed
+	"""
+	if codec is None:
+		codec = WorkSpawnerConfig.COMPRESSION_CODEC
+	if threshold is None:
+		threshold = WorkSpawnerConfig.COMPRESSION_THRESHOLD
+
+	binary = isinstance(body, (bytes, bytearray))
+	if binary:
+		attributes = dict(attributes)
+		attributes[WorkSpawnerConfig.BODY_TYPE_ATTRIBUTE] = BODY_TYPE_BYTES
+
+	if not codec or len(body) <= threshold // 4:  # a utf-8 character is at most 4 bytes
+		return body, attributes
+
+	data = bytes(body) if binary else body.encode('utf-8')
+	if len(data) <= threshold:
+		return body, attributes
+
+	try:
+		compressed = get_codec(codec).compress(data)
+	except ImportError as error:  # sending it as it is beats not sending it
+		logging.error('could not compress with codec: ' + codec + ' ' + str(error))
+		return body, attributes
+
+	if len(compressed) >= len(data):  # e.g., it is already compressed
+		return body, attributes
+
+	attributes = dict(attributes)
+	attributes[WorkSpawnerConfig.CODEC_ATTRIBUTE] = codec
+	return compressed, attributes
+
+
+def pop_attributes(attributes):
+	"""
+	:param attributes: attributes of a message that was pulled.  the ones encode() added are removed
+	:return: dict of the attributes that were removed, to pass to decode()
+	"""
+	popped = {}
+	for name in (WorkSpawnerConfig.CODEC_ATTRIBUTE, WorkSpawnerConfig.BODY_TYPE_ATTRIBUTE):
+		if name in attributes:
+			popped[name] = attributes.pop(name)
+	return popped
+
+
+def decode(data, codec_attributes):
+	"""
+	:param data: body as it came off the queue, string or bytes
+	:param codec_attributes: from pop_attributes()
+	:return: the body that was published, bytes if it was bytes, otherwise a string
+	"""
+	codec = codec_attributes.get(WorkSpawnerConfig.CODEC_ATTRIBUTE)
+	if codec:
+		data = get_codec(codec).decompress(data)
+
+	if codec_attributes.get(WorkSpawnerConfig.BODY_TYPE_ATTRIBUTE) == BODY_TYPE_BYTES:
+		return data.encode('utf-8') if isinstance(data, str) else bytes(data)
+	if isinstance(data, (bytes, bytearray)):
+		return bytes(data).decode('utf-8')
+	return data
@@ -0,0 +1,181 @@
+#
+# Number of batch sub-tasks run at once, tuned to what the host can take
+#
+# A fixed BATCH_SLOTS is too low for work that waits on I/O and too high for work that fights over memory
+# bandwidth.  The tuner watches how many sub-tasks finish per second, the load average, memory pressure from
+# /proc/pressure/memory and the share of sub-tasks that fail.  While the host is healthy it hill climbs: one slot
+# at a time in the same direction while throughput improves, back the other way once it gets worse, and one fewer
+# when it stays the same.  When the host is overloaded or too much work fails the slots are cut by
+# CONCURRENCY_DECREASE.  Every decision is logged.
+#
+import logging
+import os
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# memory pressure of the host, see https://docs.kernel.org/accounting/psi.html
+MEMORY_PRESSURE_FILE = '/proc/pressure/memory'
+
+
+def get_load():
+	"""
+	:return: 1 minute load average per core, None if it isn't available
+	"""
+	try:
+		return os.getloadavg()[0] / (os.cpu_count() or 1)
+	except (AttributeError, OSError):
+		return None
+
+
+def get_memory_pressure(filename=MEMORY_PRESSURE_FILE):
+	"""
+	:return: percentage of the last 10 seconds some task was stalled waiting on memory, None if the kernel doesn't
+			report it
+	"""
+	try:
+		with open(filename) as f:
+			for line in f:
+				kind, _, fields = line.partition(' ')
+				if kind == 'some':
+					return float(dict(field.split('=') for field in fields.split())['avg10'])
+	except (OSError, KeyError, ValueError):
+		pass
+	return None
+
+
+class ConcurrencyTuner:
+	"""
+	Closed loop controller of the number of slots.  Call record() for every sub-task that finishes and update()
+	every time around the loop that starts them
+	"""
+
+	def __init__(self, minimum=None, maximum=None, start=None, interval=None, clock=time.time, get_load=get_load,
+				get_memory_pressure=get_memory_pressure):
+		"""
+		:param minimum: fewest slots.  defaults to WorkSpawnerConfig.CONCURRENCY_MIN_SLOTS
+		:param maximum: most slots.  defaults to WorkSpawnerConfig.CONCURRENCY_MAX_SLOTS, 0 is twice the cores
+		:param start: slots to start with.  defaults to WorkSpawnerConfig.BATCH_SLOTS, 0 is the number of cores
+		:param interval: min seconds between decisions.  defaults to WorkSpawnerConfig.CONCURRENCY_INTERVAL
+		:param clock: function that returns the current time in seconds
+		:param get_load: function that returns the load per core
+		:param get_memory_pressure: function that returns the memory pressure of the host in percent
+		"""
+		cores = os.cpu_count() or 1
+		self.minimum = max(1, minimum if minimum is not None else WorkSpawnerConfig.CONCURRENCY_MIN_SLOTS)
+		maximum = maximum if maximum is not None else WorkSpawnerConfig.CONCURRENCY_MAX_SLOTS
+		self.maximum = max(self.minimum, maximum or 2 * cores)
+		start = start if start is not None else WorkSpawnerConfig.BATCH_SLOTS
+		self.slots = min(self.maximum, max(self.minimum, start or cores))
+		self.interval = interval if interval is not None else WorkSpawnerConfig.CONCURRENCY_INTERVAL
+		self.clock = clock
+		self.get_load = get_load
+		self.get_memory_pressure = get_memory_pressure
+
+		self.direction = 1  # +1 while adding slots helps, -1 while taking them away helps
+		self.last_throughput = None  # sub-tasks per second at the last decision, None after a cut
+		self.last_update = None
+		self._start_window(clock())
+
+	def _start_window(self, now):
+		self.window_start = now
+		self.finished = 0
+		self.failed = 0
+		self.saturated = True  # every slot had work waiting for it for the whole window
+
+	def record(self, failed=False):
+		"""
+		:param failed: True if the sub-task failed
+		:return: None
+		"""
+		self.finished += 1
+		if failed:
+			self.failed += 1
+
+	def update(self, running, waiting):
+		"""
+		:param running: sub-tasks running now
+		:param waiting: sub-tasks waiting for a slot
+		:return: number of slots to fill.  running sub-tasks are never stopped, slots that are taken away are
+				only not refilled
+		"""
+		now = self.clock()
+		if self.last_update is not None and now - self.last_update > self.interval:
+			self._start_window(now)  # nothing was running in between, e.g., between batches
+		self.last_update = now
+
+		if running < self.slots and not waiting:  # e.g., the end of a batch, throughput says nothing about the slots
+			self.saturated = False
+
+		elapsed = now - self.window_start
+		if elapsed < self.interval:
+			return self.slots
+
+		load = self.get_load()
+		pressure = self.get_memory_pressure()
+		why = self.get_overload(load, pressure)
+		if self.finished < self.slots and why is None:
+			return self.slots  # wait for about every slot to have finished something, long work needs longer windows
+
+		self.decide(self.finished / elapsed if elapsed > 0 else 0.0, load, pressure, why)
+		self._start_window(now)
+		return self.slots
+
+	def get_overload(self, load, pressure):
+		"""
+		:param load: load per core, None if unknown
+		:param pressure: memory pressure in percent, None if unknown
+		:return: why the slots have to be cut, None if they don't
+		"""
+		failure_rate = self.failed / self.finished if self.finished else 0.0
+		if self.finished >= self.minimum and failure_rate > WorkSpawnerConfig.CONCURRENCY_MAX_FAILURE_RATE:
+			return 'failure rate ' + str(round(failure_rate, 2))
+		if pressure is not None and pressure > WorkSpawnerConfig.CONCURRENCY_MAX_MEMORY_PRESSURE:
+			return 'memory pressure ' + str(pressure) + '%'
+		if load is not None and load > WorkSpawnerConfig.CONCURRENCY_MAX_LOAD:
+			return 'load ' + str(round(load, 2)) + ' per core'
+		return None
+
+	def decide(self, throughput, load, pressure, why):
+		"""
+		move the slots at the end of a window
+		:param throughput: sub-tasks finished per second during the window
+		:param load: load per core, None if unknown
+		:param pressure: memory pressure in percent, None if unknown
+		:param why: from get_overload()
+		:return: None
+		"""
+		slots = self.slots
+		tolerance = WorkSpawnerConfig.CONCURRENCY_TOLERANCE
+		if why is not None:  # multiplicative decrease
+			slots = int(slots * WorkSpawnerConfig.CONCURRENCY_DECREASE)
+			self.direction = 1  # probe upwards again from the new level
+			self.last_throughput = None
+			reason = why
+		elif not self.saturated:
+			reason = 'not every slot had work'
+		elif self.last_throughput is None or throughput > self.last_throughput * (1 + tolerance):
+			slots += self.direction  # the last step helped, or there is nothing to compare with yet
+			reason = 'throughput improved'
+			self.last_throughput = throughput
+		elif throughput < self.last_throughput * (1 - tolerance):
+			self.direction = -self.direction  # the last step made it worse, step back
+			slots += self.direction
+			reason = 'throughput fell from ' + str(round(self.last_throughput, 3)) + '/s'
+			self.last_throughput = throughput
+		else:
+			self.direction = -1  # the same throughput with fewer slots leaves more of the host for everything else
+			slots += self.direction
+			reason = 'throughput held'
+			self.last_throughput = throughput
+
+		slots = min(self.maximum, max(self.minimum, slots))
+		logging.info('concurrency: ' + str(self.slots) + ' -> ' + str(slots) + ' slots, ' + str(self.finished) +
+					' finished at ' + str(round(throughput, 3)) + '/s, ' + str(self.failed) + ' failed, load ' +
+					str(round(load, 2) if load is not None else None) + ', memory pressure ' + str(pressure) + ': ' +
+					reason)
+		self.slots = slots
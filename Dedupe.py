@@ -0,0 +1,178 @@
+#
+# Duplicate delivery suppression for the work spawner
+#
+# Pub/Sub delivers messages at least once, so the same work can be pulled again after a lease lapses.
+# The store remembers which work has been started and completed on this host so a redelivery of
+# completed work is acked without running it again, and a redelivery of work that is still running is held back.
+#
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class DedupeStore:
+	"""
+	Bounded in memory LRU of recently seen work backed by an SQLite database in WAL mode.
+	Work is keyed by the idempotency key attribute if the publisher set one, otherwise by the message_id.
+	"""
+
+	# states returned by check()
+	NEW = 'new'  # never seen, or seen but safe to run again
+	STARTED = 'started'  # being worked on by a live process on this host
+	COMPLETED = 'completed'  # finished and acked, whether it succeeded or not
+
+	def __init__(self, db_file=None, cache_size=None, retention=None):
+		"""
+		:param db_file: sqlite file to persist to.  defaults to WorkSpawnerConfig.DEDUPE_DB_FILE
+		:param cache_size: max number of entries kept in memory
+		:param retention: seconds to remember work for.  should be at least the message retention of the topics
+		"""
+		if db_file is None:
+			db_file = WorkSpawnerConfig.DEDUPE_DB_FILE
+		if cache_size is None:
+			cache_size = WorkSpawnerConfig.DEDUPE_CACHE_SIZE
+		if retention is None:
+			retention = WorkSpawnerConfig.DEDUPE_RETENTION
+
+		self.cache_size = cache_size
+		self.retention = retention
+		self.cache = collections.OrderedDict()  # key: (state, host, pid, updated), most recently used last
+		self.host = socket.gethostname()
+		self.pid = os.getpid()
+		self.last_prune = 0
+
+		db_dir = os.path.dirname(db_file)
+		if db_dir:
+			os.makedirs(db_dir, exist_ok=True)
+
+		# autocommit, every write is its own transaction
+		self.db = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS work ('
+						'key TEXT PRIMARY KEY, state TEXT NOT NULL, host TEXT, pid INTEGER, updated REAL NOT NULL)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS work_updated ON work (updated)')
+
+		self.prune()
+
+	@staticmethod
+	def get_key(message):
+		"""
+		:param message: message pulled from a work topic
+		:return: string that identifies the work, None if the message can't be identified
+		"""
+		return message.get_work_key()
+
+	def _get(self, key):
+		# completed work never changes state, anything else may have been updated by another process on the host
+		entry = self.cache.get(key)
+		if entry is not None and entry[0] == self.COMPLETED:
+			self.cache.move_to_end(key)
+			return entry
+
+		row = self.db.execute('SELECT state, host, pid, updated FROM work WHERE key = ?', (key,)).fetchone()
+		if row is None:
+			return None
+
+		entry = tuple(row)
+		self._cache(key, entry)
+		return entry
+
+	def _cache(self, key, entry):
+		self.cache[key] = entry
+		self.cache.move_to_end(key)
+		while len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)  # least recently used
+
+	def _set(self, key, state):
+		entry = (state, self.host, self.pid, time.time())
+		self.db.execute('INSERT OR REPLACE INTO work (key, state, host, pid, updated) VALUES (?, ?, ?, ?, ?)',
+						(key,) + entry)
+		self._cache(key, entry)
+
+	@staticmethod
+	def _is_running(pid):
+		try:
+			os.kill(pid, 0)  # signal 0 only checks that the process exists
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			return True  # exists but owned by someone else
+		return True
+
+	def check(self, message):
+		"""
+		:param message: message pulled from a work topic
+		:return: NEW if the work should be run, COMPLETED if it should be acked without running,
+				STARTED if it is being worked on by a live process on this host and should be held back
+		"""
+		key = self.get_key(message)
+		if key is None:
+			return self.NEW
+
+		entry = self._get(key)
+		if entry is None:
+			return self.NEW
+
+		state, host, pid, updated = entry
+		if time.time() - updated > self.retention:
+			return self.NEW
+
+		if state == self.COMPLETED:
+			return self.COMPLETED
+
+		# started but never completed.  only hold it back if the process working on it is still alive on this host
+		# otherwise that process died and the work needs to be run again
+		if host == self.host and self._is_running(pid):
+			return self.STARTED
+
+		logging.info('work: ' + key + ' was started by pid: ' + str(pid) + ' on: ' + str(host) + ' and never completed')
+		return self.NEW
+
+	def mark_started(self, message):
+		key = self.get_key(message)
+		if key is not None:
+			self._set(key, self.STARTED)
+
+	def mark_completed(self, message):
+		key = self.get_key(message)
+		if key is not None:
+			self._set(key, self.COMPLETED)
+		self.prune()
+
+	def forget(self, message):
+		"""
+		remove the work so the next delivery of it will be run again.  e.g., when it was handed back for a retry
+		:param message: message to forget
+		:return: None
+		"""
+		key = self.get_key(message)
+		if key is None:
+			return
+		self.cache.pop(key, None)
+		self.db.execute('DELETE FROM work WHERE key = ?', (key,))
+
+	def prune(self):
+		"""
+		drop work older than the retention period.  only runs about once an hour
+		:return: None
+		"""
+		now = time.time()
+		if now - self.last_prune < 3600:
+			return
+		self.last_prune = now
+
+		cursor = self.db.execute('DELETE FROM work WHERE updated < ?', (now - self.retention,))
+		logging.debug('pruned ' + str(cursor.rowcount) + ' old entries from the dedupe store')
+
+	def close(self):
+		self.db.close()
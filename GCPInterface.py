@@ -44,6 +44,9 @@ read from topic file and create topics if don't exist
 # standard python stuff
 import argparse
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # google cloud specific
 from google.cloud import storage
@@ -54,10 +57,17 @@ from google.api_core import retry
 # local config for project
 import config
 
+# max requests in one GCS batch request
+GCS_BATCH_SIZE = 100
+
+# partial response of a listing with only the names of the blobs, which is much smaller
+NAMES_ONLY = 'items(name),prefixes,nextPageToken'
+
 
 class GCSFile:
 
     def __init__(self):
+        self.client = storage.Client()
         self.bucket = self.get_default_bucket()
 
     def list_buckets(self):
@@ -69,8 +79,7 @@ class GCSFile:
             logging.debug(bucket.name)
 
     def get_default_bucket(self):
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(config.bucket_name)
+        bucket = self.client.get_bucket(config.bucket_name)
         return bucket
 
     def create_file_for_writing(self, filename):
@@ -113,41 +122,216 @@ class GCSFile:
         gcs_file.close()
         return contents
 
-    def list_bucket(self, bucket):
-        """Create several files and paginate through them.
-
-		Production apps should set page_size to a practical value.
-
-		Args:
-			bucket: bucket.
-		"""
-        self.response.write('Listbucket result:\n')
-        gcs = self.bucket
-
-        page_size = 1
-        stats = gcs.listbucket(bucket + '/foo', max_keys=page_size)
-        while True:
-            count = 0
-            for stat in stats:
-                count += 1
-                self.response.write(repr(stat))
-                self.response.write('\n')
-
-            if count != page_size or count == 0:
+    def list_pages(self, prefix=None, delimiter=None, page_size=None, fields=None):
+        """Yields the blobs under a prefix a page at a time, one request per page.
+
+        Args:
+            prefix: only list blobs whose names start with it.
+            delimiter: e.g. '/' to only list the blobs directly under the prefix.
+            page_size: blobs per request.  defaults to config.list_page_size, GCS allows up to 1000.
+            fields: partial response fields, e.g. 'items(name,size),prefixes,nextPageToken' to list faster.
+
+        Yields:
+            pages of the listing.  each is an iterable of blobs with the sub prefixes in its prefixes attribute.
+        """
+        if page_size is None:
+            page_size = config.list_page_size
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix, delimiter=delimiter, page_size=page_size,
+                                       fields=fields)
+        for page in blobs.pages:
+            yield page
+
+    def list_blobs(self, prefix=None, delimiter=None, page_size=None, fields=None):
+        """Yields the blobs under a prefix as they are listed, without holding the whole listing in memory."""
+        for page in self.list_pages(prefix, delimiter, page_size, fields):
+            for blob in page:
+                yield blob
+
+    def list_prefixes(self, prefix=None, delimiter='/'):
+        """Yields the sub prefixes directly under a prefix, e.g. the "directories" in it."""
+        for page in self.list_pages(prefix, delimiter, fields='prefixes,nextPageToken'):
+            for sub_prefix in sorted(page.prefixes):
+                yield sub_prefix
+
+    def get_shards(self, prefix=None, depth=1, delimiter='/'):
+        """Splits a prefix into sub prefixes that can be listed in parallel.
+
+        Args:
+            prefix: prefix to split.
+            depth: number of levels of sub prefixes to descend.
+
+        Returns:
+            (list of prefixes to list whole, list of prefixes to only list the blobs directly under)
+        """
+        shards = [prefix or '']
+        leaves = []  # prefixes without sub prefixes, there is nothing to split them on
+        shallow = []
+        for _ in range(depth):
+            next_shards = []
+            for shard in shards:
+                sub_prefixes = list(self.list_prefixes(shard, delimiter))
+                if sub_prefixes:
+                    shallow.append(shard)
+                    next_shards.extend(sub_prefixes)
+                else:
+                    leaves.append(shard)
+            shards = next_shards
+            if not shards:
                 break
-            stats = gcs.listbucket(bucket + '/foo', max_keys=page_size,
-                                   marker=stat.filename)
-
-    def delete_files(self):
-        gcs = self.bucket
-
-        self.response.write('Deleting files...\n')
-        for filename in self.tmp_filenames_to_clean_up:
-            self.response.write('Deleting file %s\n' % filename)
+        return leaves + shards, shallow
+
+    def list_blobs_parallel(self, prefix=None, workers=None, depth=1, delimiter='/', fields=None):
+        """Yields the blobs under a prefix, listing each sub prefix in its own thread.
+
+        A listing is one request per 1000 blobs in a row, so a prefix with 100k blobs takes 100 round trips.
+        Listing the sub prefixes in parallel cuts that by the number of workers when the blobs are spread
+        over sub prefixes, e.g. logs/<job>/.  Blobs come out in no particular order.
+
+        Args:
+            prefix: prefix to list.
+            workers: threads listing at once.  defaults to config.list_workers.
+            depth: levels of sub prefixes to split the listing on.
+            fields: partial response fields, see list_pages.
+        """
+        if workers is None:
+            workers = config.list_workers
+
+        shards, shallow = self.get_shards(prefix, depth, delimiter)
+        for shallow_prefix in shallow:  # blobs that are directly under a prefix, not in a sub prefix
+            for blob in self.list_blobs(shallow_prefix, delimiter=delimiter, fields=fields):
+                yield blob
+        if not shards:
+            return
+
+        pages = queue.Queue(maxsize=workers * 2)  # bounded, so listing doesn't run far ahead of the caller
+        stopped = threading.Event()  # set if the caller stops iterating early
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def list_shard(shard):
             try:
-                gcs.delete(filename)
-            except gcs.NotFoundError:
-                pass
+                for page in self.list_pages(shard, fields=fields):
+                    put(list(page))
+                    if stopped.is_set():
+                        break
+            except Exception as error:  # handed to the caller's thread
+                put(error)
+            finally:
+                put(None)
+
+        executor = ThreadPoolExecutor(workers)
+        try:
+            for shard in shards:
+                executor.submit(list_shard, shard)
+
+            remaining = len(shards)
+            while remaining:
+                item = pages.get()
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for blob in item:
+                        yield blob
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True)
+
+    def run_bulk(self, function, items, workers=None):
+        """Calls function on every item in a pool of threads, keeping a bounded number of calls in flight.
+
+        Returns:
+            sum of what the calls returned
+        """
+        if workers is None:
+            workers = config.list_workers
+
+        total = 0
+        with ThreadPoolExecutor(workers) as executor:
+            running = set()
+            for item in items:
+                if len(running) >= workers * 2:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    total += sum(future.result() for future in done)
+                running.add(executor.submit(function, item))
+            total += sum(future.result() for future in running)
+        return total
+
+    def delete_blobs(self, blobs, workers=None):
+        """Deletes blobs in batch requests of up to 100, several batches at once.
+
+        Args:
+            blobs: iterable of blobs or blob names, e.g. from list_blobs_parallel.
+
+        Returns:
+            number of blobs deleted
+        """
+        def delete_batch(batch):
+            # blobs that are already gone don't fail the rest of the batch
+            with self.client.batch(raise_exception=False):
+                for blob in batch:
+                    self.bucket.delete_blob(blob if isinstance(blob, str) else blob.name)
+            return len(batch)
+
+        count = self.run_bulk(delete_batch, chunk(blobs, GCS_BATCH_SIZE), workers)
+        logging.info('deleted {} blobs'.format(count))
+        return count
+
+    def delete_prefix(self, prefix, workers=None):
+        """Deletes every blob under a prefix."""
+        blobs = self.list_blobs_parallel(prefix, workers, fields=NAMES_ONLY)
+        return self.delete_blobs(blobs, workers)
+
+    def copy_prefix(self, prefix, destination_prefix, destination_bucket=None, workers=None):
+        """Copies every blob under a prefix to a new prefix, a copy per thread.
+
+        Args:
+            prefix: prefix to copy.
+            destination_prefix: the prefix is replaced with this in the names of the copies.
+            destination_bucket: bucket to copy to, defaults to this bucket.
+
+        Returns:
+            number of blobs copied
+        """
+        if destination_bucket is None:
+            destination_bucket = self.bucket
+        elif isinstance(destination_bucket, str):
+            destination_bucket = self.client.bucket(destination_bucket)
+
+        def copy(blob):
+            self.bucket.copy_blob(blob, destination_bucket, destination_prefix + blob.name[len(prefix):])
+            return 1
+
+        count = self.run_bulk(copy, self.list_blobs_parallel(prefix, workers), workers)
+        logging.info('copied {} blobs from {} to {}'.format(count, prefix, destination_prefix))
+        return count
+
+    def list_bucket(self, prefix=None):
+        """Logs the names of the blobs under a prefix.
+
+        Args:
+            prefix: prefix to list, defaults to the whole bucket.
+
+        Returns:
+            number of blobs
+        """
+        count = 0
+        for blob in self.list_blobs_parallel(prefix, fields=NAMES_ONLY):
+            logging.debug(blob.name)
+            count += 1
+        logging.info('Listbucket result: {} blobs under {}'.format(count, prefix or '/'))
+        return count
+
+    def delete_files(self, filenames):
+        logging.info('Deleting files...')
+        return self.delete_blobs(filenames)
 
     def copy_local_to_bucket(self, source_file_name, destination_blob_name):
         if not destination_blob_name:
@@ -173,6 +357,18 @@ class GCSFile:
             destination_file_name))
 
 
+def chunk(items, size):
+    """Yields lists of up to size items from an iterable."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class GCPubSub:
     """Publishes multiple messages to a Pub/Sub topic with an error handler."""
 
@@ -0,0 +1,207 @@
+#
+# Slots shared by every spawner on a host
+#
+# Several spawners can run on one vm, e.g., one per docker image or kind of work.  Each on its own would pull as
+# much work as it can run, so together they oversubscribe the host and hold leases on work they can't start.  The
+# slot table is a small file in HOST_SLOTS_FILE that every spawner maps into memory.  A spawner takes a slot before
+# it pulls work and gives it back when the work is done, so no more than HOST_SLOTS pieces of work run on the host
+# at once.  Batches take a slot for every sub-task after the first.  Slot i is on core i modulo the number of
+# cores, and with HOST_SLOTS_PIN_CORES the work is pinned to it.  Changes to the table are made under a file lock,
+# and slots of processes that are gone, e.g., after a crash or a kill -9, are taken back the next time a slot is
+# looked for.
+#
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+
+import WorkSpawnerConfig
+import Workspace
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MAGIC = b'WSST'
+VERSION = 1
+HEADER = struct.Struct('<4sII')  # magic, version, number of slots in use
+SLOT = struct.Struct('<qqd')  # pid holding the slot or 0, start time of the process in clock ticks, time taken
+MAX_SLOTS = 1024  # the file is always big enough for this many, so it never has to grow while it is mapped
+SIZE = HEADER.size + MAX_SLOTS * SLOT.size
+
+
+def get_start_ticks(pid):
+	"""
+	:param pid: process id
+	:return: when the process started in clock ticks after boot, so a reused pid isn't mistaken for the process
+			that held a slot.  0 if it isn't known
+	"""
+	try:
+		with open('/proc/' + str(pid) + '/stat') as f:
+			stat = f.read()
+		# the command name can have spaces and parentheses in it, the fields after it don't
+		return int(stat[stat.rindex(')') + 2:].split()[19])
+	except (OSError, ValueError, IndexError):
+		return 0
+
+
+class HostSlots:
+	"""
+	Table of the slots on a host in a memory mapped file, shared by the spawners on it
+	"""
+
+	def __init__(self, filename=None, slots=None, pin_cores=None):
+		"""
+		:param filename: file the table is in.  defaults to WorkSpawnerConfig.HOST_SLOTS_FILE
+		:param slots: number of slots on the host.  defaults to WorkSpawnerConfig.HOST_SLOTS, 0 is the number of
+				cores.  the first spawner sets it, the others use the size in the table while it has live slots
+		:param pin_cores: True to pin work to the core of its slot.  defaults to WorkSpawnerConfig.HOST_SLOTS_PIN_CORES
+		"""
+		self.filename = filename if filename is not None else WorkSpawnerConfig.HOST_SLOTS_FILE
+		slots = slots if slots is not None else WorkSpawnerConfig.HOST_SLOTS
+		slots = min(MAX_SLOTS, slots or os.cpu_count() or 1)
+		self.pin_cores = pin_cores if pin_cores is not None else WorkSpawnerConfig.HOST_SLOTS_PIN_CORES
+		self.pid = os.getpid()
+		self.start_ticks = get_start_ticks(self.pid)
+		self.held = set()  # slots this process holds
+
+		directory = os.path.dirname(self.filename)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+		self.file = os.fdopen(fd, 'r+b')
+		with self._lock():
+			if os.fstat(fd).st_size < SIZE:
+				os.ftruncate(fd, SIZE)
+		self.map = mmap.mmap(fd, SIZE)
+
+		with self._lock():
+			magic, version, count = HEADER.unpack_from(self.map, 0)
+			if (magic, version) != (MAGIC, VERSION):
+				self._reset(slots)
+			elif count != slots:
+				if self._get_live(count):
+					logging.warning('host slot table has ' + str(count) + ' slots instead of ' + str(slots) +
+									', keeping it while other spawners use it')
+				else:
+					self._reset(slots)
+
+	@contextlib.contextmanager
+	def _lock(self):
+		fcntl.flock(self.file, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self.file, fcntl.LOCK_UN)
+
+	def _reset(self, slots):
+		HEADER.pack_into(self.map, 0, MAGIC, VERSION, slots)
+		for index in range(MAX_SLOTS):
+			self._write(index, 0, 0, 0.0)
+
+	def _read(self, index):
+		"""
+		:return: (pid, start ticks, time taken) of a slot.  the pid is 0 if the slot is free
+		"""
+		return SLOT.unpack_from(self.map, HEADER.size + index * SLOT.size)
+
+	def _write(self, index, pid, start_ticks, taken):
+		SLOT.pack_into(self.map, HEADER.size + index * SLOT.size, pid, start_ticks, taken)
+
+	def _get_count(self):
+		return HEADER.unpack_from(self.map, 0)[2]
+
+	def _is_stale(self, pid, start_ticks):
+		"""
+		:return: True if the process that took a slot is gone
+		"""
+		if pid == self.pid:
+			return start_ticks != self.start_ticks  # an earlier process that had the same pid
+		if not Workspace.is_running(pid):
+			return True
+		return bool(start_ticks) and get_start_ticks(pid) not in (0, start_ticks)
+
+	def _get_live(self, count):
+		"""
+		:return: slots held by processes that are still running
+		"""
+		live = []
+		for index in range(count):
+			pid, start_ticks, taken = self._read(index)
+			if pid and not self._is_stale(pid, start_ticks):
+				live.append(index)
+		return live
+
+	def acquire(self):
+		"""
+		take a free slot, taking back the slots of processes that are gone first
+		:return: index of the slot, None if every slot is taken
+		"""
+		with self._lock():
+			for index in range(self._get_count()):
+				pid, start_ticks, taken = self._read(index)
+				if pid and self._is_stale(pid, start_ticks):
+					logging.info('taking back host slot: ' + str(index) + ' of pid: ' + str(pid) +
+								' which is no longer running')
+					pid = 0
+				if not pid:
+					self._write(index, self.pid, self.start_ticks, time.time())
+					self.held.add(index)
+					return index
+		return None
+
+	def release(self, index):
+		"""
+		:param index: slot from acquire()
+		:return: None
+		"""
+		if index is None or index not in self.held:
+			return
+		with self._lock():
+			pid, start_ticks, taken = self._read(index)
+			if pid == self.pid:
+				self._write(index, 0, 0, 0.0)
+		self.held.discard(index)
+
+	def release_all(self):
+		"""
+		give back every slot this process holds, e.g., before exiting
+		:return: None
+		"""
+		for index in list(self.held):
+			self.release(index)
+
+	@staticmethod
+	def get_core(index):
+		"""
+		:return: core of a slot
+		"""
+		return index % (os.cpu_count() or 1)
+
+	def get_cores(self, index):
+		"""
+		:param index: slot from acquire()
+		:return: set of cores to pin the work in the slot to, None to let it run on any
+		"""
+		if not self.pin_cores or index is None:
+			return None
+		return {self.get_core(index)}
+
+	def get_taken(self):
+		"""
+		:return: list of (slot, pid, core, seconds it has been taken for) of the slots in use
+		"""
+		now = time.time()
+		in_use = []
+		with self._lock():
+			for index in range(self._get_count()):
+				pid, start_ticks, taken = self._read(index)
+				if pid:
+					in_use.append((index, pid, self.get_core(index), now - taken))
+		return in_use
+
+	def __len__(self):
+		return self._get_count()
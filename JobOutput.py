@@ -0,0 +1,217 @@
+#
+# Capture of the stdout and stderr of spawned work
+#
+# Each stream is drained by its own reader thread as fast as the work writes it, so a chatty job can never
+# block on a full pipe.  What is read goes to a per job file that is rotated at a size cap, and the last few KB
+# are kept in memory so they can be attached to the message if the work fails.
+#
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class RotatingFile:
+	"""
+	File that is renamed to .1 (and .1 to .2 and so on) once it reaches max_bytes, keeping at most backups old files
+	"""
+
+	def __init__(self, filename, max_bytes, backups):
+		self.filename = filename
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.file = open(filename, 'wb')
+		self.size = 0
+
+	def write(self, data):
+		if self.size and self.size + len(data) > self.max_bytes:
+			self.rotate()
+		self.file.write(data)
+		self.file.flush()  # so the output of running work can be tailed
+		self.size += len(data)
+
+	def rotate(self):
+		self.file.close()
+		for index in range(self.backups - 1, 0, -1):
+			older = self.filename + '.' + str(index)
+			if os.path.exists(older):
+				os.replace(older, self.filename + '.' + str(index + 1))
+		if self.backups:
+			os.replace(self.filename, self.filename + '.1')
+		self.file = open(self.filename, 'wb')
+		self.size = 0
+
+	def close(self):
+		self.file.close()
+
+
+class TailBuffer:
+	"""
+	Ring buffer of the last max_bytes written to it.  0 keeps nothing
+	"""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.chunks = collections.deque()
+		self.size = 0
+		self.lock = threading.Lock()
+
+	def write(self, data):
+		if self.max_bytes <= 0:
+			return
+		with self.lock:
+			self.chunks.append(data)
+			self.size += len(data)
+			while self.size - len(self.chunks[0]) >= self.max_bytes:  # drop chunks that are entirely too old
+				self.size -= len(self.chunks.popleft())
+
+	def get(self):
+		"""
+		:return: the last max_bytes written, decoded as utf-8
+		"""
+		if self.max_bytes <= 0:  # data[-0:] would be all of it
+			return ''
+		with self.lock:
+			data = b''.join(self.chunks)
+		return data[-self.max_bytes:].decode('utf-8', errors='replace')
+
+
+class OutputCapture:
+	"""
+	Reader threads for the stdout and stderr pipes of one job
+	"""
+
+	# the streams that are captured
+	STREAMS = ('stdout', 'stderr')
+
+	def __init__(self, job_name, output_dir=None, max_bytes=None, backups=None, tail_bytes=None):
+		"""
+		:param job_name: used to name the output files of the job
+		:param output_dir: directory the output files go in.  defaults to WorkSpawnerConfig.JOB_OUTPUT_DIR
+		:param max_bytes: size a file is rotated at
+		:param backups: number of rotated files kept per stream
+		:param tail_bytes: number of bytes at the end of each stream kept in memory
+		"""
+		if output_dir is None:
+			output_dir = WorkSpawnerConfig.JOB_OUTPUT_DIR
+		if max_bytes is None:
+			max_bytes = WorkSpawnerConfig.JOB_OUTPUT_MAX_BYTES
+		if backups is None:
+			backups = WorkSpawnerConfig.JOB_OUTPUT_BACKUPS
+		if tail_bytes is None:
+			tail_bytes = WorkSpawnerConfig.JOB_OUTPUT_TAIL_BYTES
+
+		os.makedirs(output_dir, exist_ok=True)
+		self.output_dir = output_dir
+		self.job_name = job_name
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.tails = {stream: TailBuffer(tail_bytes) for stream in self.STREAMS}
+		self.threads = []
+
+	def get_filename(self, stream):
+		return os.path.join(self.output_dir, self.job_name + '.' + stream)
+
+	def start(self, process):
+		"""
+		start draining the pipes of the process
+		:param process: Popen started with stdout=PIPE and stderr=PIPE
+		:return: None
+		"""
+		for stream in self.STREAMS:
+			pipe = getattr(process, stream)
+			thread = threading.Thread(target=self._read, args=(pipe, stream), daemon=True,
+									name='output-' + stream + '-' + str(process.pid))
+			thread.start()
+			self.threads.append(thread)
+
+	def _read(self, pipe, stream):
+		output_file = RotatingFile(self.get_filename(stream), self.max_bytes, self.backups)
+		tail = self.tails[stream]
+		try:
+			while True:
+				data = os.read(pipe.fileno(), 65536)  # returns what is available instead of waiting for a full block
+				if not data:  # every process holding the pipe has closed it
+					break
+				output_file.write(data)
+				tail.write(data)
+		except (OSError, ValueError) as error:
+			logging.error('could not capture ' + stream + ' of job: ' + self.job_name + ' ' + str(error))
+		finally:
+			output_file.close()
+			pipe.close()
+
+	def join(self, timeout=5):
+		"""
+		wait for the rest of the output once the process has exited.  anything the work left running in the
+		background may hold the pipes open, so don't wait for that forever
+		:param timeout: max seconds to wait for each stream
+		:return: None
+		"""
+		for thread in self.threads:
+			thread.join(timeout)
+
+	def get_tail(self, stream):
+		"""
+		:param stream: 'stdout' or 'stderr'
+		:return: the last tail_bytes of the stream
+		"""
+		return self.tails[stream].get()
+
+	def add_to_attributes(self, message):
+		"""
+		attach the tail of each stream, and where to find the rest of it, to a message whose work failed
+		:param message: message whose work failed
+		:return: None
+		"""
+		message.attributes['output_files'] = socket.gethostname() + ':' + self.get_filename('{stdout,stderr}')
+		for stream in self.STREAMS:
+			tail = self.get_tail(stream)
+			if tail:
+				logging.info(stream + ' of failed job: ' + self.job_name + '\n' + tail)
+				# pub/sub attribute values are limited to 1024 bytes, so only the end of the tail fits
+				message.attributes[stream + '_tail'] = tail.encode('utf-8')[-1024:].decode('utf-8', errors='ignore')
+
+
+def prune(output_dir=None, keep=None):
+	"""
+	delete the output of all but the most recent jobs
+	:param output_dir: directory the output files are in.  defaults to WorkSpawnerConfig.JOB_OUTPUT_DIR
+	:param keep: number of output files to keep.  defaults to WorkSpawnerConfig.JOB_OUTPUT_KEEP_FILES
+	:return: None
+	"""
+	if output_dir is None:
+		output_dir = WorkSpawnerConfig.JOB_OUTPUT_DIR
+	if keep is None:
+		keep = WorkSpawnerConfig.JOB_OUTPUT_KEEP_FILES
+
+	try:
+		entries = [entry for entry in os.scandir(output_dir) if entry.is_file()]
+	except FileNotFoundError:
+		return
+
+	entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)  # newest first
+	for entry in entries[keep:]:
+		try:
+			os.remove(entry.path)
+		except OSError:
+			pass  # removed by another spawner
+
+
+def get_job_name(message):
+	"""
+	:param message: message the job is for
+	:return: unique name for the output files of the job
+	"""
+	name = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+	if message.message_id:
+		name += '-' + ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(message.message_id))
+	return name
@@ -0,0 +1,69 @@
+#
+# Keeps the leases of messages that have been pulled but are waiting on something alive
+#
+import logging
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class LeaseKeeper:
+	"""
+	Tracks messages that are held by this process and renews their leases with queue.keep_alive() once half of
+	the lease has gone by.  Call renew() regularly, at least a few times per lease.
+	"""
+
+	def __init__(self, queue, lease=None, clock=time.time):
+		"""
+		:param queue: PubSub instance the messages were pulled from
+		:param lease: seconds a keep_alive() extends a lease by.  defaults to WorkSpawnerConfig.LEASE_SECONDS
+		:param clock: function that returns the current time in seconds
+		"""
+		self.queue = queue
+		self.lease = lease if lease is not None else WorkSpawnerConfig.LEASE_SECONDS
+		self.clock = clock
+		self.renewed = {}  # id(message): (message, time the lease was last renewed, seconds the lease is renewed by)
+
+	def add(self, message, lease=None):
+		"""
+		start keeping a message alive.  the lease is renewed right away
+		:param message: message that was just pulled
+		:param lease: seconds to renew the lease of this message by.  defaults to the lease of the keeper
+		:return: None
+		"""
+		if lease is None:
+			lease = self.lease
+		self.queue.keep_alive(message, lease)
+		self.renewed[id(message)] = (message, self.clock(), lease)
+
+	def remove(self, message):
+		"""
+		stop keeping a message alive, e.g., because it is about to be acked
+		:param message: message being held
+		:return: None
+		"""
+		self.renewed.pop(id(message), None)
+
+	def get_messages(self):
+		return [message for message, renewed, lease in self.renewed.values()]
+
+	def renew(self):
+		"""
+		renew the leases that are half way to expiring
+		:return: None
+		"""
+		now = self.clock()
+		for key, (message, renewed, lease) in list(self.renewed.items()):
+			if now - renewed >= lease / 2:
+				try:
+					self.queue.keep_alive(message, lease)
+					self.renewed[key] = (message, now, lease)
+				except Exception as error:  # the lease may already be gone, the message will be redelivered
+					logging.error('could not renew lease for: ' + str(message) + ' ' + str(error))
+
+	def __len__(self):
+		return len(self.renewed)
@@ -0,0 +1,618 @@
+#
+# Append-only ledger of every job the spawners on a host have run, and the command line to query it
+#
+# The history of the work was only in the logs.  The spawner appends one binary row per job to a journal file of
+# its own: the message_id, topic, score, when it was pulled, spawned, exited and finished, its result and exit code,
+# the cpu time and block io of its processes and which attempt it was.  A journal is sealed after
+# LEDGER_COMPACT_INTERVAL seconds or LEDGER_JOURNAL_ROWS rows.  A background thread of the spawner, or
+# Ledger.py --compact from cron, compacts the sealed journals into a columnar segment: each column is a packed array,
+# the rows are sorted by topic and then by when they finished, and the header says where the rows of each topic start
+# and end and the time they cover.  A query only reads the columns it needs of the topics it asks for, and finds
+# the time range by bisecting the finished column, so a few million rows take well under a second.  Small segments
+# are merged into segments of up to LEDGER_SEGMENT_ROWS rows, and rows older than LEDGER_RETENTION are dropped.
+#	$ python3 Ledger.py --since 24h
+#	$ python3 Ledger.py --since 7d --metric cpu --topic priority-1 --result failed --json
+#
+import argparse
+import array
+import bisect
+import collections
+import contextlib
+import fcntl
+import glob
+import itertools
+import json
+import logging
+import math
+import os
+import resource
+import struct
+import sys
+import threading
+import time
+import uuid
+
+import WorkSpawnerConfig
+import Workspace
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# numeric columns, name and array typecode.  times are unix seconds, NaN for stages the job didn't reach
+COLUMNS = [
+	('pulled', 'd'),  # the message was pulled
+	('started', 'd'),  # the work was spawned
+	('exited', 'd'),  # the work exited or was stopped
+	('finished', 'd'),  # the message was acked or handed back.  the time index of the ledger
+	('score', 'd'),  # score attribute stamped by the prioritizer, NaN if it has none
+	('exitcode', 'q'),  # NO_EXITCODE if nothing was spawned, e.g., a cached result or a batch
+	('attempt', 'q'),  # 1 for the first attempt, the retry count is one less
+	('cpu_user', 'd'),  # seconds of user cpu of the processes of the work the spawner reaped
+	('cpu_system', 'd'),
+	('blocks_in', 'q'),  # blocks read and written by them.  docker work only counts the docker client
+	('blocks_out', 'q'),
+]
+# string columns.  topic and result are dictionary encoded in segments
+STRINGS = ['message_id', 'topic', 'result']
+NO_EXITCODE = -2 ** 63
+FAILED_RESULT = 'failed'  # WorkSpawner.WORK_FAILED
+
+# a journal row: the length of each string, the numeric columns and then the strings
+JOURNAL_ROW = struct.Struct('<' + 'H' * len(STRINGS) + ''.join(code for name, code in COLUMNS))
+
+# a segment: magic, version, length of the json header, the header and then the columns
+SEGMENT_MAGIC = b'WSLG'
+SEGMENT_VERSION = 1
+SEGMENT_PREFIX = struct.Struct('<4sII')
+
+JOURNAL_PREFIX = 'journal-'  # journal-<pid>-<ms>-<uuid>.bin, written by a running spawner
+SEALED_PREFIX = 'sealed-'  # journals that are complete and waiting to be compacted
+SEGMENT_PREFIX_NAME = 'segment-'
+LOCK_FILE = 'compact.lock'
+
+# what a query can measure, the columns it needs and how a value is worked out from them
+METRICS = {
+	'runtime': (('started', 'exited'), lambda started, exited: exited - started),  # seconds the work ran
+	'pre_process': (('pulled', 'started'), lambda pulled, started: started - pulled),
+	'post_process': (('exited', 'finished'), lambda exited, finished: finished - exited),
+	'total': (('pulled', 'finished'), lambda pulled, finished: finished - pulled),
+	'cpu': (('cpu_user', 'cpu_system'), lambda user, system: user + system),
+	'score': (('score',), float),
+	'attempt': (('attempt',), float),
+}
+
+
+def get_child_usage():
+	"""
+	:return: (user cpu seconds, system cpu seconds, blocks in, blocks out) of every child process reaped so far.
+			the difference before and after a job is what its processes used
+	"""
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime, usage.ru_stime, usage.ru_inblock, usage.ru_oublock
+
+
+def get_percentile(ordered, q):
+	if not ordered:
+		return None
+	return ordered[min(len(ordered) - 1, max(0, int(math.ceil(q * len(ordered))) - 1))]
+
+
+def read_journal(filename):
+	"""
+	:param filename: journal file
+	:return: list of rows, each a tuple of the numeric columns and then the strings.  a row the writer didn't get
+			to finish is left out
+	"""
+	with open(filename, 'rb') as f:
+		data = f.read()
+	rows = []
+	offset = 0
+	count = len(STRINGS)
+	while offset + JOURNAL_ROW.size <= len(data):
+		fields = JOURNAL_ROW.unpack_from(data, offset)
+		end = offset + JOURNAL_ROW.size + sum(fields[:count])
+		if end > len(data):
+			break
+		strings = []
+		position = offset + JOURNAL_ROW.size
+		for length in fields[:count]:
+			strings.append(data[position:position + length].decode('utf-8', 'replace'))
+			position += length
+		rows.append(fields[count:] + tuple(strings))
+		offset = end
+	return rows
+
+
+def read_segment_header(f):
+	"""
+	:param f: segment file opened for binary reading
+	:return: the json header, with the offset the columns start at in data_offset
+	"""
+	magic, version, length = SEGMENT_PREFIX.unpack(f.read(SEGMENT_PREFIX.size))
+	if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+		raise ValueError('not a ledger segment: ' + str(f.name))
+	header = json.loads(f.read(length).decode('utf-8'))
+	header['data_offset'] = SEGMENT_PREFIX.size + length
+	return header
+
+
+def read_column(f, header, name, start=0, end=None):
+	"""
+	:param f: segment file opened for binary reading
+	:param header: from read_segment_header()
+	:param name: numeric column, or topic or result for their codes
+	:param start: first row
+	:param end: row after the last, None for the last row
+	:return: array of the values of the rows
+	"""
+	typecode, offset, count = header['columns'][name]
+	end = count if end is None else end
+	values = array.array(typecode)
+	f.seek(header['data_offset'] + offset + start * values.itemsize)
+	values.frombytes(f.read((end - start) * values.itemsize))
+	if header['byteorder'] != sys.byteorder:
+		values.byteswap()
+	return values
+
+
+def read_segment(filename):
+	"""
+	:param filename: segment file
+	:return: list of rows as in read_journal()
+	"""
+	with open(filename, 'rb') as f:
+		header = read_segment_header(f)
+		numeric = [read_column(f, header, name) for name, code in COLUMNS]
+		topics = [header['topics'][code] for code in read_column(f, header, 'topic')]
+		results = [header['results'][code] for code in read_column(f, header, 'result')]
+		offset, length = header['message_ids']
+		f.seek(header['data_offset'] + offset)
+		message_ids = f.read(length).decode('utf-8').split('\0') if header['rows'] else []
+	return list(zip(*numeric, message_ids, topics, results))
+
+
+def write_segment(filename, rows, sources):
+	"""
+	:param filename: segment file to write
+	:param rows: list of rows as in read_journal()
+	:param sources: names of the journals and segments the rows came from.  queries skip them while they are
+			still around, and compaction deletes them if it was stopped before it could
+	:return: None
+	"""
+	count = len(COLUMNS)
+	finished = [name for name, code in COLUMNS].index('finished')
+	topic_index = count + STRINGS.index('topic')
+	rows = sorted(rows, key=lambda row: (row[topic_index], row[finished]))
+
+	topics = sorted(set(row[topic_index] for row in rows))
+	results = sorted(set(row[count + STRINGS.index('result')] for row in rows))
+	topic_codes = {topic: code for code, topic in enumerate(topics)}
+	result_codes = {result: code for code, result in enumerate(results)}
+
+	blobs = []
+	columns = {}
+	offset = 0
+	for index, (name, code) in enumerate(COLUMNS):
+		blobs.append(array.array(code, (row[index] for row in rows)).tobytes())
+		columns[name] = (code, offset, len(rows))
+		offset += len(blobs[-1])
+	for name, codes in (('topic', topic_codes), ('result', result_codes)):
+		blobs.append(array.array('H', (codes[row[count + STRINGS.index(name)]] for row in rows)).tobytes())
+		columns[name] = ('H', offset, len(rows))
+		offset += len(blobs[-1])
+	blobs.append('\0'.join(row[count + STRINGS.index('message_id')] for row in rows).encode('utf-8'))
+	message_ids = (offset, len(blobs[-1]))
+
+	topic_rows = {}
+	for index, row in enumerate(rows):
+		topic_rows.setdefault(row[topic_index], [index, index])[1] = index + 1
+	times = [row[finished] for row in rows]
+	header = json.dumps({
+		'rows': len(rows),
+		'byteorder': sys.byteorder,
+		'columns': columns,
+		'message_ids': message_ids,
+		'topics': topics,
+		'results': results,
+		'topic_rows': topic_rows,
+		'min_time': min(times) if times else None,
+		'max_time': max(times) if times else None,
+		'sources': sources,
+	}).encode('utf-8')
+
+	with open(filename + '.tmp', 'wb') as f:
+		f.write(SEGMENT_PREFIX.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(header)))
+		f.write(header)
+		for blob in blobs:
+			f.write(blob)
+	os.replace(filename + '.tmp', filename)  # queries never see half a segment
+
+
+class Ledger:
+	"""
+	Journal of the jobs run by this process, compacted with the journals of the other spawners into segments
+	"""
+
+	def __init__(self, directory=None, clock=time.time):
+		"""
+		:param directory: where the journals and segments are.  defaults to WorkSpawnerConfig.LEDGER_DIR
+		:param clock: function that returns the current time in seconds
+		"""
+		self.directory = directory if directory is not None else WorkSpawnerConfig.LEDGER_DIR
+		self.clock = clock
+		self.journal = None  # file of the journal this process appends to, opened with the first row
+		self.journal_name = None
+		self.journal_rows = 0
+		self.opened_at = None  # when the journal was opened
+		self.compactor = None  # background thread compacting the ledger, started with the first row
+		self.stopped = threading.Event()
+
+	def record(self, message, result, times, exitcode=None, usage_at_start=None, attempt=1):
+		"""
+		append a row for a job, and seal the journal when it is time to compact it
+		:param message: message the job was for
+		:param result: what happened to the work, e.g., WorkSpawner.WORK_SUCCEEDED
+		:param times: (pulled, started, exited, finished).  None for stages the job didn't reach
+		:param exitcode: exit code of the work, None if nothing was spawned
+		:param usage_at_start: get_child_usage() when the job was pulled, None to not record usage
+		:param attempt: which attempt at the work it was, starting at 1
+		:return: None
+		"""
+		usage = (0.0, 0.0, 0, 0)
+		if usage_at_start is not None:
+			usage = tuple(now - start for now, start in zip(get_child_usage(), usage_at_start))
+		try:
+			score = float(message.attributes.get(WorkSpawnerConfig.SCORE_ATTRIBUTE))
+		except (TypeError, ValueError):
+			score = float('nan')
+
+		strings = [str(message.message_id or '').encode('utf-8'), str(message.topic or '').encode('utf-8'),
+				str(result).encode('utf-8')]
+		numeric = [float('nan') if value is None else value for value in times]
+		numeric += [score, NO_EXITCODE if exitcode is None else exitcode, attempt]
+		try:
+			row = JOURNAL_ROW.pack(*([len(string) for string in strings] + numeric + list(usage))) + b''.join(strings)
+			if self.journal is None:
+				self.open_journal()
+			self.journal.write(row)  # one write to a file opened for appending, so a row is never torn by a crash
+			self.journal_rows += 1
+		except (OSError, struct.error) as error:  # the ledger is a record of the work, it mustn't stop it
+			logging.error('could not add job to the ledger: ' + str(error))
+			return
+
+		interval = WorkSpawnerConfig.LEDGER_COMPACT_INTERVAL
+		if (self.journal_rows >= WorkSpawnerConfig.LEDGER_JOURNAL_ROWS or
+				(interval and self.clock() - self.opened_at >= interval)):
+			self.close()
+
+		if self.compactor is None and interval:
+			self.compactor = threading.Thread(target=self._compact_loop, name='ledger-compactor', daemon=True)
+			self.compactor.start()
+
+	def _compact_loop(self):
+		# compaction reads and writes whole segments, so it is kept off the thread running the work
+		while not self.stopped.wait(WorkSpawnerConfig.LEDGER_COMPACT_INTERVAL):
+			self.compact()
+
+	def open_journal(self):
+		os.makedirs(self.directory, exist_ok=True)
+		# a full journal can be sealed and the next one opened in the same millisecond
+		self.journal_name = (JOURNAL_PREFIX + str(os.getpid()) + '-' + str(int(self.clock() * 1000)) + '-' +
+							uuid.uuid4().hex[:12] + '.bin')
+		self.journal = open(os.path.join(self.directory, self.journal_name), 'ab', buffering=0)
+		self.journal_rows = 0
+		self.opened_at = self.clock()
+
+	def seal(self):
+		"""
+		close the journal of this process so it can be compacted.  the next row starts a new one
+		:return: None
+		"""
+		if self.journal is None:
+			return
+		self.journal.close()
+		self.journal = None
+		os.replace(os.path.join(self.directory, self.journal_name),
+				os.path.join(self.directory, SEALED_PREFIX + self.journal_name[len(JOURNAL_PREFIX):]))
+
+	def close(self):
+		try:
+			self.seal()
+		except OSError as error:
+			logging.error('could not seal ledger journal: ' + str(error))
+
+	@contextlib.contextmanager
+	def _lock(self):
+		"""
+		:return: context that holds the compaction lock, or raises BlockingIOError if another process holds it
+		"""
+		with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+			fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			try:
+				yield
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def stop(self):
+		"""
+		stop compacting in the background and seal the journal.  a compaction that is running is left to finish, or
+		to be cleaned up by the next one if the process exits first
+		:return: None
+		"""
+		self.stopped.set()
+		self.close()
+
+	def compact(self):
+		"""
+		compact every sealed journal and the journals of spawners that are gone into a segment, and merge small
+		segments.  the journal of this process is left alone, it is compacted once it is sealed.  skipped if another
+		process is compacting
+		:return: None
+		"""
+		try:
+			with self._lock():
+				self.remove_compacted()
+				self.compact_journals()
+				self.merge_segments()
+				self.expire_segments()
+		except BlockingIOError:
+			logging.debug('another process is compacting the ledger')
+		except (OSError, ValueError) as error:
+			logging.error('could not compact the ledger: ' + str(error))
+
+	def get_segment_name(self):
+		# the merge of a segment can be written in the same millisecond as the segment
+		return SEGMENT_PREFIX_NAME + str(int(self.clock() * 1000)) + '-' + uuid.uuid4().hex[:12] + '.seg'
+
+	def get_segments(self):
+		"""
+		:return: list of (name, header) of the segments, oldest first
+		"""
+		segments = []
+		for filename in sorted(glob.glob(os.path.join(self.directory, SEGMENT_PREFIX_NAME + '*.seg'))):
+			try:
+				with open(filename, 'rb') as f:
+					segments.append((os.path.basename(filename), read_segment_header(f)))
+			except FileNotFoundError:  # merged by another process
+				continue
+		return segments
+
+	def get_journals(self, live=True):
+		"""
+		:param live: also return the journals of spawners that are still running
+		:return: list of names of the journals waiting to be compacted
+		"""
+		names = []
+		for name in sorted(os.listdir(self.directory)) if os.path.isdir(self.directory) else []:
+			if name.startswith(SEALED_PREFIX):
+				names.append(name)
+			elif name.startswith(JOURNAL_PREFIX):
+				pid = int(name[len(JOURNAL_PREFIX):].split('-')[0])
+				if live or (name != self.journal_name and not Workspace.is_running(pid)):
+					names.append(name)
+		return names
+
+	def remove_compacted(self):
+		"""
+		delete journals and segments that are already in a segment, e.g., if compaction was stopped
+		:return: None
+		"""
+		for name, header in self.get_segments():
+			for source in header['sources']:
+				with contextlib.suppress(FileNotFoundError):
+					os.remove(os.path.join(self.directory, source))
+
+	def compact_journals(self):
+		names = self.get_journals(live=False)
+		if not names:
+			return
+		rows = []
+		for name in names:
+			rows.extend(read_journal(os.path.join(self.directory, name)))
+		write_segment(os.path.join(self.directory, self.get_segment_name()), rows, names)
+		for name in names:
+			os.remove(os.path.join(self.directory, name))
+		logging.info('compacted ' + str(len(rows)) + ' jobs from ' + str(len(names)) + ' ledger journals')
+
+	def merge_segments(self):
+		"""
+		merge segments under LEDGER_SEGMENT_ROWS rows, oldest first, once there are LEDGER_MERGE_SEGMENTS of them
+		:return: None
+		"""
+		small = [(name, header) for name, header in self.get_segments()
+				if header['rows'] < WorkSpawnerConfig.LEDGER_SEGMENT_ROWS]
+		if len(small) < WorkSpawnerConfig.LEDGER_MERGE_SEGMENTS:
+			return
+		small.sort(key=lambda segment: segment[1]['min_time'] or 0)
+
+		group = []
+		rows = 0
+		for name, header in small + [(None, None)]:
+			if name is not None and rows + header['rows'] <= WorkSpawnerConfig.LEDGER_SEGMENT_ROWS:
+				group.append(name)
+				rows += header['rows']
+				continue
+			if len(group) > 1:
+				self.merge(group)
+			group = [name] if name is not None else []
+			rows = header['rows'] if name is not None else 0
+
+	def merge(self, names):
+		"""
+		:param names: segments to merge into one.  rows older than LEDGER_RETENTION are dropped
+		:return: None
+		"""
+		oldest = self.clock() - WorkSpawnerConfig.LEDGER_RETENTION
+		finished = [name for name, code in COLUMNS].index('finished')
+		rows = []
+		for name in names:
+			rows.extend(row for row in read_segment(os.path.join(self.directory, name)) if row[finished] >= oldest)
+		write_segment(os.path.join(self.directory, self.get_segment_name()), rows, names)
+		for name in names:
+			os.remove(os.path.join(self.directory, name))
+		logging.info('merged ' + str(len(names)) + ' ledger segments into one of ' + str(len(rows)) + ' jobs')
+
+	def expire_segments(self):
+		oldest = self.clock() - WorkSpawnerConfig.LEDGER_RETENTION
+		for name, header in self.get_segments():
+			if header['max_time'] is None or header['max_time'] < oldest:
+				os.remove(os.path.join(self.directory, name))
+				logging.info('deleted ledger segment older than the retention: ' + name)
+
+	def query(self, since=None, until=None, topics=None, result=None, metric='runtime'):
+		"""
+		:param since: first finished time to include, None for the start of the ledger
+		:param until: last finished time to include, None for now
+		:param topics: list of topics to include, None for all of them
+		:param result: only measure jobs with this result, None for every job
+		:param metric: one of METRICS
+		:return: dict of topic to {'jobs': jobs that finished in the time range, 'results': jobs per result,
+				'values': sorted values of the metric}
+		"""
+		since = -math.inf if since is None else since
+		until = math.inf if until is None else until
+		names, wanted = METRICS[metric]
+		groups = {}
+
+		def add(topic, columns, codes, result_names):
+			group = groups.setdefault(topic, {'jobs': 0, 'results': collections.Counter(), 'values': []})
+			group['jobs'] += len(codes)
+			for code, count in collections.Counter(codes).items():
+				group['results'][result_names[code] if result_names is not None else code] += count
+			values = map(wanted, *[columns[name] for name in names])
+			if result is not None:
+				code = result if result_names is None else (result_names.index(result) if result in result_names
+															else None)
+				values = itertools.compress(values, [each == code for each in codes])
+			group['values'].extend(value for value in values if value == value)  # NaN for stages not reached
+
+		segments = self.get_segments()
+		compacted = set(itertools.chain.from_iterable(header['sources'] for name, header in segments))
+		for name, header in segments:
+			if name in compacted or header['min_time'] is None:
+				continue
+			if header['max_time'] < since or header['min_time'] > until:
+				continue
+			try:
+				with open(os.path.join(self.directory, name), 'rb') as f:
+					for topic, (start, end) in header['topic_rows'].items():
+						if topics is not None and topic not in topics:
+							continue
+						times = read_column(f, header, 'finished', start, end)
+						first = start + bisect.bisect_left(times, since)
+						last = start + bisect.bisect_right(times, until)
+						columns = {column: read_column(f, header, column, first, last) for column in names}
+						add(topic, columns, read_column(f, header, 'result', first, last), header['results'])
+			except FileNotFoundError:  # merged while the query ran, its rows are in the merged segment
+				logging.warning('ledger segment was merged during the query, run it again for every job: ' + name)
+
+		index = {name: position for position, (name, code) in enumerate(COLUMNS)}
+		topic_index = len(COLUMNS) + STRINGS.index('topic')
+		result_index = len(COLUMNS) + STRINGS.index('result')
+		for name in self.get_journals():
+			if name in compacted:
+				continue
+			try:
+				rows = read_journal(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				continue
+			by_topic = collections.defaultdict(list)
+			for row in rows:
+				if since <= row[index['finished']] <= until and (topics is None or row[topic_index] in topics):
+					by_topic[row[topic_index]].append(row)
+			for topic, topic_rows in by_topic.items():
+				columns = {column: [row[index[column]] for row in topic_rows] for column in names}
+				add(topic, columns, [row[result_index] for row in topic_rows], None)
+
+		for group in groups.values():
+			group['values'].sort()
+		return groups
+
+
+def summarize(groups, quantiles):
+	"""
+	:param groups: from Ledger.query()
+	:param quantiles: list of quantiles to report, e.g., [0.5, 0.95, 0.99]
+	:return: list of dicts of the jobs, failures and the metric of each topic
+	"""
+	summary = []
+	for topic, group in sorted(groups.items()):
+		values = group['values']
+		entry = {
+			'topic': topic,
+			'jobs': group['jobs'],
+			'failed': group['results'].get(FAILED_RESULT, 0),
+			'results': dict(group['results']),
+			'count': len(values),
+			'mean': sum(values) / len(values) if values else None,
+			'max': values[-1] if values else None,
+		}
+		for q in quantiles:
+			entry['p' + ('%g' % (100 * q))] = get_percentile(values, q)
+		summary.append(entry)
+	return summary
+
+
+def format_summary(summary, quantiles, metric):
+	"""
+	:param summary: from summarize()
+	:return: the summary as a table
+	"""
+	def number(value):
+		return '-' if value is None else ('%.1f' % value)
+
+	names = ['p' + ('%g' % (100 * q)) for q in quantiles]
+	lines = ['topic'.ljust(16) + 'jobs'.rjust(10) + 'failed'.rjust(10) + (metric + ' n').rjust(12) +
+			'mean'.rjust(10) + ''.join(name.rjust(10) for name in names) + 'max'.rjust(10)]
+	for entry in summary:
+		lines.append(entry['topic'].ljust(16) + str(entry['jobs']).rjust(10) + str(entry['failed']).rjust(10) +
+					str(entry['count']).rjust(12) + number(entry['mean']).rjust(10) +
+					''.join(number(entry[name]).rjust(10) for name in names) + number(entry['max']).rjust(10))
+	return '\n'.join(lines)
+
+
+def parse_age(age):
+	"""
+	:param age: seconds, or a number with s, m, h or d after it, e.g., 24h
+	:return: seconds
+	"""
+	units = {'s': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600}
+	try:
+		if age[-1:] in units:
+			return float(age[:-1]) * units[age[-1]]
+		return float(age)
+	except ValueError:
+		raise argparse.ArgumentTypeError('not an age: ' + age)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--dir", help="ledger directory instead of LEDGER_DIR")
+	parser.add_argument("--since", help="jobs that finished this long ago or later, e.g., 24h", type=parse_age)
+	parser.add_argument("--until", help="jobs that finished this long ago or earlier, e.g., 1h", type=parse_age)
+	parser.add_argument("--topic", help="only this topic, can be repeated", action="append")
+	parser.add_argument("--result", help="only measure jobs with this result, e.g., failed")
+	parser.add_argument("--metric", help="what to measure of each job, runtime is how long the work ran",
+						choices=sorted(METRICS), default='runtime')
+	parser.add_argument("--quantiles", help="comma separated quantiles", default='0.5,0.95,0.99')
+	parser.add_argument("--compact", help="compact the journals and merge segments first", action="store_true")
+	parser.add_argument("--json", help="print the summary as json", action="store_true")
+	args = parser.parse_args()
+
+	ledger = Ledger(args.dir)
+	if args.compact:
+		os.makedirs(ledger.directory, exist_ok=True)
+		ledger.compact()
+
+	now = time.time()
+	quantiles = [float(q) for q in args.quantiles.split(',')]
+	groups = ledger.query(now - args.since if args.since is not None else None,
+						now - args.until if args.until is not None else None, args.topic, args.result, args.metric)
+	summary = summarize(groups, quantiles)
+
+	if args.json:
+		print(json.dumps(summary, indent=2))
+	else:
+		print(format_summary(summary, quantiles, args.metric))
@@ -0,0 +1,232 @@
+#
+# Backlog and drain time estimates for the work topics, used to size the groups of spawner vms
+#
+# Spawners report every job they finish, and a heartbeat while idle, on the stats topic.  The monitor combines
+# those with the backlog of each topic to estimate how long each tier will take to drain and how many spawners
+# are needed to drain all of the work within a target time.
+#
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+import WorkSpawnerConfig
+from PubSub import Message
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# results of jobs that took work off the backlog, WorkSpawner.WORK_SUCCEEDED and WORK_FAILED.  work that was handed
+# back is back on the backlog, and took about no time, so it isn't counted towards job durations
+JOB_RESULTS = ('succeeded', 'failed')
+
+
+class StatsReporter:
+	"""
+	Used by a spawner to report finished jobs and heartbeats on the stats topic
+	"""
+
+	def __init__(self, queue, slots=1, clock=time.time):
+		"""
+		:param queue: PubSub instance to publish on
+		:param slots: number of jobs the spawner can run at once
+		:param clock: function that returns the current time in seconds
+		"""
+		self.queue = queue
+		self.slots = slots
+		self.clock = clock
+		self.spawner_id = socket.gethostname() + ':' + str(os.getpid())
+		self.last_report = 0
+
+	def _publish(self, stats):
+		stats.update({'spawner': self.spawner_id, 'slots': self.slots, 'time': self.clock()})
+		try:
+			self.queue.publish(WorkSpawnerConfig.stats_topic_name, Message(json.dumps(stats)))
+			self.last_report = self.clock()
+		except Exception as error:  # stats must never stop work
+			logging.error('could not report stats: ' + str(error))
+
+	def job_done(self, topic, duration, result):
+		"""
+		:param topic: topic the work was pulled from
+		:param duration: seconds the work took
+		:param result: what happened to the work.  one of the WorkSpawner WORK_ results
+		:return: None
+		"""
+		self._publish({'type': 'job', 'topic': topic, 'duration': duration, 'result': result})
+
+	def task_done(self, topic, duration, result):
+		"""
+		sub-tasks of batch messages are reported separately from jobs so they don't count towards job durations
+		:param topic: topic the batch was pulled from
+		:param duration: seconds the sub-task took
+		:param result: what happened to the sub-task.  one of the WorkSpawner WORK_ results
+		:return: None
+		"""
+		self._publish({'type': 'task', 'topic': topic, 'duration': duration, 'result': result})
+
+	def heartbeat(self):
+		"""
+		let the monitor know the spawner is alive.  only publishes if nothing has been reported for a while
+		:return: None
+		"""
+		if self.clock() - self.last_report >= WorkSpawnerConfig.STATS_HEARTBEAT_SECONDS:
+			self._publish({'type': 'heartbeat'})
+
+
+class BacklogMonitor:
+	"""
+	Estimates drain time per tier and the number of spawners needed from topic backlogs and spawner stats
+	"""
+
+	def __init__(self, queue, topics, clock=time.time):
+		"""
+		:param queue: PubSub instance to read backlogs and stats from
+		:param topics: list of work topics, highest priority first
+		:param clock: function that returns the current time in seconds
+		"""
+		self.queue = queue
+		self.topics = list(topics)
+		self.clock = clock
+		self.durations = {}  # topic: exponentially weighted moving average of job seconds
+		self.spawners = {}  # spawner id: (time last heard from, slots)
+
+	def add_stats(self, stats):
+		"""
+		:param stats: dict reported by a StatsReporter
+		:return: None
+		"""
+		spawner = stats.get('spawner')
+		if spawner:
+			self.spawners[spawner] = (float(stats.get('time', self.clock())), int(stats.get('slots', 1)))
+
+		if stats.get('type') == 'job' and stats.get('topic') in self.topics and stats.get('result') in JOB_RESULTS:
+			topic = stats['topic']
+			duration = float(stats['duration'])
+			alpha = WorkSpawnerConfig.MONITOR_DURATION_ALPHA
+			if topic in self.durations:
+				self.durations[topic] = alpha * duration + (1 - alpha) * self.durations[topic]
+			else:
+				self.durations[topic] = duration
+
+	def consume_stats(self, max_messages=1000):
+		"""
+		pull and ack everything on the stats topic
+		:param max_messages: max stats to read in one call
+		:return: number of stats read
+		"""
+		count = 0
+		while count < max_messages:
+			messages = self.queue.pull(WorkSpawnerConfig.stats_topic_name, 100)
+			if not messages:
+				break
+			for message in messages:
+				try:
+					self.add_stats(json.loads(message.body))
+				except (ValueError, KeyError, TypeError) as error:
+					logging.error('bad stats message: ' + str(message) + ' ' + str(error))
+				self.queue.ack(message)
+				count += 1
+		return count
+
+	def get_active_slots(self):
+		"""
+		:return: (number of spawners heard from recently, total slots they have)
+		"""
+		cutoff = self.clock() - WorkSpawnerConfig.MONITOR_SPAWNER_TIMEOUT
+		active = [slots for last_seen, slots in self.spawners.values() if last_seen >= cutoff]
+		return len(active), sum(active)
+
+	def estimate(self):
+		"""
+		Work is assumed to be drained highest priority first, so a tier drains once it and every tier above it is done
+		:return: dict of the estimates, ready to be written out as json
+		"""
+		spawners, slots = self.get_active_slots()
+
+		tiers = []
+		total_work = 0.0  # slot seconds of work in the backlog of this tier and all above it
+		unknown_backlog = False
+		for topic in self.topics:
+			backlog = self.queue.get_backlog(topic)
+			if backlog is None:
+				unknown_backlog = True
+				backlog = 0
+
+			duration = self.durations.get(topic, WorkSpawnerConfig.MONITOR_DEFAULT_JOB_SECONDS)
+			total_work += backlog * duration
+
+			drain_seconds = None  # never drains without spawners
+			if slots:
+				drain_seconds = total_work / slots
+			elif not total_work:
+				drain_seconds = 0.0
+
+			tiers.append({
+				'topic': topic,
+				'backlog': backlog,
+				'job_seconds': duration,
+				'drain_seconds': drain_seconds,
+			})
+
+		# slots needed to drain everything within the target, converted to spawners using the slots they report
+		slots_per_spawner = slots / spawners if spawners else 1
+		desired_slots = total_work / WorkSpawnerConfig.MONITOR_TARGET_DRAIN_SECONDS
+		desired_spawners = int(math.ceil(desired_slots / slots_per_spawner))
+		desired_spawners = max(WorkSpawnerConfig.MONITOR_MIN_SPAWNERS,
+							min(WorkSpawnerConfig.MONITOR_MAX_SPAWNERS, desired_spawners))
+
+		return {
+			'time': self.clock(),
+			'tiers': tiers,
+			'active_spawners': spawners,
+			'active_slots': slots,
+			'backlog_seconds': total_work,
+			'desired_spawners': desired_spawners,
+			'complete': not unknown_backlog,  # False if some backlogs couldn't be read
+		}
+
+	@staticmethod
+	def write_metrics(estimate, filename):
+		"""
+		write the estimate in the prometheus text format, e.g., for the node exporter textfile collector
+		:param estimate: dict from estimate()
+		:param filename: file to write, replaced atomically
+		:return: None
+		"""
+		lines = [
+			'work_spawner_active_spawners ' + str(estimate['active_spawners']),
+			'work_spawner_active_slots ' + str(estimate['active_slots']),
+			'work_spawner_backlog_seconds ' + str(estimate['backlog_seconds']),
+			'work_spawner_desired_spawners ' + str(estimate['desired_spawners']),
+		]
+		for tier in estimate['tiers']:
+			label = '{topic="' + tier['topic'] + '"} '
+			lines.append('work_spawner_backlog' + label + str(tier['backlog']))
+			lines.append('work_spawner_job_seconds' + label + str(tier['job_seconds']))
+			if tier['drain_seconds'] is not None:
+				lines.append('work_spawner_drain_seconds' + label + str(tier['drain_seconds']))
+
+		tmp_file = filename + '.tmp'
+		with open(tmp_file, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.replace(tmp_file, filename)
+
+	@staticmethod
+	def write_json(estimate, filename):
+		"""
+		:param estimate: dict from estimate()
+		:param filename: file to write, replaced atomically so a reader never sees half of it
+		:return: None
+		"""
+		dirname = os.path.dirname(filename)
+		if dirname:
+			os.makedirs(dirname, exist_ok=True)
+
+		tmp_file = filename + '.tmp'
+		with open(tmp_file, 'w') as f:
+			json.dump(estimate, f)
+		os.replace(tmp_file, filename)
@@ -1,4 +1,5 @@
 # standard imports
+import os
 import logging
 import argparse
 import subprocess
@@ -20,7 +21,37 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# tree the work runs in when the spawner doesn't give jobs their own workspaces
+SHARED_WORK_DIR = '../Bug-World'
+
+# True if prioritize always gives the same body and attributes the same score, so scores can be cached.  it doesn't,
+# messages without a priority attribute get a random score
+PRIORITIZE_IS_DETERMINISTIC = False
+
+
 # stateless re-entrant functions
+def get_work_dir(message):
+	"""
+	:param message: PubSub message to be processed
+	:return: directory the work runs in, its own workspace if it has one
+	"""
+	if message.workspace is not None:
+		return message.workspace.path
+	return SHARED_WORK_DIR
+
+
+def get_config_dir(message):
+	if message.workspace is not None:
+		return message.workspace.config_dir
+	return SHARED_WORK_DIR + '/config'
+
+
+def get_log_dir(message):
+	if message.workspace is not None:
+		return message.workspace.log_dir
+	return SHARED_WORK_DIR + '/logs'
+
+
 def pre_process(message):  # things that need to be done before processing work
 	logging.debug('pre_processing: ' + str(message))
 	# payload definition
@@ -30,7 +61,7 @@ def pre_process(message):  # things that need to be done before processing work
 	# copy all files from src directory to ./config/
 	bucket = WorkSpawnerConfig.DEFAULT_BUCKET_NAME
 	src_file = 'gs://' + bucket + '/config/*'
-	dest_file = '../Bug-World/config/'
+	dest_file = get_config_dir(message) + '/'
 	cmd = ['gsutil', 'cp', '-r', src_file, dest_file]
 	logging.info('executing the following command: ' + str(cmd))
 
@@ -65,7 +96,9 @@ def post_process(message):  # things that need to be done after the work is comp
 
 	bucket = WorkSpawnerConfig.DEFAULT_BUCKET_NAME 
 	base_path = 'gs://' + bucket + '/Bug-World/logs/'
-	cmd = ['gsutil', 'mv', '../Bug-World/logs/', base_path]
+	if message.workspace is not None:  # keep the logs of jobs apart
+		base_path += os.path.basename(message.workspace.path) + '/'
+	cmd = ['gsutil', 'mv', get_log_dir(message) + '/', base_path]
 	logging.info('executing the following command: ' + str(cmd))
 	try:
 		rv = subprocess.call(cmd)
@@ -83,7 +116,7 @@ def post_process(message):  # things that need to be done after the work is comp
 		# if the copy worked, prioritize the work for next loop
 		priority_message = 'Prioritize this: ' + base_path
 		q = PubSub.PubSubFactory.get_queue()
-		message = PubSub.Message_GCP(priority_message)
+		message = Message(priority_message)
 		q.publish(WorkSpawnerConfig.priority_topic_name, message)
 
 	logging.debug('returning: ' + str(rv))
@@ -98,12 +131,28 @@ def get_work_cmd(message):  # default stub
 	# cmd_to_run = ['python', 'MyWork.py']  # needs to be something Popen can run.
 	cmd_to_run = ['python', 'main.py', '--nodisplay']  # needs to be something Popen can run.
 
-	cwd = '../Bug-World'
+	cwd = get_work_dir(message)
 	logging.debug('cmd: ' + str(cmd_to_run) + ' in dir: ' + cwd)
 
 	return cmd_to_run, cwd
 
 
+def get_work_inputs(message):  # only used when results are memoized
+	"""
+	:param message: PubSub message to be processed
+	:return: list of the files and directories the work reads.  their contents are part of the memoization key
+	"""
+	return [get_config_dir(message)]
+
+
+def get_work_outputs(message):  # only used when results are memoized
+	"""
+	:param message: PubSub message to be processed
+	:return: the directory the work writes its results to.  this is what gets cached and restored
+	"""
+	return get_log_dir(message)
+
+
 def prioritize(message):  # where the prioritization happens based on the message
 	logging.debug('prioritizing: ' + str(message))
 	if 'priority' in message.attributes:
@@ -0,0 +1,224 @@
+#
+# Low overhead profiling of the daemons for --profile
+#
+# A sampling thread records the stack of the main thread every few ms, so it costs about the same whether the
+# daemon is busy or idle and can be left on in production.  The MyWork hooks are also timed one by one.
+# On SIGUSR1 or exit the samples are written in the collapsed stack format flamegraph.pl and speedscope read,
+# and the hook timings as a table, e.g.,
+#	$ kill -USR1 <pid>
+#	$ flamegraph.pl state/profile/work_spawner-<pid>.collapsed > spawner.svg
+# PROFILE_PSTATS adds a cProfile of the main thread for pstats and snakeviz, which costs much more.
+#
+import atexit
+import collections
+import cProfile
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# MyWork hooks that are timed
+HOOKS = ['pre_process', 'get_work_cmd', 'post_process', 'prioritize']
+
+
+class HookTimer:
+	"""
+	Number of calls, total and max seconds of each hook
+	"""
+
+	def __init__(self):
+		self.timings = collections.OrderedDict()  # hook name: [calls, total seconds, max seconds]
+		self.lock = threading.Lock()
+
+	def wrap(self, name, function):
+		"""
+		:param name: name the timings are kept under
+		:param function: function to time
+		:return: function that times every call of function
+		"""
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				self.add(name, time.perf_counter() - start)
+		timed.untimed = function
+		return timed
+
+	def add(self, name, seconds):
+		with self.lock:
+			timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+			timing[0] += 1
+			timing[1] += seconds
+			timing[2] = max(timing[2], seconds)
+
+	def get_report(self):
+		"""
+		:return: table of the timings, one hook per line
+		"""
+		lines = ['hook'.ljust(16) + 'calls'.rjust(10) + 'total s'.rjust(12) + 'mean ms'.rjust(12) + 'max ms'.rjust(12)]
+		with self.lock:
+			for name, (calls, total, longest) in self.timings.items():
+				mean = total / calls if calls else 0.0
+				lines.append(name.ljust(16) + str(calls).rjust(10) + ('%.3f' % total).rjust(12) +
+							('%.1f' % (mean * 1000)).rjust(12) + ('%.1f' % (longest * 1000)).rjust(12))
+		return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+	"""
+	Samples the stack of one thread from a background thread
+	"""
+
+	def __init__(self, interval=None, thread_id=None):
+		"""
+		:param interval: seconds between samples.  defaults to WorkSpawnerConfig.PROFILE_INTERVAL
+		:param thread_id: thread to sample.  defaults to the thread creating the profiler
+		"""
+		self.interval = interval if interval is not None else WorkSpawnerConfig.PROFILE_INTERVAL
+		self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+		self.stacks = collections.Counter()  # collapsed stack: number of samples
+		self.samples = 0
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is None:  # the thread has exited
+				break
+			self.stacks[self.collapse(frame)] += 1
+			self.samples += 1
+			del frame  # don't keep the frames of the sampled thread alive
+
+	@staticmethod
+	def collapse(frame):
+		"""
+		:param frame: innermost frame of a stack
+		:return: the stack as 'outermost;...;innermost' with each frame as file:function
+		"""
+		names = []
+		while frame is not None:
+			code = frame.f_code
+			names.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+			frame = frame.f_back
+		return ';'.join(reversed(names))
+
+	def get_collapsed(self):
+		"""
+		:return: the samples in the collapsed stack format, one 'stack count' per line
+		"""
+		stacks = list(self.stacks.items())  # copy, the sampling thread may be adding to it
+		return ''.join(stack + ' ' + str(count) + '\n' for stack, count in sorted(stacks))
+
+
+class Profiler:
+	"""
+	Sampling profile of the daemon and timings of the MyWork hooks, dumped on SIGUSR1 and on exit
+	"""
+
+	def __init__(self, name, output_dir=None, interval=None, pstats=None):
+		"""
+		:param name: name of the daemon, used to name the output files
+		:param output_dir: directory to write to.  defaults to WorkSpawnerConfig.PROFILE_DIR
+		:param interval: seconds between samples
+		:param pstats: also run cProfile on the main thread.  defaults to WorkSpawnerConfig.PROFILE_PSTATS
+		"""
+		self.name = name
+		self.output_dir = output_dir if output_dir is not None else WorkSpawnerConfig.PROFILE_DIR
+		self.sampler = SamplingProfiler(interval)
+		self.hooks = HookTimer()
+		self.started = None
+
+		if pstats is None:
+			pstats = WorkSpawnerConfig.PROFILE_PSTATS
+		self.cprofile = cProfile.Profile() if pstats else None
+
+	def time_hooks(self, module):
+		"""
+		time every call of the hooks in module.  the module functions are replaced, so callers that look them up
+		at call time, like the Spawner, are timed.  prioritize calls in scoring pool processes are not counted
+		:param module: module with the hooks, i.e., MyWork
+		:return: None
+		"""
+		for hook in HOOKS:
+			function = getattr(module, hook, None)
+			if function is not None and not hasattr(function, 'untimed'):
+				setattr(module, hook, self.hooks.wrap(hook, function))
+
+	def start(self):
+		"""
+		start sampling and dump on SIGUSR1 and on exit
+		:return: None
+		"""
+		self.started = time.time()
+		self.sampler.start()
+		if self.cprofile is not None:
+			self.cprofile.enable()
+		signal.signal(signal.SIGUSR1, lambda sig, frame: self.dump())
+		atexit.register(self.stop)
+		logging.info('profiling ' + self.name + ', send SIGUSR1 to pid: ' + str(os.getpid()) + ' to dump to: ' +
+					self.output_dir)
+
+	def stop(self):
+		if self.started is None:
+			return
+		self.sampler.stop()
+		if self.cprofile is not None:
+			self.cprofile.disable()
+		self.dump()
+		self.started = None
+
+	def get_filename(self, extension):
+		return os.path.join(self.output_dir, self.name + '-' + str(os.getpid()) + extension)
+
+	def dump(self):
+		"""
+		write the samples so far to <name>-<pid>.collapsed, the hook timings to <name>-<pid>.hooks.txt and the
+		cProfile, if there is one, to <name>-<pid>.pstats
+		:return: None
+		"""
+		try:
+			os.makedirs(self.output_dir, exist_ok=True)
+			for extension, text in (('.collapsed', self.sampler.get_collapsed()), ('.hooks.txt', self.get_report())):
+				filename = self.get_filename(extension)
+				with open(filename + '.tmp', 'w') as f:
+					f.write(text)
+				os.replace(filename + '.tmp', filename)
+
+			if self.cprofile is not None:
+				filename = self.get_filename('.pstats')
+				try:
+					self.cprofile.dump_stats(filename + '.tmp')
+				finally:
+					if not self.sampler.stopped.is_set():  # dump_stats disables the profile, keep profiling until stop
+						self.cprofile.enable()
+				os.replace(filename + '.tmp', filename)
+		except OSError as error:  # profiling must never stop the daemon
+			logging.error('could not write profile: ' + str(error))
+			return
+		logging.info('wrote profile of ' + str(self.sampler.samples) + ' samples to: ' + self.get_filename('.*'))
+
+	def get_report(self):
+		seconds = time.time() - self.started if self.started else 0
+		return (self.name + ' pid ' + str(os.getpid()) + ': ' + str(self.sampler.samples) + ' samples over ' +
+				str(int(seconds)) + ' seconds\n\n' + self.hooks.get_report())
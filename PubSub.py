@@ -1,9 +1,13 @@
 
 import logging
 import datetime
+import time
+import uuid
 
 # WorkSpawner specific
 import WorkSpawnerConfig
+import ClaimCheck
+import Codec
 
 # logging format is set in the WorkSpawnerConfig...this changes the level in this file.
 logger = logging.getLogger()
@@ -15,14 +19,30 @@ logger.setLevel(logging.INFO)
 #  the dummy implementation is only for testing
 class Message:
 
-	def __init__(self, body='', attributes={}):
+	def __init__(self, body='', attributes=None):
 		"""
 		:param attributes: dict of things passed along with the message in the queue
-		:param body: binary blob of data
+		:param body: string or bytes
 		"""
+		self.claim = None  # ClaimCheck.Claim if the body is in a blob store and fetched when first used
 		self.body = body
-		self.attributes = attributes
+		self.attributes = attributes if attributes is not None else {}
 		self.acknowledged = False
+		self.message_id = None  # unique id assigned by the queue when published
+		self.delivery_attempt = 0  # set by queues that count deliveries, 0 if they don't
+		self.topic = None  # topic the message was pulled from
+		self.workspace = None  # Workspace.Workspace the work for the message runs in, None for the shared tree
+
+	@property
+	def body(self):
+		if self.claim is not None and not self.claim.loaded:
+			self._body = self.claim.fetch()
+		return self._body
+
+	@body.setter
+	def body(self, body):
+		self._body = body
+		self.claim = None  # a new body isn't the one in the blob store any more
 
 	# this is required method because used in error handling and reporting
 	def __repr__(self):
@@ -32,18 +52,53 @@ class Message:
 			for key in self.attributes:
 				attr_string += str(', attr_key:' + str(key) + ' ' + str(self.attributes[key]))
 
-		repr_string = 'message: ' + str(self.body)
+		if self.claim is not None and not self.claim.loaded:  # don't fetch the body just to log it
+			repr_string = 'message: <claim check ' + self.claim.ref + '>'
+		else:
+			repr_string = 'message: ' + str(self.body)
 		repr_string += attr_string
 		return repr_string
 
-	def add_error_to_attributes(self, error_str):
+	def is_attribute_set(self, key):
+		"""
+		attributes are passed as strings, so treat empty, 0, false and no as not set
+		:param key: attribute name
+		:return: True if the attribute is present and not a false value
+		"""
+		value = self.attributes.get(key)
+		if value is None:
+			return False
+		return str(value).strip().lower() not in ('', '0', 'false', 'no')
+
+	def get_work_key(self):
+		"""
+		:return: string that identifies the work, the idempotency key if the publisher set one otherwise the
+				message_id.  None if the message can't be identified
+		"""
+		key = self.attributes.get(WorkSpawnerConfig.IDEMPOTENCY_KEY_ATTRIBUTE)
+		if key:
+			return 'key:' + str(key)
+		if self.message_id:
+			return 'id:' + str(self.message_id)
+		return None
+
+	def add_error_to_attributes(self, error_str, when=None):
 		"""
 		add the error string to the message attributes so can see on failed work queue
 		:param error_str: string of what went wrong
+		:param when: datetime the error happened, defaults to now
 		:return: none
 		"""
-		key = 'error_' + str(datetime.time())
-		self.attributes[key] = error_str
+		# number the errors so earlier ones aren't overwritten
+		count = 1
+		while 'error_' + str(count) in self.attributes:
+			count += 1
+
+		key = 'error_' + str(count)
+		if when is None:
+			when = datetime.datetime.now()
+		value = when.isoformat() + ': ' + str(error_str)
+		self.attributes[key] = value[:1024]  # pub/sub attribute values are limited to 1024 bytes
 
 	# over ride this method for platform specific work
 	def ack(self):
@@ -56,8 +111,14 @@ class Message:
 class PubSub:  # base class that describes the implementation independent interface
 
 	# override this method with platform specific init
-	def __init__(self):
-		self.queue = {}  # a dictionary of all of the topics the PubSub will communicate with
+	def __init__(self, clock=time.time):
+		"""
+		the base class is an in memory queue with leases so it can be used for testing
+		:param clock: function that returns the current time in seconds.  the simulator passes a virtual clock
+		"""
+		self.queue = {}  # a dictionary of all of the topics the PubSub will communicate with, each is message_id: message
+		self.clock = clock
+		self.leases = {}  # id(message): time the lease on a pulled message runs out
 
 	# override this method with platform specific methods
 	def publish(self, topic, message):
@@ -70,12 +131,17 @@ class PubSub:  # base class that describes the implementation independent interf
 		try:
 			self.queue[topic]  # if a queue hasn't been created yet, create one
 		except KeyError:
-			self.queue[topic] = []
+			self.queue[topic] = {}  # oldest first, so acks don't have to search for the message
 
-		self.queue[topic].append(message)
+		# queue a copy like a real queue would, the same message may be published to several topics
+		body, attributes = self.pack(message)
+		queued_message = Message(body, dict(attributes))
+		queued_message.message_id = str(uuid.uuid4())
+		queued_message.topic = topic
+		self.queue[topic][queued_message.message_id] = queued_message
 
 		# for debugging only
-		debug_msg = 'Queuing-> ' + message + ' to topic: ' + str(topic)
+		debug_msg = 'Queuing-> ' + str(message) + ' to topic: ' + str(topic)
 		logging.debug(debug_msg)
 		return True
 
@@ -89,9 +155,19 @@ class PubSub:  # base class that describes the implementation independent interf
 		except KeyError:
 			return None  # no such topic
 
-		messages = self.queue[topic]  # list of messages for this topic
+		now = self.clock()
+		messages_to_return = []
+		for message in self.queue[topic].values():  # messages for this topic, oldest first
+			if len(messages_to_return) >= max_message_count:
+				break
+			if self.leases.get(id(message), 0) > now:
+				continue  # pulled by someone else and not acked yet
 
-		messages_to_return = messages[:max_message_count]
+			self.leases[id(message)] = now + WorkSpawnerConfig.LEASE_SECONDS
+			message.delivery_attempt += 1
+			if message.delivery_attempt == 1:  # the queued copy is unpacked in place, so only the first time
+				self.unpack(message)
+			messages_to_return.append(message)
 
 		# for debugging only
 		debug_msg = ''
@@ -100,17 +176,48 @@ class PubSub:  # base class that describes the implementation independent interf
 
 		logging.debug(debug_msg)
 
-		return messages[:max_message_count]  # return a subset of those messages
+		return messages_to_return  # return a subset of those messages
 
 	# override this method
-	def keep_alive(self, message):
+	def keep_alive(self, message, deadline=None):
 		"""
 		used to keep long running messages timing out for not being acknowledged
 		:param message:
+		:param deadline: seconds to extend the lease by.  defaults to WorkSpawnerConfig.LEASE_SECONDS
 		:return: None
 		"""
+		if deadline is None:
+			deadline = WorkSpawnerConfig.LEASE_SECONDS
+		self.leases[id(message)] = self.clock() + deadline
 		logging.debug('stayin alive!')
 
+	# override this method with platform specific methods
+	def get_backlog(self, topic):
+		"""
+		:param topic: short topic name
+		:return: number of messages on the topic that haven't been acked, None if it can't be found out
+		"""
+		return len(self.queue.get(topic, {}))
+
+	# override this method with platform specific methods
+	def nack(self, message, delay=0):
+		"""
+		hand a message back to the queue without processing it
+		:param message: message to hand back
+		:param delay: seconds before the message can be delivered again
+		:return: None
+		"""
+		self.leases[id(message)] = self.clock() + delay
+		logging.debug('handing back message: ' + str(message) + ' for ' + str(delay) + ' seconds')
+
+	# override this method if acks or publishes are batched
+	def flush(self):
+		"""
+		send anything that has been batched up.  called before the daemons exit
+		:return: None
+		"""
+		pass
+
 	# override this method with platform specific methods
 	def log_failed_work(self, message):
 		logging.error('Work failed for message: ' + str(message))
@@ -123,214 +230,147 @@ class PubSub:  # base class that describes the implementation independent interf
 		"""
 		message.ack()
 
+		messages = self.queue.get(message.topic, {})
+		if messages.get(message.message_id) is message:
+			del messages[message.message_id]
+			self.release(message)
+		self.leases.pop(id(message), None)
 
-# ----  Google Cloud Platform implementation below here -----
-# cloud specific imports
-from google.api_core.exceptions import DeadlineExceeded
-from google.api_core.exceptions import NotFound
-from google.cloud import pubsub_v1
-
-
-class Message_GCP(Message):
-	"""
-	GCP specific version of Message
-	"""
-	def __init__(self, body='', attributes={}):
-		self.body = body
-		self.attributes = attributes
-		self.received_message = None  # used to store the full message received if any
-
-	def create_from_received_message(self, received_message):
-		self.received_message = received_message  # this has other data stored with it.
-		self.body = self.received_message.message.data.decode('utf-8')
-		self.attributes = dict(self.received_message.message.attributes)
-		logging.debug('created a message: ' + str(self))  # base class repr should be able to print this
-
-	def convert_attributes(self):
-		"""GCP Pubsub requires attributes to be strings when published.  This converts them"""
-		ret_attribs = {}
-
-		for key in self.attributes:
-			logging.debug('Type of attribute: ' + str(key) + ' is: ' + type(self.attributes[key]).__name__)
-			ret_attribs[key] = str(self.attributes[key])
-
-		return ret_attribs
-
-
-class PubSub_GCP(PubSub):
-
-	def __init__(self):
-
-		# for publishing
-		self.publisher = pubsub_v1.PublisherClient()
-
-		# for subscribing
-		self.subscriber = pubsub_v1.SubscriberClient()
-		self.ack_paths = {}  # used to keep the ack_id's for successfully processed messages
-		self.subscriptions = {}  # every topic requires a subscription object to interact with it.
-
-		# store project id from the configuration file
-		self.project_id = WorkSpawnerConfig.project_id
-
-	def _get_subscription(self, topic):
+	# override this method for backends whose daemons run on several hosts
+	def get_claim_check_location(self):
 		"""
-		private method only used by GCP
-		:param topic: short name of topic to lookup the subscription for.
-		:return: subscription_path as a string
+		:return: blob store bodies over WorkSpawnerConfig.CLAIM_CHECK_THRESHOLD are put in, see ClaimCheck.get_store()
 		"""
+		return WorkSpawnerConfig.CLAIM_CHECK_DIR
 
-		logging.debug("Looking up subscriptions for topic: " + topic)
-		# see if have already looked up the subscription
-		try:
-			subscription_path = self.subscriptions[topic]
-			return subscription_path
-		except KeyError:
-			pass  # continue to the rest of the function
-
-		# assume there is a subscription with the same name as the topic
-		subscription_path = self.subscriber.subscription_path(self.project_id, topic)
-		logging.debug("subscription_path: " + subscription_path)
-
-		self.subscriptions[topic] = subscription_path
+	def pack(self, message, copies=1):
+		"""
+		:param message: message about to be published
+		:param copies: number of subscriptions the message is delivered to
+		:return: (body, attributes) to put on the queue.  the body is compressed if it is large, and replaced by a
+				claim check attribute if it is still too large.  it is bytes if it was, or if it was compressed
+		"""
+		if message.claim is not None:  # pulled and not changed since, the body is already in a blob store
+			return ClaimCheck.add_ref(message, copies)
 
-		return subscription_path
+		body, attributes = Codec.encode(message.body, message.attributes)
+		if WorkSpawnerConfig.CLAIM_CHECK_ENABLED:
+			body, attributes = ClaimCheck.check_in(body, attributes, self.get_claim_check_location(), copies=copies)
+		return body, attributes
 
-	def publish(self, topic, message):
-		""" Publish a message body and attributes to a topic in a PubSub environment
-		:param topic: 	topic string specific to the cloud platform.  the path will be added to it
-						For GC: projects/project_id/topics/topic_name
-		:param message: the platform specific message to publish
-		:return: True if successful, False otherwise
+	def unpack(self, message):
 		"""
+		undo pack() on a message that was pulled.  a body in a blob store is fetched the first time it is used
+		:param message: message that was pulled, with the body as it came off the queue
+		:return: None
+		"""
+		codec_attributes = Codec.pop_attributes(message.attributes)
+		if not ClaimCheck.check_out(message, codec_attributes):
+			message.body = Codec.decode(message.body, codec_attributes)
 
-		logging.debug('publishing message: ' + str(message))
+	def release(self, message):
+		"""
+		free what pack() stored for a message once it has been acked
+		:param message: message that was acked
+		:return: None
+		"""
+		ClaimCheck.release(message)
 
-		# create the full unique path of the topic based on the current project
-		topic_path = self.publisher.topic_path(self.project_id, topic)
-		logging.debug('publishing on topic: ' + topic_path)
 
-		# When a message is published a message, the client returns a "future".
-		# this is to handle async responses for errors.
-		# https://googleapis.dev/python/pubsub/latest/publisher/api/futures.html
+# ---- Used to abstract the instantiation of the platform specific class ----
+class PubSubFactory:
+	"""
+	Registry of queue backends by name.  Each backend is a 'module:class' string that is only imported when it
+	is first used, so daemons and MyWork hooks don't pay for cloud libraries they don't use.
+	Other packages can add backends with an entry point in the BACKEND_ENTRY_POINT_GROUP group, e.g.,
+		[project.entry-points."work_spawner.backends"]
+		redis = "my_package.queues:PubSub_Redis"
+	"""
 
-		# data must be a byte string.
-		payload = message.body.encode('utf-8')
-		if not message.attributes:
-			logging.debug('attributes are empty')
+	backends = {
+		'memory': PubSub,
+		'gcp': 'PubSubGCP:PubSub_GCP',
+		'sqlite': 'PubSubSQLite:PubSub_SQLite',
+	}
 
-		if isinstance(message, Message_GCP):
-			# if a Message_GCP, then use function to convert it.  Otherwise assume attribs are strings
-			logging.debug('Converting attributes to string: ' + str(message))
-			attribs = message.convert_attributes()
+	BACKEND_ENTRY_POINT_GROUP = 'work_spawner.backends'
 
-		future = self.publisher.publish(topic_path, data=payload, **attribs)
-		logging.debug(future.result())
+	loaded = {}  # name: class of the backends that have been imported
+	entry_points_loaded = False
 
-	def pull(self, topic, max_message_count=1):
+	@staticmethod
+	def register(name, backend):
 		"""
-		poll to see if there is are any messages for the given topic
-		:param topic: short name for the topic
-		:param max_message_count: number of messages to pull if available, will pull up to max
-		:return: list of messages pulled, empty if non available
+		:param name: name the backend is selected by
+		:param backend: PubSub subclass, or a 'module:class' string to import it from on first use
+		:return: None
 		"""
+		PubSubFactory.backends[name] = backend
+		PubSubFactory.loaded.pop(name, None)
 
-		messages = []
-		response = None
-
-		# use the topic to find the appropriate subscription
-		subscription_path = self._get_subscription(topic)
+	@staticmethod
+	def _load_entry_points():
+		if PubSubFactory.entry_points_loaded:
+			return
+		PubSubFactory.entry_points_loaded = True
 
-		# The subscriber attempts to pull all of the messages up to the max.
+		import importlib.metadata
 		try:
-			response = self.subscriber.pull(request={"subscription": subscription_path, "max_messages": max_message_count})
+			entry_points = importlib.metadata.entry_points(group=PubSubFactory.BACKEND_ENTRY_POINT_GROUP)
+		except TypeError:  # python before 3.10 returns a dict of every group
+			entry_points = importlib.metadata.entry_points().get(PubSubFactory.BACKEND_ENTRY_POINT_GROUP, [])
 
-		except DeadlineExceeded:  # deadline is set at the subscription level.  if no work available by deadline, return
-			return messages  # should be empty
-		except NotFound:
-			logging.error('subscription path does not exist: ' + subscription_path)
-			exit(-1)
+		for entry_point in entry_points:
+			if entry_point.name not in PubSubFactory.backends:  # the built in backends can't be replaced this way
+				PubSubFactory.backends[entry_point.name] = entry_point.value
 
-		# response: definition google.cloud.pubsub_v1.types.PullResponse
-		# received_messages will be empty if none are available
-		# received_message: definition google.cloud.pubsub_v1.types.ReceivedMessage
+	@staticmethod
+	def get_backend_names():
+		PubSubFactory._load_entry_points()
+		return sorted(PubSubFactory.backends)
 
-		logging.debug('type of response received: ' + type(response).__name__)
+	@staticmethod
+	def get_backend(name):
+		"""
+		:param name: one of the keys in PubSubFactory.backends
+		:return: the PubSub subclass of the backend, imported if it hasn't been yet
+		"""
+		if name in PubSubFactory.loaded:
+			return PubSubFactory.loaded[name]
 
-		for received_message in response.received_messages:
-			logging.debug('type of message received: ' + type(received_message).__name__)
-			ack_id = received_message.ack_id
-			self.ack_paths[received_message.message.message_id] = {'path': subscription_path, 'ack_id': ack_id}
-			logging.debug("Received message: " + str(received_message))
-			message = Message_GCP()
-			message.create_from_received_message(received_message)
-			messages.append(message)
+		if name not in PubSubFactory.backends:
+			PubSubFactory._load_entry_points()
+		try:
+			backend = PubSubFactory.backends[name]
+		except KeyError:
+			raise ValueError('unknown queue backend: ' + str(name) + ', choose from: ' +
+							str(PubSubFactory.get_backend_names()))
 
-		return messages
+		if isinstance(backend, str):
+			import importlib
+			module_name, class_name = backend.split(':')
+			logging.debug('importing queue backend: ' + name + ' from: ' + backend)
+			backend = getattr(importlib.import_module(module_name), class_name)
 
-	def ack(self, message):
-		# response[].received_messages
-		# received_message.ackID
-		# received_message.message
-		# message.data: string
-		# message.attributes { string: string }
-		# message.messageID: string
-		# message.publishTime: string
-
-		# Acknowledges the received messages so they will not be sent again.
-
-		try:  # if came from a received message, should have ack() method on it.
-			message.received_message.ack()  # Python PubsubMessage has a method to ack itself
-			logging.debug('Acknowledged using built in ack method: ' + str(message))
-			return
-		except Exception:  # try try again
-			logging.debug('no ack method on received_message')
-
-		message_id = message.received_message.message.message_id
-		r_ack_id = message.received_message.ack_id
-		subs = self.ack_paths[message_id]
-		subscription_path = subs['path']
-		ack_id = subs['ack_id']
-		ack_ids = [ack_id]
-		logging.debug('subscription path to ack: ' + str(subscription_path))
-		logging.debug('received message ack_id: ' + str(r_ack_id))
-		logging.debug('going to ack message_id: ' + str(message_id) + ' ack_id: ' + str(ack_id))
-		self.subscriber.acknowledge(
-			request={"subscription": subscription_path, "ack_ids": ack_ids})
-		logging.debug('Acknowledged using explicit acknowledge: ' + str(message))
-
-	def keep_alive(self, message):
-		# look up subscription
-		# see how long the timeout is
-		# add to rcvd time
-		# if close, reset the ack timeout
-		# https://cloud.google.com/pubsub/docs/pull
-
-		message_id = message.received_message.message.message_id
-		subs = self.ack_paths[message_id]
-		subscription_path = subs['path']
-		ack_id = subs['ack_id']
-
-		# ack_deadline_seconds must be between 10 to 600.
-		self.subscriber.modify_ack_deadline(
-			request={"subscription": subscription_path, "ack_ids": [ack_id], "ack_deadline_seconds": 60})
-
-		logging.debug('Reset ack deadline for: ' + str(message))
-
-
-def log_failed_work(self, message):
-	# TODO: abstract this into class
-	#  failed_work_topic_name = tr.get_failed_topic()
-	self.publish(WorkSpawnerConfig.failed_work_topic_name, message)
+		PubSubFactory.loaded[name] = backend
+		return backend
 
+	@staticmethod
+	def get_queue(name=None):
+		"""
+		:param name: backend to use.  defaults to WorkSpawnerConfig.QUEUE_BACKEND, or memory in test mode
+		:return: a queue instance
+		"""
+		if name is None:
+			name = 'memory' if WorkSpawnerConfig.TEST_MODE else WorkSpawnerConfig.QUEUE_BACKEND
 
-# ---- Used to abstract the instantiation of the platform specific class ----
-class PubSubFactory:
+		return PubSubFactory.get_backend(name)()
 
-	@staticmethod
-	def get_queue():
-		if WorkSpawnerConfig.TEST_MODE:
-			pubsub = PubSub()
-		else:
-			pubsub = PubSub_GCP()
 
-		return pubsub
+def __getattr__(name):
+	# the GCP classes used to live in this module.  keep PubSub.Message_GCP and PubSub.PubSub_GCP working
+	# without importing the google cloud libraries for everyone that imports this module
+	if name in ('Message_GCP', 'PubSub_GCP'):
+		import PubSubGCP
+		return getattr(PubSubGCP, name)
+	raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
@@ -0,0 +1,273 @@
+#
+# Google Cloud Pub/Sub implementation of the PubSub interface
+#
+# only imported by PubSub.PubSubFactory when the gcp backend is used, since importing the google cloud
+# libraries takes several hundred ms
+#
+import logging
+import time
+
+# cloud specific imports
+from google.api_core.exceptions import DeadlineExceeded
+from google.api_core.exceptions import NotFound
+from google.cloud import pubsub_v1
+
+# WorkSpawner specific
+import WorkSpawnerConfig
+from PubSub import Message, PubSub
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class Message_GCP(Message):
+	"""
+	GCP specific version of Message
+	"""
+	def __init__(self, body='', attributes=None):
+		super().__init__(body, attributes)
+		self.received_message = None  # used to store the full message received if any
+
+	def create_from_received_message(self, received_message):
+		self.received_message = received_message  # this has other data stored with it.
+		self.body = self.received_message.message.data  # bytes until PubSub.unpack() decodes it
+		self.attributes = dict(self.received_message.message.attributes)
+		self.message_id = self.received_message.message.message_id
+		self.delivery_attempt = self.received_message.delivery_attempt
+		logging.debug('created a message: ' + str(self))  # base class repr should be able to print this
+
+	def convert_attributes(self):
+		"""GCP Pubsub requires attributes to be strings when published.  This converts them"""
+		ret_attribs = {}
+
+		for key in self.attributes:
+			logging.debug('Type of attribute: ' + str(key) + ' is: ' + type(self.attributes[key]).__name__)
+			ret_attribs[key] = str(self.attributes[key])
+
+		return ret_attribs
+
+
+class PubSub_GCP(PubSub):
+
+	def __init__(self):
+
+		# for publishing
+		self.publisher = pubsub_v1.PublisherClient()
+
+		# for subscribing
+		self.subscriber = pubsub_v1.SubscriberClient()
+		self.ack_paths = {}  # used to keep the ack_id's for successfully processed messages
+		self.subscriptions = {}  # every topic requires a subscription object to interact with it.
+
+		# store project id from the configuration file
+		self.project_id = WorkSpawnerConfig.project_id
+
+		self.monitoring = None  # only created if backlogs are read
+
+	def _get_subscription(self, topic):
+		"""
+		private method only used by GCP
+		:param topic: short name of topic to lookup the subscription for.
+		:return: subscription_path as a string
+		"""
+
+		logging.debug("Looking up subscriptions for topic: " + topic)
+		# see if have already looked up the subscription
+		try:
+			subscription_path = self.subscriptions[topic]
+			return subscription_path
+		except KeyError:
+			pass  # continue to the rest of the function
+
+		# assume there is a subscription with the same name as the topic
+		subscription_path = self.subscriber.subscription_path(self.project_id, topic)
+		logging.debug("subscription_path: " + subscription_path)
+
+		self.subscriptions[topic] = subscription_path
+
+		return subscription_path
+
+	def publish(self, topic, message):
+		""" Publish a message body and attributes to a topic in a PubSub environment
+		:param topic: 	topic string specific to the cloud platform.  the path will be added to it
+						For GC: projects/project_id/topics/topic_name
+		:param message: the platform specific message to publish
+		:return: True if successful, False otherwise
+		"""
+
+		logging.debug('publishing message: ' + str(message))
+
+		# create the full unique path of the topic based on the current project
+		topic_path = self.publisher.topic_path(self.project_id, topic)
+		logging.debug('publishing on topic: ' + topic_path)
+
+		# When a message is published a message, the client returns a "future".
+		# this is to handle async responses for errors.
+		# https://googleapis.dev/python/pubsub/latest/publisher/api/futures.html
+
+		# a large body is compressed, and replaced by a claim check if it is still large
+		body, attributes = self.pack(message)
+
+		# data must be a byte string.
+		payload = body.encode('utf-8') if isinstance(body, str) else body
+		if not attributes:
+			logging.debug('attributes are empty')
+
+		# GCP Pubsub requires attributes to be strings when published
+		attribs = {key: str(value) for key, value in attributes.items()}
+
+		future = self.publisher.publish(topic_path, data=payload, **attribs)
+		logging.debug(future.result())
+
+	def pull(self, topic, max_message_count=1):
+		"""
+		poll to see if there is are any messages for the given topic
+		:param topic: short name for the topic
+		:param max_message_count: number of messages to pull if available, will pull up to max
+		:return: list of messages pulled, empty if non available
+		"""
+
+		messages = []
+		response = None
+
+		# use the topic to find the appropriate subscription
+		subscription_path = self._get_subscription(topic)
+
+		# The subscriber attempts to pull all of the messages up to the max.
+		try:
+			response = self.subscriber.pull(request={"subscription": subscription_path, "max_messages": max_message_count})
+
+		except DeadlineExceeded:  # deadline is set at the subscription level.  if no work available by deadline, return
+			return messages  # should be empty
+		except NotFound:
+			logging.error('subscription path does not exist: ' + subscription_path)
+			exit(-1)
+
+		# response: definition google.cloud.pubsub_v1.types.PullResponse
+		# received_messages will be empty if none are available
+		# received_message: definition google.cloud.pubsub_v1.types.ReceivedMessage
+
+		logging.debug('type of response received: ' + type(response).__name__)
+
+		for received_message in response.received_messages:
+			logging.debug('type of message received: ' + type(received_message).__name__)
+			ack_id = received_message.ack_id
+			self.ack_paths[received_message.message.message_id] = {'path': subscription_path, 'ack_id': ack_id}
+			logging.debug("Received message: " + str(received_message))
+			message = Message_GCP()
+			message.create_from_received_message(received_message)
+			message.topic = topic
+			self.unpack(message)
+			messages.append(message)
+
+		return messages
+
+	def ack(self, message):
+		# response[].received_messages
+		# received_message.ackID
+		# received_message.message
+		# message.data: string
+		# message.attributes { string: string }
+		# message.messageID: string
+		# message.publishTime: string
+
+		# Acknowledges the received messages so they will not be sent again.
+		# the claim check is only released once the ack went through.  if it fails the message is delivered again
+		# and still needs its body
+		try:  # if came from a received message, should have ack() method on it.
+			message.received_message.ack()  # Python PubsubMessage has a method to ack itself
+			logging.debug('Acknowledged using built in ack method: ' + str(message))
+			self.release(message)
+			return
+		except Exception:  # try try again
+			logging.debug('no ack method on received_message')
+
+		message_id = message.received_message.message.message_id
+		r_ack_id = message.received_message.ack_id
+		subs = self.ack_paths[message_id]
+		subscription_path = subs['path']
+		ack_id = subs['ack_id']
+		ack_ids = [ack_id]
+		logging.debug('subscription path to ack: ' + str(subscription_path))
+		logging.debug('received message ack_id: ' + str(r_ack_id))
+		logging.debug('going to ack message_id: ' + str(message_id) + ' ack_id: ' + str(ack_id))
+		self.subscriber.acknowledge(
+			request={"subscription": subscription_path, "ack_ids": ack_ids})
+		logging.debug('Acknowledged using explicit acknowledge: ' + str(message))
+		self.release(message)
+
+	def get_claim_check_location(self):
+		# spawners on other vms have to be able to fetch the body
+		return WorkSpawnerConfig.CLAIM_CHECK_BUCKET_PATH
+
+	def keep_alive(self, message, deadline=None):
+		# look up subscription
+		# see how long the timeout is
+		# add to rcvd time
+		# if close, reset the ack timeout
+		# https://cloud.google.com/pubsub/docs/pull
+
+		message_id = message.received_message.message.message_id
+		subs = self.ack_paths[message_id]
+		subscription_path = subs['path']
+		ack_id = subs['ack_id']
+
+		if deadline is None:
+			deadline = WorkSpawnerConfig.LEASE_SECONDS
+
+		# ack_deadline_seconds must be between 10 to 600.
+		self.subscriber.modify_ack_deadline(
+			request={"subscription": subscription_path, "ack_ids": [ack_id],
+					"ack_deadline_seconds": max(10, min(600, int(deadline)))})
+
+		logging.debug('Reset ack deadline for: ' + str(message))
+
+	def log_failed_work(self, message):
+		# TODO: look up the failed work topic with tr.get_failed_work_topic()
+		logging.error('Work failed for message: ' + str(message))
+		self.publish(WorkSpawnerConfig.failed_work_topic_name, message)
+
+	def nack(self, message, delay=0):
+		message_id = message.received_message.message.message_id
+		subs = self.ack_paths[message_id]
+
+		# a deadline of 0 makes the message available for redelivery right away.  max is 600
+		delay = int(min(max(delay, 0), 600))
+		self.subscriber.modify_ack_deadline(
+			request={"subscription": subs['path'], "ack_ids": [subs['ack_id']], "ack_deadline_seconds": delay})
+
+		logging.debug('Handed back: ' + str(message) + ' for ' + str(delay) + ' seconds')
+
+	def get_backlog(self, topic):
+		# pub/sub doesn't report backlogs itself, they come from the cloud monitoring metrics of the subscription
+		# which are sampled every minute.  google-cloud-monitoring is only needed by the monitor, so import it here
+		try:
+			from google.cloud import monitoring_v3
+		except ImportError:
+			logging.error('google-cloud-monitoring must be installed to read topic backlogs')
+			return None
+
+		if self.monitoring is None:
+			self.monitoring = monitoring_v3.MetricServiceClient()
+
+		now = int(time.time())
+		interval = monitoring_v3.TimeInterval({'end_time': {'seconds': now}, 'start_time': {'seconds': now - 300}})
+		metric_filter = ('metric.type = "pubsub.googleapis.com/subscription/num_undelivered_messages" AND '
+						'resource.labels.subscription_id = "' + topic + '"')
+
+		try:
+			results = self.monitoring.list_time_series(request={
+				'name': 'projects/' + self.project_id,
+				'filter': metric_filter,
+				'interval': interval,
+				'view': monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL})
+
+			for series in results:
+				if series.points:
+					return int(series.points[0].value.int64_value)  # points are newest first
+		except Exception as error:
+			logging.error('could not read backlog for: ' + topic + ' ' + str(error))
+			return None
+
+		return 0  # no samples means nothing has been undelivered for the last few minutes
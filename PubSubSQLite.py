@@ -0,0 +1,225 @@
+#
+# SQLite implementation of the PubSub interface for running on a single host without Pub/Sub
+#
+# Topics fan out to subscriptions like Pub/Sub.  Every message on a subscription is a row with a visible_at
+# time: a pull leases the oldest visible rows by moving visible_at out by the ack deadline, an ack deletes the row
+# and a nack or keep_alive moves visible_at.  The database is in WAL mode and every change is a single statement,
+# so several spawners and a prioritizer on the host can share it.  SQLite before 3.35 has no UPDATE ... RETURNING,
+# there a pull selects and leases its rows in one BEGIN IMMEDIATE transaction instead.
+#
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+# WorkSpawner specific
+import WorkSpawnerConfig
+from PubSub import Message, PubSub
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# UPDATE ... RETURNING is new in SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class Message_SQLite(Message):
+	"""
+	SQLite specific version of Message
+	"""
+	def __init__(self, body='', attributes=None):
+		super().__init__(body, attributes)
+		self.row_id = None  # row of the message on its subscription, None until pulled
+
+
+class PubSub_SQLite(PubSub):
+
+	def __init__(self, db_file=None, clock=time.time):
+		"""
+		:param db_file: sqlite file shared by every process on the host.  defaults to WorkSpawnerConfig.SQLITE_QUEUE_FILE
+		:param clock: function that returns the current time in seconds
+		"""
+		if db_file is None:
+			db_file = WorkSpawnerConfig.SQLITE_QUEUE_FILE
+
+		self.clock = clock
+		self.subscriptions = {}  # topic: list of its subscriptions
+		self.ack_deadlines = {}  # subscription: seconds a pull leases a message for
+
+		db_dir = os.path.dirname(db_file)
+		if db_dir:
+			os.makedirs(db_dir, exist_ok=True)
+
+		# autocommit, every change is its own transaction.  the timeout waits for other processes holding the lock
+		self.db = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS topics (name TEXT PRIMARY KEY)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS subscriptions ('
+						'name TEXT PRIMARY KEY, topic TEXT NOT NULL, ack_deadline REAL NOT NULL)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS messages ('
+						'id INTEGER PRIMARY KEY AUTOINCREMENT, subscription TEXT NOT NULL, message_id TEXT NOT NULL, '
+						'body TEXT NOT NULL, attributes TEXT NOT NULL, published REAL NOT NULL, '
+						'visible_at REAL NOT NULL, delivery_attempt INTEGER NOT NULL DEFAULT 0)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS messages_visible ON messages (subscription, visible_at)')
+
+	def create_topic(self, topic):
+		self.db.execute('INSERT OR IGNORE INTO topics (name) VALUES (?)', (topic,))
+
+	def create_subscription(self, subscription, topic, ack_deadline=None):
+		"""
+		messages published on the topic after this are delivered to the subscription
+		:param subscription: name of the subscription
+		:param topic: topic it subscribes to
+		:param ack_deadline: seconds a pull leases a message for.  defaults to WorkSpawnerConfig.LEASE_SECONDS
+		:return: None
+		"""
+		if ack_deadline is None:
+			ack_deadline = WorkSpawnerConfig.LEASE_SECONDS
+		self.create_topic(topic)
+		self.db.execute('INSERT OR IGNORE INTO subscriptions (name, topic, ack_deadline) VALUES (?, ?, ?)',
+						(subscription, topic, ack_deadline))
+		self.subscriptions.pop(topic, None)
+
+	def _get_subscriptions(self, topic):
+		"""
+		private method only used by SQLite
+		:param topic: short name of the topic
+		:return: list of the subscriptions of the topic.  like GCP, a subscription with the same name as the topic
+				is assumed, so one is created if the topic has none
+		"""
+		try:
+			return self.subscriptions[topic]
+		except KeyError:
+			pass
+
+		rows = self.db.execute('SELECT name FROM subscriptions WHERE topic = ?', (topic,)).fetchall()
+		if not rows:
+			self.create_subscription(topic, topic)
+			rows = [(topic,)]
+
+		self.subscriptions[topic] = [row[0] for row in rows]
+		return self.subscriptions[topic]
+
+	def _get_ack_deadline(self, subscription):
+		try:
+			return self.ack_deadlines[subscription]
+		except KeyError:
+			pass
+
+		row = self.db.execute('SELECT ack_deadline FROM subscriptions WHERE name = ?', (subscription,)).fetchone()
+		self.ack_deadlines[subscription] = row[0] if row is not None else WorkSpawnerConfig.LEASE_SECONDS
+		return self.ack_deadlines[subscription]
+
+	def publish(self, topic, message):
+		"""
+		:param topic: short topic name to publish message
+		:param message: message to publish
+		:return: True if successful
+		"""
+		subscriptions = self._get_subscriptions(topic)
+		body, attributes = self.pack(message, len(subscriptions))  # each subscription acks its copy
+		if isinstance(body, bytearray):
+			body = bytes(body)  # stored as a blob, strings are stored as text
+		attributes = json.dumps({key: str(value) for key, value in attributes.items()})
+		message_id = str(uuid.uuid4())
+		now = self.clock()
+
+		self.db.executemany(
+			'INSERT INTO messages (subscription, message_id, body, attributes, published, visible_at) '
+			'VALUES (?, ?, ?, ?, ?, ?)',
+			[(subscription, message_id, body, attributes, now, now) for subscription in subscriptions])
+
+		logging.debug('Queuing-> ' + str(message) + ' to topic: ' + str(topic))
+		return True
+
+	def pull(self, topic, max_message_count=1):
+		"""
+		lease up to max_message_count of the oldest visible messages in one statement, so two processes never
+		pull the same message
+		:param topic: short topic name, the subscription with the same name is pulled from
+		:param max_message_count: number of messages to pull if available, will pull up to max
+		:return: list of messages pulled, empty if none available
+		"""
+		self._get_subscriptions(topic)  # makes sure the subscription exists
+		now = self.clock()
+		deadline = self._get_ack_deadline(topic)
+
+		if HAS_RETURNING:
+			rows = self.db.execute(
+				'UPDATE messages SET visible_at = ?, delivery_attempt = delivery_attempt + 1 '
+				'WHERE id IN (SELECT id FROM messages WHERE subscription = ? AND visible_at <= ? '
+				'ORDER BY visible_at, id LIMIT ?) '
+				'RETURNING id, message_id, body, attributes, delivery_attempt',
+				(now + deadline, topic, now, max_message_count)).fetchall()
+		else:
+			rows = self._lease_rows(topic, now, deadline, max_message_count)
+
+		messages = []
+		for row_id, message_id, body, attributes, delivery_attempt in sorted(rows):  # oldest first
+			message = Message_SQLite(body, json.loads(attributes))
+			message.row_id = row_id
+			message.message_id = message_id
+			message.delivery_attempt = delivery_attempt
+			message.topic = topic
+			self.unpack(message)
+			messages.append(message)
+			logging.debug('DeQueuing-> ' + str(message) + ' from topic: ' + str(topic))
+
+		return messages
+
+	def _lease_rows(self, topic, now, deadline, max_message_count):
+		"""
+		private method only used by SQLite.  pull for SQLite without RETURNING: the write lock is taken before the
+		rows are selected, so no other process can lease them in between
+		:return: list of (id, message_id, body, attributes, delivery_attempt) of the leased messages
+		"""
+		self.db.execute('BEGIN IMMEDIATE')
+		try:
+			rows = self.db.execute(
+				'SELECT id, message_id, body, attributes, delivery_attempt + 1 FROM messages '
+				'WHERE subscription = ? AND visible_at <= ? ORDER BY visible_at, id LIMIT ?',
+				(topic, now, max_message_count)).fetchall()
+			self.db.executemany('UPDATE messages SET visible_at = ?, delivery_attempt = ? WHERE id = ?',
+								[(now + deadline, row[4], row[0]) for row in rows])
+			self.db.execute('COMMIT')
+		except sqlite3.Error:
+			self.db.execute('ROLLBACK')
+			raise
+		return rows
+
+	# the delivery_attempt is the lease: once a message is pulled again, acks and extensions of the old lease are
+	# ignored like they are for an expired ack id on pub/sub
+
+	def ack(self, message):
+		message.ack()
+		cursor = self.db.execute('DELETE FROM messages WHERE id = ? AND delivery_attempt = ?',
+								(message.row_id, message.delivery_attempt))
+		if cursor.rowcount:  # an ack of an expired lease is ignored, the message is still on the queue
+			self.release(message)
+
+	def keep_alive(self, message, deadline=None):
+		if deadline is None:
+			deadline = WorkSpawnerConfig.LEASE_SECONDS
+		self.db.execute('UPDATE messages SET visible_at = ? WHERE id = ? AND delivery_attempt = ?',
+						(self.clock() + deadline, message.row_id, message.delivery_attempt))
+		logging.debug('Reset ack deadline for: ' + str(message))
+
+	def nack(self, message, delay=0):
+		self.db.execute('UPDATE messages SET visible_at = ? WHERE id = ? AND delivery_attempt = ?',
+						(self.clock() + max(delay, 0), message.row_id, message.delivery_attempt))
+		logging.debug('Handed back: ' + str(message) + ' for ' + str(delay) + ' seconds')
+
+	def get_backlog(self, topic):
+		row = self.db.execute('SELECT COUNT(*) FROM messages WHERE subscription = ?', (topic,)).fetchone()
+		return row[0]
+
+	def log_failed_work(self, message):
+		logging.error('Work failed for message: ' + str(message))
+		self.publish(WorkSpawnerConfig.failed_work_topic_name, message)
+
+	def close(self):
+		self.db.close()
@@ -0,0 +1,141 @@
+#
+# Reordering of the work in a topic by its exact score
+#
+# A topic covers a whole range of scores, e.g., priority-3 is [3, 10), so its work is served first in first out no
+# matter the score.  The prioritizer stamps the exact score on each message in the score attribute.  With
+# REORDER_WINDOW over 1 the spawner pulls a window of messages from a topic and runs the best scored one first.
+# What it doesn't run yet is either handed back right away (nack), or held on extended leases for the next pull
+# from the topic (lease), but never for more than REORDER_MAX_HOLD seconds so other spawners can pick it up.
+#
+import logging
+import time
+
+import WorkSpawnerConfig
+import LeaseKeeper
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# what happens to the messages that weren't picked
+HOLD_NACK = 'nack'
+HOLD_LEASE = 'lease'
+
+
+def get_score(message):
+	"""
+	:param message: message pulled from a work topic
+	:return: the score the prioritizer stamped on it, None if it doesn't have one
+	"""
+	try:
+		return float(message.attributes[WorkSpawnerConfig.SCORE_ATTRIBUTE])
+	except (KeyError, TypeError, ValueError):
+		return None
+
+
+class ReorderWindow:
+	"""
+	Window of messages pulled from each topic, best score first
+	"""
+
+	def __init__(self, queue, window=None, hold=None, max_hold=None, lowest_first=None, clock=time.time):
+		"""
+		:param queue: PubSub instance the messages are pulled from
+		:param window: messages pulled and ordered at once.  defaults to WorkSpawnerConfig.REORDER_WINDOW
+		:param hold: HOLD_NACK or HOLD_LEASE.  defaults to WorkSpawnerConfig.REORDER_HOLD
+		:param max_hold: max seconds a message is held before it is handed back.
+				defaults to WorkSpawnerConfig.REORDER_MAX_HOLD
+		:param lowest_first: True if lower scores are better.  defaults to WorkSpawnerConfig.REORDER_LOWEST_FIRST
+		:param clock: function that returns the current time in seconds
+		"""
+		self.queue = queue
+		self.window = window if window is not None else WorkSpawnerConfig.REORDER_WINDOW
+		self.hold = hold if hold is not None else WorkSpawnerConfig.REORDER_HOLD
+		self.max_hold = max_hold if max_hold is not None else WorkSpawnerConfig.REORDER_MAX_HOLD
+		self.lowest_first = lowest_first if lowest_first is not None else WorkSpawnerConfig.REORDER_LOWEST_FIRST
+		self.clock = clock
+		if self.hold not in (HOLD_NACK, HOLD_LEASE):
+			raise ValueError('unknown reorder hold: ' + str(self.hold))
+
+		self.held = {}  # topic: list of (message, time it was pulled) in the order they were pulled
+		self.leases = LeaseKeeper.LeaseKeeper(queue, clock=clock)
+
+	def get_sort_key(self, message):
+		"""
+		:return: key that sorts the best message first.  messages without a score go last
+		"""
+		score = get_score(message)
+		if score is None:
+			return 1, 0.0
+		return 0, score if self.lowest_first else -score
+
+	def pull(self, topic):
+		"""
+		top up the window of a topic and take the best message out of it
+		:param topic: short topic name
+		:return: list with the best message, empty if the topic has no work
+		"""
+		held = self.held.get(topic, [])
+		room = self.window - len(held)
+		if room > 0:
+			now = self.clock()
+			for message in self.queue.pull(topic, room) or []:
+				held.append((message, now))
+				if self.hold == HOLD_LEASE:
+					self.leases.add(message)
+		if not held:
+			return []
+
+		# sorted is stable, so messages with the same score stay first in first out
+		held.sort(key=lambda entry: self.get_sort_key(entry[0]))
+		best, pulled = held.pop(0)
+		self.leases.remove(best)
+		logging.debug('picked score: ' + str(get_score(best)) + ' out of ' + str(len(held) + 1) + ' messages on: ' +
+					topic)
+
+		if self.hold == HOLD_NACK:
+			for message, pulled in held:
+				self.queue.nack(message)
+			held = []
+		if held:
+			self.held[topic] = held
+		else:
+			self.held.pop(topic, None)
+		return [best]
+
+	def renew(self):
+		"""
+		renew the leases of held messages and hand back the ones held too long.  call regularly, also while work
+		is running
+		:return: None
+		"""
+		if not self.held:
+			return
+		now = self.clock()
+		for topic, held in list(self.held.items()):
+			kept = []
+			for message, pulled in held:
+				if now - pulled >= self.max_hold:
+					self.leases.remove(message)
+					self.queue.nack(message)
+				else:
+					kept.append((message, pulled))
+			if kept:
+				self.held[topic] = kept
+			else:
+				del self.held[topic]
+		self.leases.renew()
+
+	def hand_back(self):
+		"""
+		hand back every held message, e.g., when draining
+		:return: None
+		"""
+		for topic, held in self.held.items():
+			for message, pulled in held:
+				self.leases.remove(message)
+				self.queue.nack(message)
+		self.held = {}
+
+	def __len__(self):
+		return sum(len(held) for held in self.held.values())
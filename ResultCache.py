@@ -0,0 +1,176 @@
+#
+# Content addressed cache of job results for deterministic work
+#
+# When the same command is run in the same directory with the same input files, it produces the same output.
+# The cache key is a digest of all of those, and the value is a copy of the output directory of the work.
+#
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class ResultCache:
+	"""
+	Local result store with size based eviction of the least recently used results.
+	Each result is a directory named by its key that holds a copy of the output directory.
+	"""
+
+	output_sub_dir = 'output'
+	size_file = 'size'  # total bytes of the output, saves walking the tree when evicting
+
+	def __init__(self, cache_dir=None, max_bytes=None):
+		"""
+		:param cache_dir: directory to keep results in.  defaults to WorkSpawnerConfig.RESULT_CACHE_DIR
+		:param max_bytes: evict results once the cache is bigger than this
+		"""
+		if cache_dir is None:
+			cache_dir = WorkSpawnerConfig.RESULT_CACHE_DIR
+		if max_bytes is None:
+			max_bytes = WorkSpawnerConfig.RESULT_CACHE_MAX_BYTES
+
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	@staticmethod
+	def is_wanted(message):
+		"""
+		:param message: message pulled from a work topic
+		:return: False if the publisher opted the message out of memoization
+		"""
+		return not message.is_attribute_set(WorkSpawnerConfig.MEMOIZE_OPT_OUT_ATTRIBUTE)
+
+	@staticmethod
+	def _digest_file(filename, digest):
+		with open(filename, 'rb') as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b''):
+				digest.update(chunk)
+
+	@staticmethod
+	def get_key(cmd, cwd, inputs, base_dir=None):
+		"""
+		:param cmd: resolved command that will be run, as passed to Popen
+		:param cwd: directory the command will be run in
+		:param inputs: list of input files or directories the work reads
+		:param base_dir: directory cwd and the inputs are named relative to, e.g., the workspace of the job, whose
+				path is different for every job.  None to use them as they are
+		:return: hex digest that identifies the result of the work
+		"""
+		def get_name(path):
+			if base_dir is None or path is None:
+				return path
+			return os.path.relpath(path, base_dir)
+
+		digest = hashlib.sha256()
+		digest.update(json.dumps({'cmd': [str(arg) for arg in cmd], 'cwd': get_name(cwd)}).encode('utf-8'))
+
+		for path in sorted(inputs):
+			digest.update(b'\0input\0' + get_name(path).encode('utf-8'))
+			if os.path.isdir(path):
+				for root, dirs, files in os.walk(path):
+					dirs.sort()  # walk in a stable order so the key doesn't depend on the file system
+					for name in sorted(files):
+						filename = os.path.join(root, name)
+						digest.update(b'\0file\0' + os.path.relpath(filename, path).encode('utf-8') + b'\0')
+						ResultCache._digest_file(filename, digest)
+			elif os.path.isfile(path):
+				ResultCache._digest_file(path, digest)
+			else:
+				digest.update(b'\0missing\0')
+
+		return digest.hexdigest()
+
+	def _entry_dir(self, key):
+		return os.path.join(self.cache_dir, key)
+
+	def restore(self, key, output_dir):
+		"""
+		copy a cached result into the output directory
+		:param key: key from get_key()
+		:param output_dir: directory the work would have written its output to
+		:return: True if there was a cached result, False otherwise
+		"""
+		entry_dir = self._entry_dir(key)
+		cached_output = os.path.join(entry_dir, self.output_sub_dir)
+		if not os.path.isdir(cached_output):
+			return False
+
+		shutil.copytree(cached_output, output_dir, dirs_exist_ok=True)
+		os.utime(entry_dir)  # mark as recently used for eviction
+		logging.info('restored cached result: ' + key + ' to: ' + output_dir)
+		return True
+
+	def store(self, key, output_dir):
+		"""
+		copy the output of successful work into the cache
+		:param key: key from get_key()
+		:param output_dir: directory the work wrote its output to
+		:return: True if stored, False otherwise
+		"""
+		if not os.path.isdir(output_dir):
+			logging.error('no output to cache in: ' + output_dir)
+			return False
+
+		entry_dir = self._entry_dir(key)
+		if os.path.isdir(entry_dir):
+			return True  # already cached
+
+		# copy to a temporary name and rename it so a half written result is never restored
+		tmp_dir = os.path.join(self.cache_dir, '.tmp-' + uuid.uuid4().hex)
+		try:
+			shutil.copytree(output_dir, os.path.join(tmp_dir, self.output_sub_dir))
+			size = 0
+			for root, dirs, files in os.walk(tmp_dir):
+				for name in files:
+					size += os.path.getsize(os.path.join(root, name))
+			with open(os.path.join(tmp_dir, self.size_file), 'w') as f:
+				f.write(str(size))
+			os.rename(tmp_dir, entry_dir)
+		except OSError as error:
+			logging.error('could not cache result: ' + key + ' ' + str(error))
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+			return False
+
+		logging.info('cached result: ' + key + ' size: ' + str(size))
+		self.evict()
+		return True
+
+	def evict(self):
+		"""
+		remove the least recently used results until the cache fits in max_bytes
+		:return: None
+		"""
+		entries = []
+		total = 0
+		for name in os.listdir(self.cache_dir):
+			entry_dir = self._entry_dir(name)
+			if name.startswith('.tmp-'):
+				# left behind by a crash while storing
+				if time.time() - os.path.getmtime(entry_dir) > 24 * 3600:
+					shutil.rmtree(entry_dir, ignore_errors=True)
+				continue
+			try:
+				with open(os.path.join(entry_dir, self.size_file)) as f:
+					size = int(f.read())
+				entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+				total += size
+			except (OSError, ValueError):
+				continue
+
+		entries.sort()  # oldest first
+		for last_used, size, entry_dir in entries:
+			if total <= self.max_bytes:
+				break
+			logging.info('evicting cached result: ' + entry_dir)
+			shutil.rmtree(entry_dir, ignore_errors=True)
+			total -= size
@@ -0,0 +1,182 @@
+#
+# Retry policy for work that failed in the work spawner
+#
+# Failures are classified as transient (e.g., a gsutil hiccup in pre_process) or permanent (e.g., the work timed out).
+# Transient failures are handed back to the queue with an exponential backoff until the work has been attempted
+# max_attempts times.  Permanent failures, and work that ran out of attempts, are dead lettered to the failed work
+# topic with the history of its errors attached.
+#
+import collections
+import datetime
+import logging
+import random
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class RetryPolicy:
+
+	# stages of the work a failure can happen in
+	PRE_PROCESS = 'pre_process'
+	SPAWN = 'spawn'  # the work could not be started
+	EXIT_CODE = 'exit_code'  # the work returned a non zero exit code
+	TIMEOUT = 'timeout'
+	POST_PROCESS = 'post_process'
+	BATCH = 'batch'  # the sub-tasks of a batch message could not be read
+
+	# what to do with a failure
+	TRANSIENT = 'transient'
+	PERMANENT = 'permanent'
+
+	# how transient failures are handed back
+	NACK = 'nack'  # modify the ack deadline to the backoff.  the backoff is capped at the 600 second max deadline
+	REPUBLISH = 'republish'  # publish a copy with attempt and retry_after attributes and ack the original
+
+	# attributes used to track retries on republished messages
+	attempt_attribute = 'attempt'
+	retry_after_attribute = 'retry_after'
+
+	max_history = 10000  # number of messages to remember attempts and errors for in nack mode
+
+	def __init__(self, mode=None, max_attempts=None, backoff_base=None, backoff_max=None,
+				clock=time.time, rng=None):
+		"""
+		:param mode: NACK or REPUBLISH.  defaults to WorkSpawnerConfig.RETRY_MODE
+		:param max_attempts: number of times work is attempted before it is dead lettered
+		:param backoff_base: seconds to wait before the first retry.  doubles with every attempt
+		:param backoff_max: longest wait between retries
+		:param clock: function that returns the current time in seconds.  the simulator passes a virtual clock
+		:param rng: random.Random used for jitter
+		"""
+		self.mode = mode if mode is not None else WorkSpawnerConfig.RETRY_MODE
+		self.max_attempts = max_attempts if max_attempts is not None else WorkSpawnerConfig.RETRY_MAX_ATTEMPTS
+		self.backoff_base = backoff_base if backoff_base is not None else WorkSpawnerConfig.RETRY_BACKOFF_BASE
+		self.backoff_max = backoff_max if backoff_max is not None else WorkSpawnerConfig.RETRY_BACKOFF_MAX
+		self.clock = clock
+		self.rng = rng if rng is not None else random.Random()
+
+		# the queue redelivers the original message in nack mode, so attempts and errors are remembered here
+		self.history = collections.OrderedDict()  # message key: list of (datetime, error), most recent last
+
+		if self.mode not in (self.NACK, self.REPUBLISH):
+			logging.error('unknown retry mode: ' + str(self.mode) + ', using: ' + self.NACK)
+			self.mode = self.NACK
+
+	def classify(self, stage, exitcode=None):
+		"""
+		:param stage: stage of the work the failure happened in
+		:param exitcode: exit code of the work for EXIT_CODE failures
+		:return: TRANSIENT if the work should be retried, PERMANENT otherwise
+		"""
+		if stage == self.EXIT_CODE:
+			if exitcode in WorkSpawnerConfig.RETRY_TRANSIENT_EXIT_CODES:
+				return self.TRANSIENT
+			return self.PERMANENT
+
+		if stage in WorkSpawnerConfig.RETRY_TRANSIENT_STAGES:
+			return self.TRANSIENT
+		return self.PERMANENT
+
+	def get_attempt(self, message):
+		"""
+		:param message: message being processed
+		:return: which attempt at the work this delivery is, starting at 1
+		"""
+		attempt = 1
+
+		# the queue's delivery_attempt is not used: it also counts the hand-backs of messages a reorder window
+		# pulled but didn't run, and the deliveries of work that was handed back on a drain
+		try:
+			attempt = max(attempt, int(message.attributes.get(self.attempt_attribute, 1)))
+		except ValueError:
+			pass
+
+		errors = self.history.get(message.get_work_key())
+		if errors:
+			attempt = max(attempt, len(errors) + 1)
+
+		return attempt
+
+	def get_backoff(self, attempt):
+		"""
+		:param attempt: the attempt that failed, starting at 1
+		:return: seconds to wait before the next attempt.  jittered so retries of a burst of failures spread out
+		"""
+		backoff = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+		return backoff * self.rng.uniform(0.8, 1.0)
+
+	def get_retry_delay(self, message):
+		"""
+		republished retries are not supposed to run until their retry_after time
+		:param message: message pulled from a work topic
+		:return: seconds until the message should be run, 0 if it can run now
+		"""
+		retry_after = message.attributes.get(self.retry_after_attribute)
+		if not retry_after:
+			return 0
+		try:
+			return max(float(retry_after) - self.clock(), 0)
+		except ValueError:
+			return 0
+
+	def _remember(self, message, error):
+		key = message.get_work_key()
+		errors = self.history.pop(key, [])
+		errors.append((datetime.datetime.now(), error))
+		self.history[key] = errors
+		while len(self.history) > self.max_history:
+			self.history.popitem(last=False)
+		return errors
+
+	def handle_failure(self, queue, message, stage, error, exitcode=None):
+		"""
+		hand the message back for another attempt, or dead letter it
+		:param queue: PubSub instance the message was pulled from
+		:param message: message whose work failed
+		:param stage: stage of the work the failure happened in
+		:param error: string describing what went wrong
+		:param exitcode: exit code of the work for EXIT_CODE failures
+		:return: True if the work will be retried, False if it was dead lettered.  either way the queue is done with it
+		"""
+		attempt = self.get_attempt(message)
+		error = 'attempt ' + str(attempt) + ' ' + stage + ': ' + str(error)
+		errors = self._remember(message, error)
+
+		classification = self.classify(stage, exitcode)
+		if classification == self.TRANSIENT and attempt < self.max_attempts:
+			backoff = self.get_backoff(attempt)
+			logging.info('retrying ' + str(message) + ' in ' + str(int(backoff)) + ' seconds after: ' + error)
+
+			if self.mode == self.REPUBLISH:
+				message.add_error_to_attributes(error)
+				message.attributes[self.attempt_attribute] = str(attempt + 1)
+				message.attributes[self.retry_after_attribute] = str(self.clock() + backoff)
+				queue.publish(message.topic, message)
+				queue.ack(message)  # the copy replaces it
+			else:
+				queue.nack(message, backoff)
+			return True
+
+		logging.error('dead lettering ' + str(message) + ' after ' + classification + ' failure: ' + error)
+		if self.mode == self.NACK:  # republished messages carry their earlier errors already
+			for when, previous_error in errors[:-1]:
+				message.add_error_to_attributes(previous_error, when)
+		message.add_error_to_attributes(error)
+		message.attributes[self.attempt_attribute] = str(attempt)
+		queue.log_failed_work(message)
+		queue.ack(message)  # ack so that it is pulled off the queue so it won't be processed again
+		self.history.pop(message.get_work_key(), None)
+		return False
+
+	def handle_success(self, message):
+		"""
+		forget the failures of work that finally succeeded
+		:param message: message whose work succeeded
+		:return: None
+		"""
+		self.history.pop(message.get_work_key(), None)
@@ -0,0 +1,183 @@
+#
+# Runtime profiles of work, used to pick a timeout and a lease length for each job
+#
+# A single WAIT_TIMEOUT lets a short job that hangs hold the spawner for an hour, and a fixed lease means long
+# jobs renew it far more often than needed.  The spawner records how long work takes, keyed by the command or
+# docker image and by the topic it came from, and derives both from the recent durations of similar work.
+# Work that timed out didn't finish, so how long it ran is not a duration of the work.  Timeouts are only counted,
+# otherwise every hang would raise the p99 and with it the next timeout.  A learned timeout also only grows to
+# RUNTIME_TIMEOUT_GROWTH times the last one given out, starting from WAIT_TIMEOUT.  Work that keeps timing out
+# may just have got slower, so each timeout in a row raises the next one by that factor, up to RUNTIME_TIMEOUT_MAX.
+# Timeouts are only learned from the command or docker image; the topic mixes too many kinds of work for that,
+# so it is only used for the lease.
+#
+import collections
+import json
+import logging
+import math
+import os
+import sqlite3
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class RuntimeProfile:
+	"""
+	Moving average and a window of the most recent durations of one kind of work
+	"""
+
+	def __init__(self, count=0, ewma=None, samples=None, window=None):
+		"""
+		:param count: number of durations ever recorded
+		:param ewma: exponentially weighted moving average of the durations, None if there are none
+		:param samples: most recent durations, oldest first
+		:param window: max number of durations kept.  defaults to WorkSpawnerConfig.RUNTIME_SAMPLES
+		"""
+		if window is None:
+			window = WorkSpawnerConfig.RUNTIME_SAMPLES
+		self.count = count
+		self.ewma = ewma
+		self.samples = collections.deque(samples or [], maxlen=window)
+		self.timeouts = 0  # runs that were stopped at their timeout since the spawner started
+		self.timeouts_in_row = 0  # runs stopped at their timeout since the last one that finished
+		self.last_timeout = None  # timeout last given out for this kind of work, None if none has been learned yet
+
+	def add(self, duration):
+		alpha = WorkSpawnerConfig.RUNTIME_ALPHA
+		if self.ewma is None:
+			self.ewma = duration
+		else:
+			self.ewma = alpha * duration + (1 - alpha) * self.ewma
+		self.samples.append(duration)
+		self.count += 1
+		self.timeouts_in_row = 0
+
+	def get_quantile(self, q):
+		"""
+		:param q: quantile between 0 and 1, e.g., 0.99
+		:return: the quantile of the recent durations, None if there are none
+		"""
+		if not self.samples:
+			return None
+		ordered = sorted(self.samples)
+		index = min(len(ordered) - 1, max(0, int(math.ceil(q * len(ordered))) - 1))
+		return ordered[index]
+
+
+class RuntimeStats:
+	"""
+	Runtime profiles keyed by command, docker image and topic, optionally persisted to an SQLite database
+	so they survive a restart
+	"""
+
+	def __init__(self, db_file=None):
+		"""
+		:param db_file: sqlite file to persist the profiles to, None to only keep them in memory
+		"""
+		self.profiles = {}  # key: RuntimeProfile
+
+		self.db = None
+		if db_file:
+			db_dir = os.path.dirname(db_file)
+			if db_dir:
+				os.makedirs(db_dir, exist_ok=True)
+			self.db = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS runtimes ('
+							'key TEXT PRIMARY KEY, count INTEGER NOT NULL, ewma REAL, samples TEXT NOT NULL)')
+			for key, count, ewma, samples in self.db.execute('SELECT key, count, ewma, samples FROM runtimes'):
+				self.profiles[key] = RuntimeProfile(count, ewma, json.loads(samples))
+			logging.info('loaded ' + str(len(self.profiles)) + ' runtime profiles')
+
+	@staticmethod
+	def get_keys(message, cmd):
+		"""
+		:param message: message being processed
+		:param cmd: command that will be spawned for the message
+		:return: keys of the profiles the work counts towards, most specific first
+		"""
+		keys = []
+		if 'docker_id' in message.attributes:
+			keys.append('docker:' + message.attributes['docker_id'])
+		elif cmd:
+			keys.append('cmd:' + ' '.join(str(arg) for arg in cmd))
+		if message.topic:
+			keys.append('topic:' + message.topic)
+		return keys
+
+	def get_profile(self, keys):
+		"""
+		:param keys: from get_keys()
+		:return: the most specific profile with enough durations to go by, None if there isn't one
+		"""
+		for key in keys:
+			profile = self.profiles.get(key)
+			if profile is not None and len(profile.samples) >= WorkSpawnerConfig.RUNTIME_MIN_SAMPLES:
+				return profile
+		return None
+
+	def record(self, keys, duration, timed_out=False):
+		"""
+		:param keys: from get_keys()
+		:param duration: seconds the work took
+		:param timed_out: True if the work was stopped at its timeout.  it is counted but not used as a duration
+		:return: None
+		"""
+		for key in keys:
+			profile = self.profiles.get(key)
+			if profile is None:
+				profile = self.profiles[key] = RuntimeProfile()
+			if timed_out:
+				profile.timeouts += 1
+				profile.timeouts_in_row += 1
+				logging.warning('work timed out after ' + str(int(duration)) + ' seconds, ' + str(profile.timeouts) +
+								' timeouts of: ' + key)
+				continue
+			profile.add(duration)
+
+			if self.db is not None:
+				self.db.execute('INSERT OR REPLACE INTO runtimes (key, count, ewma, samples) VALUES (?, ?, ?, ?)',
+								(key, profile.count, profile.ewma, json.dumps(list(profile.samples))))
+
+	def get_timeout(self, keys):
+		"""
+		:param keys: from get_keys()
+		:return: seconds to let the work run before it is stopped.  WAIT_TIMEOUT until the command or docker image
+				has a profile to go by
+		"""
+		profile = self.get_profile([key for key in keys if not key.startswith('topic:')])
+		if profile is None:
+			return WorkSpawnerConfig.WAIT_TIMEOUT
+
+		timeout = profile.get_quantile(WorkSpawnerConfig.RUNTIME_TIMEOUT_QUANTILE)
+		timeout *= WorkSpawnerConfig.RUNTIME_TIMEOUT_FACTOR
+		last_timeout = profile.last_timeout if profile.last_timeout is not None else WorkSpawnerConfig.WAIT_TIMEOUT
+		max_timeout = last_timeout * WorkSpawnerConfig.RUNTIME_TIMEOUT_GROWTH
+		if profile.timeouts_in_row:  # the durations so far are too short for the work as it is now
+			timeout = max_timeout
+		timeout = min(timeout, max_timeout)
+		timeout = max(WorkSpawnerConfig.RUNTIME_TIMEOUT_MIN, min(WorkSpawnerConfig.RUNTIME_TIMEOUT_MAX, timeout))
+		profile.last_timeout = timeout
+		return timeout
+
+	def get_lease(self, keys):
+		"""
+		long work gets a long lease so it is renewed less often.  the lease is also how long the message is stuck
+		if the spawner dies, so it is capped
+		:param keys: from get_keys()
+		:return: seconds each keep_alive should extend the lease by.  LEASE_SECONDS until there is a profile
+		"""
+		profile = self.get_profile(keys)
+		if profile is None:
+			return WorkSpawnerConfig.LEASE_SECONDS
+
+		return max(WorkSpawnerConfig.RUNTIME_LEASE_MIN, min(WorkSpawnerConfig.RUNTIME_LEASE_MAX, profile.ewma))
+
+	def close(self):
+		if self.db is not None:
+			self.db.close()
@@ -0,0 +1,199 @@
+#
+# Schedulers that decide which priority topic the work spawner pulls from next
+#
+import logging
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class Scheduler:
+	"""
+	Strict priority scheduler.  This is the base class for all schedulers and is the original behavior
+	of the work spawner: always try the highest priority topic first and only move down the list
+	when a topic has no work.
+
+	The work spawner uses a scheduler like this:
+		for topic in scheduler.get_topic_order():  # try topics in order until one has work
+			pull from topic, if empty call scheduler.topic_empty(topic)
+		when a job from a topic is finished call scheduler.work_done(topic, cost)
+	"""
+
+	def __init__(self, topics, weights=None, clock=time.time):
+		"""
+		:param topics: list of topics, highest priority first
+		:param weights: dict of topic to weight.  missing topics default to a weight of 1
+		:param clock: function that returns the current time in seconds.  the simulator passes a virtual clock
+		"""
+		self.topics = list(topics)
+		self.weights = {}
+		for topic in self.topics:
+			weight = 1.0
+			if weights and topic in weights:
+				weight = float(weights[topic])
+			if weight <= 0:
+				logging.error('weight for topic: ' + str(topic) + ' must be positive, using 1')
+				weight = 1.0
+			self.weights[topic] = weight
+		self.clock = clock
+
+	def get_topic_order(self):
+		"""
+		:return: list of topics in the order they should be checked for work
+		"""
+		return list(self.topics)
+
+	def topic_empty(self, topic):
+		"""
+		called when a topic was checked and there was no work on it
+		:param topic: topic that had no work
+		:return: None
+		"""
+		pass
+
+	def work_done(self, topic, cost):
+		"""
+		called when the work pulled from a topic is finished, whether it succeeded or not
+		:param topic: topic the work was pulled from
+		:param cost: seconds the work occupied the spawner
+		:return: None
+		"""
+		pass
+
+
+class DeficitRoundRobinScheduler(Scheduler):
+	"""
+	Weighted fair scheduler using deficit round robin.  Each round every topic is credited with
+	weight * quantum seconds of work.  Topics with credit are served highest priority first and are
+	charged the actual run time of each job once it finishes, so the share of spawner time each topic
+	gets is proportional to its weight.  A topic that overdraws its credit with a long job carries the
+	debt into the following rounds, but never more than one round's credit (weight * quantum), so work it
+	was given while nothing else was waiting can't starve it once the other topics are busy again.  When
+	no credited topic has work, topics without credit are tried so the spawner never idles while there
+	is work.
+	"""
+
+	def __init__(self, topics, weights=None, clock=time.time, quantum=None):
+		super().__init__(topics, weights, clock)
+		if quantum is None:
+			quantum = WorkSpawnerConfig.DRR_QUANTUM
+		self.quantum = float(quantum)
+		self.deficits = {topic: 0.0 for topic in self.topics}
+
+	def _new_round(self):
+		for topic in self.topics:
+			self.deficits[topic] += self.weights[topic] * self.quantum
+		logging.debug('new scheduling round, deficits: ' + str(self.deficits))
+
+	def get_topic_order(self):
+		if not any(self.deficits[topic] > 0 for topic in self.topics):
+			self._new_round()
+
+		credited = [topic for topic in self.topics if self.deficits[topic] > 0]
+		uncredited = [topic for topic in self.topics if self.deficits[topic] <= 0]
+		return credited + uncredited
+
+	def topic_empty(self, topic):
+		# an idle topic must not bank credit for later, but it keeps any debt it has run up
+		self.deficits[topic] = min(self.deficits[topic], 0.0)
+
+	def work_done(self, topic, cost):
+		self.deficits[topic] -= max(float(cost), 1.0)  # always charge something so free work can't starve others
+		# cap the debt at one round so a topic pays back at most a round's worth of service
+		self.deficits[topic] = max(self.deficits[topic], -self.weights[topic] * self.quantum)
+
+
+class AgingScheduler(Scheduler):
+	"""
+	Priority scheduler with aging.  Topics are checked in priority order, but every aging_interval
+	seconds a topic with waiting work goes unserved it is promoted one priority level (faster for
+	larger weights).  This bounds how long a low priority topic can wait while higher priority topics
+	still win whenever the waits are similar.
+	"""
+
+	def __init__(self, topics, weights=None, clock=time.time, aging_interval=None):
+		super().__init__(topics, weights, clock)
+		if aging_interval is None:
+			aging_interval = WorkSpawnerConfig.AGING_INTERVAL
+		self.aging_interval = float(aging_interval)
+		self.waiting_since = {topic: None for topic in self.topics}  # None if not known to have work waiting
+
+	def _effective_rank(self, topic, now):
+		rank = float(self.topics.index(topic))
+		since = self.waiting_since[topic]
+		if since is not None:
+			rank -= (now - since) * self.weights[topic] / self.aging_interval
+		return rank
+
+	def get_topic_order(self):
+		now = self.clock()
+		for topic in self.topics:  # assume every topic has work until it is checked and found empty
+			if self.waiting_since[topic] is None:
+				self.waiting_since[topic] = now
+
+		# sorted is stable so ties keep the configured priority order
+		return sorted(self.topics, key=lambda topic: self._effective_rank(topic, now))
+
+	def topic_empty(self, topic):
+		self.waiting_since[topic] = None
+
+	def work_done(self, topic, cost):
+		self.waiting_since[topic] = self.clock()  # the topic has been served, so its wait starts over
+
+
+# ---- Used to abstract the instantiation of the configured scheduler ----
+class SchedulerFactory:
+
+	schedulers = {
+		'strict': Scheduler,
+		'drr': DeficitRoundRobinScheduler,
+		'aging': AgingScheduler,
+	}
+
+	@staticmethod
+	def get_scheduler(topics, weights=None, mode=None, clock=time.time):
+		"""
+		:param topics: list of topics, highest priority first
+		:param weights: dict of topic to weight
+		:param mode: one of the keys in SchedulerFactory.schedulers.  defaults to WorkSpawnerConfig.SCHEDULER_MODE
+		:param clock: function that returns the current time in seconds
+		:return: a scheduler instance
+		"""
+		if mode is None:
+			mode = WorkSpawnerConfig.SCHEDULER_MODE
+
+		try:
+			scheduler_class = SchedulerFactory.schedulers[mode]
+		except KeyError:
+			logging.error('unknown scheduler mode: ' + str(mode) + ', using strict priority')
+			scheduler_class = Scheduler
+
+		logging.info('using scheduler: ' + scheduler_class.__name__ + ' with weights: ' + str(weights))
+		return scheduler_class(topics, weights, clock)
+
+
+# For testing code only
+if __name__ == "__main__":
+
+	# fairness after an idle period: only 'low' has work for a day of hour long jobs, then every topic
+	# has steady work.  'low' should be back to its share within a couple of rounds.
+	drr = DeficitRoundRobinScheduler(['high', 'medium', 'low'], {'high': 3, 'medium': 2, 'low': 1}, quantum=600)
+	for i in range(24):
+		order = drr.get_topic_order()
+		drr.topic_empty('high')
+		drr.topic_empty('medium')
+		drr.work_done('low', 3600)
+	print('deficits after the idle period: ' + str(drr.deficits))
+	assert drr.deficits['low'] >= -600
+
+	served = {topic: 0 for topic in drr.topics}
+	for i in range(60):
+		topic = drr.get_topic_order()[0]
+		served[topic] += 1
+		drr.work_done(topic, 600)
+	print('jobs served once busy: ' + str(served))
+	assert served['low'] >= 8
@@ -0,0 +1,263 @@
+#
+# Score ranges of the topics that follow the scores the prioritizer actually sees
+#
+# The low score and high score of each topic in the topic file are picked by hand, and when most of the work lands
+# in one topic priority scheduling has nothing to choose between.  The prioritizer keeps a quantile sketch of the
+# scores it publishes and every BIN_BALANCE_INTERVAL seconds works out the boundaries that would give each topic its
+# share in BIN_TARGET_SHARES.  In propose mode they are only logged and written to proposed.csv, in apply mode they
+# are written as the next version of the topic table in TOPIC_TABLE_DIR and used right away.  In apply mode
+# TopicReader loads the latest version, so a prioritizer started later bins with it too.
+#
+import csv
+import logging
+import math
+import os
+import random
+import time
+
+import WorkSpawnerConfig
+import TopicReader
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MODE_OFF = 'off'
+MODE_PROPOSE = 'propose'
+MODE_APPLY = 'apply'
+
+# name of the file the boundaries are written to in propose mode, in TOPIC_TABLE_DIR
+PROPOSAL_FILE = 'proposed.csv'
+
+
+class QuantileSketch:
+	"""
+	KLL style streaming quantile sketch.  Values are kept in levels of compactors, a value in level h stands for 2^h
+	values.  When a level fills up it is sorted and every other value is promoted to the next level, so memory stays
+	around 3k values however many are added, with a rank error of about 1.7 / k
+	"""
+
+	def __init__(self, k=None, rng=None):
+		"""
+		:param k: capacity of the top level.  defaults to WorkSpawnerConfig.BIN_SKETCH_K
+		:param rng: random.Random used to pick which half of a level is promoted
+		"""
+		self.k = k if k is not None else WorkSpawnerConfig.BIN_SKETCH_K
+		self.rng = rng if rng is not None else random.Random()
+		self.levels = [[]]
+		self.count = 0
+		self.min = None
+		self.max = None
+
+	def add(self, value):
+		self.levels[0].append(value)
+		self.count += 1
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+		self._compact()
+
+	def _get_capacity(self, level):
+		# lower levels are smaller, they hold values that stand for fewer of the values added
+		return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - level - 1))))
+
+	def _compact(self):
+		for level, values in enumerate(self.levels):
+			if len(values) < self._get_capacity(level):
+				continue
+			if level + 1 == len(self.levels):
+				self.levels.append([])
+			values.sort()
+			odd = values.pop() if len(values) % 2 else None  # pairs are compacted, an odd one out stays
+			self.levels[level + 1].extend(values[self.rng.randint(0, 1)::2])
+			self.levels[level] = [odd] if odd is not None else []
+
+	def get_weighted(self):
+		"""
+		:return: sorted list of (value, number of values it stands for)
+		"""
+		weighted = []
+		for level, values in enumerate(self.levels):
+			weighted.extend((value, 2 ** level) for value in values)
+		weighted.sort()
+		return weighted
+
+	def quantile(self, fraction):
+		"""
+		:param fraction: 0 to 1
+		:return: the smallest value that at least this fraction of the values are less than or equal to, None if
+				nothing was added
+		"""
+		weighted = self.get_weighted()
+		if not weighted:
+			return None
+		total = sum(weight for value, weight in weighted)
+		seen = 0
+		for value, weight in weighted:
+			seen += weight
+			if seen >= fraction * total:
+				return value
+		return weighted[-1][0]
+
+	def rank(self, value):
+		"""
+		:return: fraction of the values that are less than value
+		"""
+		weighted = self.get_weighted()
+		total = sum(weight for item, weight in weighted)
+		if not total:
+			return 0.0
+		return sum(weight for item, weight in weighted if item < value) / total
+
+	def __len__(self):
+		return self.count
+
+
+class BinBalancer:
+	"""
+	Tracks the scores being published and moves the score ranges of the topics so each gets its target share
+	"""
+
+	def __init__(self, tr, mode=None, shares=None, interval=None, min_samples=None, tolerance=None, table_dir=None,
+				clock=time.time):
+		"""
+		:param tr: TopicReader.Topics the prioritizer looks topics up in.  in apply mode its score ranges are replaced
+		:param mode: MODE_PROPOSE or MODE_APPLY.  defaults to WorkSpawnerConfig.BIN_BALANCE_MODE
+		:param shares: share of the work each topic should get, in the order of the topic file.
+				defaults to WorkSpawnerConfig.BIN_TARGET_SHARES
+		:param interval: seconds of scores each proposal is based on.  defaults to WorkSpawnerConfig.BIN_BALANCE_INTERVAL
+		:param min_samples: scores needed to propose anything.  defaults to WorkSpawnerConfig.BIN_MIN_SAMPLES
+		:param tolerance: the ranges only change when a topic's share is further than this from its target.
+				defaults to WorkSpawnerConfig.BIN_TOLERANCE
+		:param table_dir: directory the versioned topic tables are written to.
+				defaults to WorkSpawnerConfig.TOPIC_TABLE_DIR
+		:param clock: function that returns the current time in seconds
+		"""
+		self.tr = tr
+		self.mode = mode if mode is not None else WorkSpawnerConfig.BIN_BALANCE_MODE
+		shares = shares if shares is not None else WorkSpawnerConfig.BIN_TARGET_SHARES
+		self.interval = interval if interval is not None else WorkSpawnerConfig.BIN_BALANCE_INTERVAL
+		self.min_samples = min_samples if min_samples is not None else WorkSpawnerConfig.BIN_MIN_SAMPLES
+		self.tolerance = tolerance if tolerance is not None else WorkSpawnerConfig.BIN_TOLERANCE
+		self.table_dir = table_dir if table_dir is not None else WorkSpawnerConfig.TOPIC_TABLE_DIR
+		self.clock = clock
+		if self.mode not in (MODE_PROPOSE, MODE_APPLY):
+			raise ValueError('unknown bin balance mode: ' + str(self.mode))
+		if len(shares) != len(tr.rows):
+			raise ValueError('need a target share for each of the ' + str(len(tr.rows)) + ' topics, got: ' +
+							str(shares))
+		total = float(sum(shares))
+		self.shares = [share / total for share in shares]
+
+		self.sketch = QuantileSketch()
+		self.started = clock()
+
+	def add(self, score):
+		"""
+		record a score that was published and balance the topics once an interval has gone by
+		:param score: score from MyWork.prioritize
+		:return: None
+		"""
+		try:
+			self.sketch.add(float(score))
+		except (TypeError, ValueError):
+			return
+		if self.clock() - self.started >= self.interval and len(self.sketch) >= self.min_samples:
+			self.balance()
+			self.sketch = QuantileSketch(self.sketch.k, self.sketch.rng)  # the next proposal follows newer scores
+			self.started = self.clock()
+
+	def get_shares(self, ranges):
+		"""
+		:param ranges: list of (low score, high score) of each topic
+		:return: estimated share of the scores in the sketch that falls in each range
+		"""
+		return [self.sketch.rank(high) - self.sketch.rank(low) for low, high in ranges]
+
+	def get_current_ranges(self):
+		return [(float(row[self.tr.low_score_tag]), float(row[self.tr.high_score_tag])) for row in self.tr.rows]
+
+	def propose(self):
+		"""
+		:return: list of (low score, high score) of each topic that would give them their target shares.  the ranges
+				are contiguous and cover both the current ranges and every score seen
+		"""
+		current = self.get_current_ranges()
+		low = min(current[0][0], math.floor(self.sketch.min))
+		high = max(current[-1][1], math.floor(self.sketch.max) + 1)  # the high score is exclusive
+
+		edges = [low]
+		cumulative = 0.0
+		for share in self.shares[:-1]:
+			cumulative += share
+			boundary = float('%.6g' % self.sketch.quantile(cumulative))  # easier to read in the table and the log
+			edges.append(max(boundary, edges[-1]))
+		edges.append(high)
+		return [(edges[index], edges[index + 1]) for index in range(len(self.shares))]
+
+	def balance(self):
+		"""
+		propose new ranges, and in apply mode write them as the next version of the topic table and use them
+		:return: list of proposed (low score, high score), None if the topics are already within the tolerance
+		"""
+		topics = [row[self.tr.topic_uid_tag] for row in self.tr.rows]
+		current_shares = self.get_shares(self.get_current_ranges())
+		logging.info('share of ' + str(len(self.sketch)) + ' scores per topic: ' +
+					str(dict(zip(topics, [round(share, 3) for share in current_shares]))) + ' target: ' +
+					str(dict(zip(topics, [round(share, 3) for share in self.shares]))))
+		if max(abs(share - target) for share, target in zip(current_shares, self.shares)) <= self.tolerance:
+			logging.info('topic score ranges are balanced')
+			return None
+
+		ranges = self.propose()
+		for topic, (low, high), share in zip(topics, ranges, self.get_shares(ranges)):
+			if low == high:
+				logging.warning('too many equal scores to give topic: ' + topic + ' a range of its own')
+			logging.info('proposed range for topic: ' + topic + ' [' + str(low) + ', ' + str(high) + ') share: ' +
+						str(round(share, 3)))
+
+		if self.mode == MODE_APPLY:
+			filename = self.write_table(ranges, self.get_next_version())
+			self.tr.load_topic_table(filename)
+			self.prune()
+			logging.info('applied topic table version: ' + str(self.tr.version))
+		else:
+			self.write_table(ranges, None)
+		return ranges
+
+	def get_next_version(self):
+		latest = TopicReader.get_latest_table(self.table_dir)
+		return TopicReader.get_table_version(latest) + 1 if latest else 1
+
+	def write_table(self, ranges, version):
+		"""
+		:param ranges: list of (low score, high score) of each topic
+		:param version: version of the table, None to write the proposal file instead
+		:return: name of the file written
+		"""
+		os.makedirs(self.table_dir, exist_ok=True)
+		name = TopicReader.get_table_name(version) if version is not None else PROPOSAL_FILE
+		filename = os.path.join(self.table_dir, name)
+
+		fieldnames = [name for name in self.tr.fieldnames if name != self.tr.version_tag] + [self.tr.version_tag]
+		with open(filename + '.tmp', 'w', newline='') as csvfile:
+			writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+			writer.writeheader()
+			for row, (low, high) in zip(self.tr.rows, ranges):
+				row = dict(row)
+				row[self.tr.low_score_tag] = repr(low)
+				row[self.tr.high_score_tag] = repr(high)
+				row[self.tr.version_tag] = str(version) if version is not None else ''
+				writer.writerow(row)
+		os.replace(filename + '.tmp', filename)  # daemons starting up never see half a table
+		logging.info('wrote topic table: ' + filename)
+		return filename
+
+	def prune(self):
+		"""
+		delete all but the latest WorkSpawnerConfig.TOPIC_TABLE_KEEP versions of the topic table
+		:return: None
+		"""
+		versions = sorted(version for version in map(TopicReader.get_table_version, os.listdir(self.table_dir))
+						if version is not None)
+		for version in versions[:-WorkSpawnerConfig.TOPIC_TABLE_KEEP]:
+			os.remove(os.path.join(self.table_dir, TopicReader.get_table_name(version)))
@@ -0,0 +1,121 @@
+#
+# Cache of scores from MyWork.prioritize so the same work isn't scored again
+#
+# post_process publishes work to prioritize after every job and retries and re-submissions often have the same
+# body and attributes, so their score is looked up instead of being computed again.
+#
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class ScoreCache:
+	"""
+	LRU of scores with a time to live, optionally persisted to an SQLite database so it survives a restart
+	"""
+
+	def __init__(self, size=None, ttl=None, db_file=None, clock=time.time):
+		"""
+		:param size: max number of scores kept in memory.  defaults to WorkSpawnerConfig.SCORE_CACHE_SIZE
+		:param ttl: seconds a score is good for
+		:param db_file: sqlite file to persist scores to, None to only keep them in memory
+		:param clock: function that returns the current time in seconds
+		"""
+		self.size = size if size is not None else WorkSpawnerConfig.SCORE_CACHE_SIZE
+		self.ttl = ttl if ttl is not None else WorkSpawnerConfig.SCORE_CACHE_TTL
+		self.clock = clock
+		self.cache = collections.OrderedDict()  # key: (score, expires), most recently used last
+		self.hits = 0
+		self.misses = 0
+
+		self.db = None
+		if db_file:
+			db_dir = os.path.dirname(db_file)
+			if db_dir:
+				os.makedirs(db_dir, exist_ok=True)
+			self.db = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score TEXT NOT NULL, expires REAL NOT NULL)')
+			self.db.execute('DELETE FROM scores WHERE expires < ?', (self.clock(),))
+
+	@staticmethod
+	def get_key(message):
+		"""
+		:param message: message to prioritize
+		:return: digest of the body and attributes of the message
+		"""
+		body = message.body
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+
+		digest = hashlib.sha256()
+		digest.update(body)
+		digest.update(b'\0')
+		digest.update(json.dumps(message.attributes, sort_keys=True, default=str).encode('utf-8'))
+		return digest.hexdigest()
+
+	def get(self, message):
+		"""
+		:param message: message to prioritize
+		:return: the cached score, None if there isn't one
+		"""
+		key = self.get_key(message)
+		now = self.clock()
+
+		entry = self.cache.get(key)
+		if entry is None and self.db is not None:
+			row = self.db.execute('SELECT score, expires FROM scores WHERE key = ?', (key,)).fetchone()
+			if row is not None:
+				entry = (json.loads(row[0]), row[1])
+				self._cache(key, entry)
+
+		if entry is None or entry[1] < now:
+			self.misses += 1
+			return None
+
+		self.cache.move_to_end(key)
+		self.hits += 1
+		return entry[0]
+
+	def _cache(self, key, entry):
+		self.cache[key] = entry
+		self.cache.move_to_end(key)
+		while len(self.cache) > self.size:
+			self.cache.popitem(last=False)  # least recently used
+
+	def put(self, message, score):
+		"""
+		:param message: message that was prioritized
+		:param score: its score from MyWork.prioritize
+		:return: None
+		"""
+		key = self.get_key(message)
+		entry = (score, self.clock() + self.ttl)
+		self._cache(key, entry)
+
+		if self.db is not None:
+			self.db.execute('INSERT OR REPLACE INTO scores (key, score, expires) VALUES (?, ?, ?)',
+							(key, json.dumps(score), entry[1]))
+
+	def get_stats(self):
+		"""
+		:return: dict of hits, misses, hit rate and the number of scores in memory
+		"""
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / lookups if lookups else 0.0,
+			'size': len(self.cache),
+		}
@@ -0,0 +1,108 @@
+#
+# Scores work to prioritize in a pool of processes so CPU heavy MyWork.prioritize hooks use every core
+#
+import concurrent.futures
+import logging
+import os
+
+import WorkSpawnerConfig
+import LeaseKeeper
+from PubSub import Message
+
+#  This is the module that contains all of the domain specific work.
+import MyWork
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def score(body, attributes):
+	"""
+	runs in a worker process.  only the body and attributes are sent since the queue specific message can't be pickled
+	:param body: body of the message to prioritize
+	:param attributes: attributes of the message to prioritize
+	:return: score from MyWork.prioritize
+	"""
+	return MyWork.prioritize(Message(body, attributes))
+
+
+class ScoringPool:
+	"""
+	Bounded window of messages being scored by a ProcessPoolExecutor.  The leases of the messages are kept alive
+	until they are finished, so they can take longer to score than the ack deadline.
+	"""
+
+	def __init__(self, queue, workers=None, window=None):
+		"""
+		:param queue: PubSub instance the messages are pulled from
+		:param workers: number of scoring processes.  defaults to the number of cores
+		:param window: max number of messages being scored or waiting to be scored.  defaults to twice the workers
+		"""
+		if not workers:
+			workers = os.cpu_count() or 1
+		if not window:
+			window = 2 * workers
+
+		self.workers = workers
+		self.window = window
+		self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+		self.pending = {}  # future: message
+		self.leases = LeaseKeeper.LeaseKeeper(queue)
+		logging.info('scoring with ' + str(workers) + ' processes and a window of ' + str(window) + ' messages')
+
+	def get_room(self):
+		"""
+		:return: number of messages that can be submitted without going over the window
+		"""
+		return self.window - len(self.pending)
+
+	def submit(self, message):
+		"""
+		start scoring a message
+		:param message: message pulled from the prioritization topic
+		:return: None
+		"""
+		body = message.body  # fetched first if it is in a blob store, so a message that can't be fetched isn't leased
+		self.leases.add(message)
+		future = self.executor.submit(score, body, dict(message.attributes))
+		self.pending[future] = message
+
+	def get_finished(self, timeout):
+		"""
+		wait for messages to finish scoring and renew the leases of the others
+		:param timeout: max seconds to wait for at least one to finish
+		:return: list of (message, score, error).  error is None unless scoring raised an exception
+		"""
+		finished = []
+		if self.pending:
+			done, not_done = concurrent.futures.wait(
+				self.pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+
+			for future in done:
+				message = self.pending.pop(future)
+				self.leases.remove(message)
+				try:
+					finished.append((message, future.result(), None))
+				except Exception as error:
+					finished.append((message, None, error))
+
+		self.leases.renew()
+		return finished
+
+	def hand_back(self):
+		"""
+		hand back every message that hasn't finished scoring, e.g., on shutdown
+		:return: None
+		"""
+		for future, message in self.pending.items():
+			future.cancel()
+			self.leases.remove(message)
+			self.leases.queue.nack(message)
+		self.pending = {}
+
+	def shutdown(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+
+	def __len__(self):
+		return len(self.pending)
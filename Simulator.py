@@ -0,0 +1,430 @@
+#
+# Discrete event simulator of a group of spawners, used to tune slots, topic weights, timeouts and leases offline
+#
+# A trace of work arriving (when, its score or topic, how long it runs and its exit code) is replayed on a virtual
+# clock through the same pieces the daemons use: the PubSub in memory broker, TopicReader to route scores to
+# topics, the Scheduler of each spawner, the RetryPolicy and the RuntimeStats timeouts and leases.  The spawner
+# loop itself blocks on subprocesses, so it is mirrored here one event at a time.  Work is prioritized the moment
+# it arrives.  Days of traffic run in seconds, e.g.,
+#	$ python3 Simulator.py --synthetic --hours 48 --rate 400 --spawners 8 --scheduler drr
+#	$ python3 Simulator.py --trace trace.csv --spawners 8 --set RUNTIME_TIMEOUT_FACTOR=2 --json
+#
+import argparse
+import ast
+import csv
+import heapq
+import json
+import logging
+import math
+import random
+
+import WorkSpawnerConfig
+import PubSub
+import RetryPolicy
+import RuntimeStats
+import Scheduler
+import TopicReader
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# columns of a trace file.  topic is optional, work is routed by its score if it is empty
+TRACE_FIELDS = ['time', 'score', 'duration', 'exitcode', 'topic']
+
+# seconds an idle spawner sleeps before checking the topics again, the same as work_spawner()
+IDLE_SLEEP = 10
+
+
+class VirtualClock:
+	"""
+	Clock that only moves when the simulator moves it.  Passed as the clock of everything being simulated
+	"""
+
+	def __init__(self, start=0.0):
+		self.now = start
+
+	def __call__(self):
+		return self.now
+
+
+def load_trace(filename):
+	"""
+	:param filename: csv file with a header of TRACE_FIELDS.  time is seconds from the start of the trace
+	:return: list of work as dicts, in the order it arrives
+	"""
+	trace = []
+	with open(filename, newline='') as f:
+		for row in csv.DictReader(f):
+			trace.append({
+				'time': float(row['time']),
+				'score': float(row['score']) if row.get('score') else None,
+				'duration': float(row['duration']),
+				'exitcode': int(row['exitcode']) if row.get('exitcode') else 0,
+				'topic': row.get('topic') or None,
+			})
+	trace.sort(key=lambda work: work['time'])
+	return trace
+
+
+def write_trace(trace, filename):
+	with open(filename, 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=TRACE_FIELDS)
+		writer.writeheader()
+		for work in trace:
+			writer.writerow(work)
+
+
+def make_synthetic_trace(hours, rate, mean_duration=120, failure_rate=0.02, seed=0):
+	"""
+	:param hours: hours of traffic
+	:param rate: average number of messages arriving per hour, as a poisson process
+	:param mean_duration: average seconds work runs, exponentially distributed
+	:param failure_rate: fraction of the work that fails.  half of the failures are transient
+	:param seed: seed of the random numbers so a trace can be made again
+	:return: list of work as dicts, in the order it arrives
+	"""
+	rng = random.Random(seed)
+	trace = []
+	now = 0.0
+	while True:
+		now += rng.expovariate(rate / 3600.0)
+		if now > hours * 3600:
+			break
+
+		exitcode = 0
+		if rng.random() < failure_rate:
+			exitcode = rng.choice(WorkSpawnerConfig.RETRY_TRANSIENT_EXIT_CODES + [1])
+
+		trace.append({
+			'time': round(now, 3),
+			'score': round(rng.uniform(1, 10), 3),  # the range of MyWork.prioritize
+			'duration': round(max(1.0, rng.expovariate(1.0 / mean_duration)), 3),
+			'exitcode': exitcode,
+			'topic': None,
+		})
+	return trace
+
+
+def get_percentile(ordered, q):
+	if not ordered:
+		return None
+	return ordered[min(len(ordered) - 1, max(0, int(math.ceil(q * len(ordered))) - 1))]
+
+
+class SimulatedSpawner:
+
+	def __init__(self, index, scheduler):
+		self.index = index
+		self.scheduler = scheduler
+		self.message = None  # message being worked on, None when idle
+		self.busy_seconds = 0.0
+
+
+class Simulator:
+
+	# kinds of events
+	ARRIVAL = 'arrival'
+	WAKE = 'wake'  # a spawner looks for work
+	FINISH = 'finish'  # a spawner's work is done
+
+	def __init__(self, trace, spawners, scheduler_mode=None, weights=None, seed=0):
+		"""
+		:param trace: list of work from load_trace() or make_synthetic_trace()
+		:param spawners: number of spawners, i.e., the slots of the whole group of vms
+		:param scheduler_mode: one of Scheduler.SchedulerFactory.schedulers.  defaults to WorkSpawnerConfig.SCHEDULER_MODE
+		:param weights: dict of topic to weight.  defaults to the weights in the topic file
+		:param seed: seed of the retry jitter
+		"""
+		self.trace = trace
+		self.clock = VirtualClock()
+		self.queue = PubSub.PubSub(clock=self.clock)
+		self.tr = TopicReader.Topics()
+		self.topics = self.tr.get_topic_list()
+		if weights is None:
+			weights = self.tr.get_topic_weights()
+
+		self.retry_policy = None
+		if WorkSpawnerConfig.RETRY_ENABLED:
+			self.retry_policy = RetryPolicy.RetryPolicy(clock=self.clock, rng=random.Random(seed))
+
+		self.runtime_stats = None
+		if WorkSpawnerConfig.RUNTIME_STATS_ENABLED:
+			self.runtime_stats = RuntimeStats.RuntimeStats()
+
+		self.spawners = [SimulatedSpawner(index, Scheduler.SchedulerFactory.get_scheduler(
+			self.topics, weights, scheduler_mode, self.clock)) for index in range(spawners)]
+
+		self.events = []  # heap of (time, sequence, kind, data)
+		self.sequence = 0  # breaks ties so events at the same time run in the order they were added
+		self.arrivals_left = 0
+
+		self.latencies = {topic: [] for topic in self.topics}  # seconds from arrival to being acked
+		self.counts = {'arrived': 0, 'unroutable': 0, 'started': 0, 'completed': 0, 'dead_lettered': 0,
+						'retried': 0, 'timeouts': 0, 'lease_renewals': 0}
+
+	def add_event(self, when, kind, data=None):
+		heapq.heappush(self.events, (when, self.sequence, kind, data))
+		self.sequence += 1
+
+	def run(self, max_hours=None):
+		"""
+		replay the trace until all of the work is done
+		:param max_hours: stop after this many simulated hours even if work is left
+		:return: report from get_report()
+		"""
+		for index, work in enumerate(self.trace):
+			self.add_event(work['time'], self.ARRIVAL, (index, work))
+		self.arrivals_left = len(self.trace)
+		for spawner in self.spawners:
+			self.add_event(0.0, self.WAKE, spawner)
+
+		end_time = max_hours * 3600 if max_hours else None
+		while self.events:
+			when, sequence, kind, data = heapq.heappop(self.events)
+			if end_time is not None and when > end_time:
+				break
+			self.clock.now = when
+
+			if kind == self.ARRIVAL:
+				self.arrive(*data)
+			elif kind == self.WAKE:
+				self.wake(data)
+			else:
+				self.finish(*data)
+
+		return self.get_report()
+
+	def arrive(self, index, work):
+		self.arrivals_left -= 1
+		self.counts['arrived'] += 1
+
+		topic = work['topic'] or self.tr.get_topic(work['score'])
+		if not topic:
+			self.counts['unroutable'] += 1
+			return
+
+		# what the work will do when it runs is carried in attributes, so retries republished by the policy keep it
+		self.queue.publish(topic, PubSub.Message(str(index), {
+			'sim_arrival': str(self.clock.now),
+			'sim_duration': str(work['duration']),
+			'sim_exitcode': str(work['exitcode']),
+		}))
+
+	def is_done(self):
+		if self.arrivals_left:
+			return False
+		if any(spawner.message is not None for spawner in self.spawners):
+			return False
+		return not any(self.queue.get_backlog(topic) for topic in self.topics)
+
+	def wake(self, spawner):
+		"""
+		one pass of the work_spawner() loop: pull from the topics in the order the scheduler picks and start the work
+		"""
+		message = None
+		for topic in spawner.scheduler.get_topic_order():
+			messages = self.queue.pull(topic, 1)
+			if messages:
+				message = messages[0]
+				break
+			spawner.scheduler.topic_empty(topic)
+
+		if message is None:
+			if not self.is_done():
+				self.add_event(self.clock.now + IDLE_SLEEP, self.WAKE, spawner)
+			return
+
+		# process_message(): republished retries wait for their backoff
+		if self.retry_policy is not None:
+			delay = self.retry_policy.get_retry_delay(message)
+			if delay > 0:
+				self.queue.nack(message, delay)
+				self.add_event(self.clock.now, self.WAKE, spawner)
+				return
+
+		# spawn_and_wait(): the timeout and lease come from how long work on the topic has taken
+		duration = float(message.attributes['sim_duration'])
+		exitcode = int(message.attributes['sim_exitcode'])
+		timeout = WorkSpawnerConfig.WAIT_TIMEOUT
+		lease = WorkSpawnerConfig.LEASE_SECONDS
+		keys = []
+		if self.runtime_stats is not None:
+			keys = self.runtime_stats.get_keys(message, None)
+			timeout = self.runtime_stats.get_timeout(keys)
+			lease = self.runtime_stats.get_lease(keys)
+
+		stage = None
+		if duration >= timeout:
+			duration = timeout
+			stage = RetryPolicy.RetryPolicy.TIMEOUT
+		elif exitcode:
+			stage = RetryPolicy.RetryPolicy.EXIT_CODE
+
+		# the lease is renewed half way through, for as long as the work runs
+		self.counts['lease_renewals'] += int(duration // (lease / 2))
+		self.queue.keep_alive(message, duration + lease)
+
+		spawner.message = message
+		self.counts['started'] += 1
+		self.add_event(self.clock.now + duration, self.FINISH, (spawner, message, topic, duration, stage, exitcode, keys))
+
+	def finish(self, spawner, message, topic, duration, stage, exitcode, keys):
+		spawner.message = None
+		spawner.busy_seconds += duration
+		spawner.scheduler.work_done(topic, duration)
+		if self.runtime_stats is not None:
+			self.runtime_stats.record(keys, duration, timed_out=stage == RetryPolicy.RetryPolicy.TIMEOUT)
+
+		if stage is None:
+			if self.retry_policy is not None:
+				self.retry_policy.handle_success(message)
+			self.queue.ack(message)
+			self.counts['completed'] += 1
+			self.latencies[topic].append(self.clock.now - float(message.attributes['sim_arrival']))
+		else:
+			if stage == RetryPolicy.RetryPolicy.TIMEOUT:
+				self.counts['timeouts'] += 1
+			error = stage + ' after ' + str(int(duration)) + ' seconds'
+			if self.retry_policy is not None and self.retry_policy.handle_failure(self.queue, message, stage, error,
+																				exitcode):
+				self.counts['retried'] += 1
+			else:
+				if self.retry_policy is None:
+					self.queue.ack(message)
+				self.counts['dead_lettered'] += 1
+
+		self.add_event(self.clock.now, self.WAKE, spawner)
+
+	def get_report(self):
+		"""
+		:return: dict of throughput, latency per tier and utilization of the spawners
+		"""
+		hours = self.clock.now / 3600.0
+		tiers = []
+		for topic in self.topics:
+			ordered = sorted(self.latencies[topic])
+			tiers.append({
+				'topic': topic,
+				'completed': len(ordered),
+				'latency_mean': sum(ordered) / len(ordered) if ordered else None,
+				'latency_p50': get_percentile(ordered, 0.5),
+				'latency_p95': get_percentile(ordered, 0.95),
+				'latency_p99': get_percentile(ordered, 0.99),
+				'latency_max': ordered[-1] if ordered else None,
+				'backlog_at_end': self.queue.get_backlog(topic),
+			})
+
+		busy = sum(spawner.busy_seconds for spawner in self.spawners)
+		report = {
+			'simulated_hours': hours,
+			'spawners': len(self.spawners),
+			'throughput_per_hour': self.counts['completed'] / hours if hours else 0.0,
+			'utilization': busy / (len(self.spawners) * self.clock.now) if self.clock.now else 0.0,
+			'tiers': tiers,
+		}
+		report.update(self.counts)
+		return report
+
+
+def format_report(report):
+	"""
+	:param report: from Simulator.get_report()
+	:return: the report as a table
+	"""
+	def seconds(value):
+		return '-' if value is None else str(int(round(value)))
+
+	lines = [
+		'simulated ' + str(round(report['simulated_hours'], 1)) + ' hours with ' + str(report['spawners']) +
+		' spawners: ' + str(report['completed']) + ' of ' + str(report['arrived']) + ' messages completed, ' +
+		str(round(report['throughput_per_hour'], 1)) + ' per hour, utilization ' +
+		str(round(100 * report['utilization'], 1)) + '%',
+		'retried ' + str(report['retried']) + ', dead lettered ' + str(report['dead_lettered']) + ', timeouts ' +
+		str(report['timeouts']) + ', unroutable ' + str(report['unroutable']) + ', lease renewals ' +
+		str(report['lease_renewals']),
+		'',
+		'topic'.ljust(16) + 'completed'.rjust(10) + 'mean s'.rjust(10) + 'p50 s'.rjust(10) + 'p95 s'.rjust(10) +
+		'p99 s'.rjust(10) + 'max s'.rjust(10) + 'backlog'.rjust(10),
+	]
+	for tier in report['tiers']:
+		lines.append(tier['topic'].ljust(16) + str(tier['completed']).rjust(10) +
+					seconds(tier['latency_mean']).rjust(10) + seconds(tier['latency_p50']).rjust(10) +
+					seconds(tier['latency_p95']).rjust(10) + seconds(tier['latency_p99']).rjust(10) +
+					seconds(tier['latency_max']).rjust(10) + str(tier['backlog_at_end']).rjust(10))
+	return '\n'.join(lines)
+
+
+def parse_setting(setting):
+	"""
+	:param setting: NAME=VALUE of a WorkSpawnerConfig setting.  the value is a python literal or a string
+	:return: (name, value)
+	"""
+	name, _, value = setting.partition('=')
+	if not hasattr(WorkSpawnerConfig, name):
+		raise argparse.ArgumentTypeError('unknown setting: ' + name)
+	try:
+		value = ast.literal_eval(value)
+	except (ValueError, SyntaxError):
+		pass  # a string
+	return name, value
+
+
+def parse_weights(weights):
+	"""
+	:param weights: comma separated topic=weight, e.g., priority-1=8,priority-2=2
+	:return: dict of topic to weight
+	"""
+	parsed = {}
+	for item in weights.split(','):
+		topic, _, weight = item.partition('=')
+		parsed[topic.strip()] = float(weight)
+	return parsed
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--trace", help="csv trace of work to replay, columns: " + ','.join(TRACE_FIELDS))
+	parser.add_argument("--synthetic", help="make up a trace instead", action="store_true")
+	parser.add_argument("--hours", help="hours of synthetic traffic", type=float, default=24)
+	parser.add_argument("--rate", help="synthetic messages per hour", type=float, default=100)
+	parser.add_argument("--mean-duration", help="average seconds synthetic work runs", type=float, default=120)
+	parser.add_argument("--failure-rate", help="fraction of synthetic work that fails", type=float, default=0.02)
+	parser.add_argument("--seed", help="seed of the random numbers", type=int, default=0)
+	parser.add_argument("--save-trace", help="write the synthetic trace to this csv file to replay later")
+	parser.add_argument("--spawners", help="number of spawners to simulate", type=int, default=1)
+	parser.add_argument("--scheduler", help="how each spawner picks the next topic to pull from",
+						choices=sorted(Scheduler.SchedulerFactory.schedulers))
+	parser.add_argument("--weights", help="topic weights instead of the topic file, e.g., priority-1=8,priority-2=2")
+	parser.add_argument("--set", help="override a WorkSpawnerConfig setting, e.g., RETRY_MODE='republish'",
+						action="append", default=[], type=parse_setting, metavar="NAME=VALUE")
+	parser.add_argument("--max-hours", help="stop after this many simulated hours", type=float)
+	parser.add_argument("--json", help="print the report as json", action="store_true")
+	parser.add_argument("--verbose", help="log what the simulated daemons log", action="store_true")
+
+	args = parser.parse_args()
+
+	for name, value in args.set:
+		setattr(WorkSpawnerConfig, name, value)
+
+	if not args.verbose:  # every retry and dead letter is logged, which is too much for days of traffic
+		logging.getLogger().setLevel(logging.CRITICAL)
+
+	if args.trace:
+		trace = load_trace(args.trace)
+	elif args.synthetic:
+		trace = make_synthetic_trace(args.hours, args.rate, args.mean_duration, args.failure_rate, args.seed)
+		if args.save_trace:
+			write_trace(trace, args.save_trace)
+	else:
+		parser.error('need --trace or --synthetic')
+
+	weights = parse_weights(args.weights) if args.weights else None
+	simulator = Simulator(trace, args.spawners, args.scheduler, weights, args.seed)
+	report = simulator.run(args.max_hours)
+
+	if args.json:
+		print(json.dumps(report, indent=2))
+	else:
+		print(format_report(report))
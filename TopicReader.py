@@ -1,6 +1,8 @@
 
 import csv
 import logging
+import os
+import re
 
 import WorkSpawnerConfig
 
@@ -19,6 +21,8 @@ class Topics:
 	priority_id_tag = 'priority id'
 	low_score_tag = 'low score'
 	high_score_tag = 'high score'
+	weight_tag = 'weight'
+	version_tag = 'version'  # only in the versioned topic tables written by ScoreBins
 
 	def __init__(self, filename=None):
 		"""
@@ -26,7 +30,9 @@ class Topics:
 		:param filename: override the default file name with this fully qualified name
 		"""
 		self.rows = []  # contains all of the rows from the config file
+		self.fieldnames = []  # column headings of the config file
 		self.topics = []  # save a list of the topics
+		self.version = None  # version of the topic table the score ranges come from, None if from the config file
 		try:
 			self.topic_file = WorkSpawnerConfig.TOPIC_FILE  # if defined in config file use it
 		except NameError:
@@ -37,6 +43,13 @@ class Topics:
 
 		if filename is None:
 			self.topics = self.load_topic_file(self.topic_file)  # load default topics list.
+			# score ranges balanced by the prioritizer replace the ones in the file, only while it is applying them
+			table = get_latest_table(WorkSpawnerConfig.TOPIC_TABLE_DIR)
+			if table and WorkSpawnerConfig.BIN_BALANCE_MODE == 'apply':
+				self.load_topic_table(table)
+			elif table:
+				logging.info('using the score ranges of the config file, not topic table: ' + table +
+							' since BIN_BALANCE_MODE is ' + str(WorkSpawnerConfig.BIN_BALANCE_MODE))
 		else:
 			self.topics = self.load_topic_file(filename)  # load default topics list.
 
@@ -57,6 +70,31 @@ class Topics:
 			reader = csv.DictReader(csvfile)
 			for row in reader:
 				self.rows.append(row)
+			self.fieldnames = reader.fieldnames or []
+		return True
+
+	def load_topic_table(self, filename):
+		"""
+		Use the score ranges of a versioned topic table written by ScoreBins instead of the ones in the config file.
+		The topics and weights still come from the config file
+		:param filename: topic table file
+		:return: True if loaded, False if its topics are not the ones in the config file
+		"""
+		with open(filename, newline='') as csvfile:
+			table = list(csv.DictReader(csvfile))
+
+		ranges = {row.get(self.topic_uid_tag): row for row in table}
+		if sorted(ranges) != sorted(row.get(self.topic_uid_tag) for row in self.rows):
+			logging.warning('ignoring topic table: ' + filename + ' since its topics are not the ones in the config file')
+			return False
+
+		for row in self.rows:
+			table_row = ranges[row.get(self.topic_uid_tag)]
+			row[self.low_score_tag] = table_row.get(self.low_score_tag)
+			row[self.high_score_tag] = table_row.get(self.high_score_tag)
+		self.version = get_table_version(filename)
+		logging.warning('using the score ranges of topic table: ' + filename + ' instead of the config file.  '
+						'set BIN_BALANCE_MODE to off or propose to go back to the config file')
 		return True
 
 	def get_topic_list(self, include_topic_root=False):
@@ -74,6 +112,7 @@ class Topics:
 		#	priority id: the integer priority.  this is used in excel file to construct the topic id
 		#	low score: the lowest score (inclusive) to put into the topic
 		#	high score: less than this score to put into the topic
+		#	weight: relative share of the spawner the topic gets when weighted scheduling is used
 
 		self.topics = []  # reload all of the topics
 		topic_root = ''
@@ -88,6 +127,30 @@ class Topics:
 
 		return self.topics
 
+	def get_topic_weights(self, include_topic_root=False):
+		"""
+		Weights are used by the weighted schedulers to share spawner time between topics
+		:param include_topic_root: set to True if the fully qualified topics are needed as keys.
+				otherwise, the short version is used
+		:return: dict of topic to weight.  topics without a weight column or value get a weight of 1
+		"""
+		weights = {}
+		topic_root = ''
+
+		for row in self.rows:
+			if include_topic_root:
+				topic_root = row.get(self.topic_root_tag)
+			topic = topic_root + row.get(self.topic_uid_tag)
+
+			weight = row.get(self.weight_tag)
+			try:
+				weights[topic] = float(weight) if weight else 1.0
+			except ValueError:
+				logging.error('invalid weight: ' + str(weight) + ' for topic: ' + topic + ', using 1')
+				weights[topic] = 1.0
+
+		return weights
+
 	def get_topic(self, score, include_topic_root=False):
 		"""
 		Retrieves the appropriate topic based on a score.  If a score is not found, the lowest priority topic is
@@ -126,6 +189,32 @@ class Topics:
 		return self.failed_work_topic_name
 
 
+def get_table_name(version):
+	return 'topics-v' + str(version) + '.csv'
+
+
+def get_table_version(filename):
+	"""
+	:param filename: name of a versioned topic table, topics-v<version>.csv
+	:return: its version, None if it isn't a topic table
+	"""
+	match = re.match(r'^topics-v(\d+)\.csv$', os.path.basename(filename))
+	return int(match.group(1)) if match else None
+
+
+def get_latest_table(directory):
+	"""
+	:param directory: directory the versioned topic tables are in
+	:return: file name of the latest version, None if there are none
+	"""
+	if not directory or not os.path.isdir(directory):
+		return None
+	tables = [name for name in os.listdir(directory) if get_table_version(name) is not None]
+	if not tables:
+		return None
+	return os.path.join(directory, max(tables, key=get_table_version))
+
+
 # For testing code only
 if __name__ == "__main__":
 
@@ -136,6 +225,7 @@ if __name__ == "__main__":
 
 	topics = tr.get_topic_list()
 	print(topics)
+	print(tr.get_topic_weights())
 
 	score = 2.7
 
@@ -1,17 +1,41 @@
 #
 # Work Spawner 3000 code
 #
+import os
 import signal
+import subprocess
 import sys
 import time
-from subprocess import Popen
+import uuid
+from subprocess import Popen, PIPE
 import logging
 import argparse
+import copy
+import json
 
 #  Local modules
 import WorkSpawnerConfig
 import TopicReader
 import PubSub
+import Batch
+import ClaimCheck
+import Concurrency
+import Dedupe
+import HostSlots
+import JobOutput
+import Ledger
+import LeaseKeeper
+import Monitor
+import Profiler
+import Reorder
+import ResultCache
+import RetryPolicy
+import RuntimeStats
+import Scheduler
+import ScoreBins
+import ScoreCache
+import ScoringPool
+import Workspace
 
 #  This is the module that contains all of the domain specific work.
 import MyWork
@@ -23,8 +47,37 @@ logger.setLevel(logging.INFO)
 
 class Spawner:
 
-	def __init__(self):
+	def __init__(self, dedupe=None, result_cache=None, retry_policy=None, stats=None, runtime_stats=None,
+				workspaces=None, reorder=None, concurrency=None, host_slots=None, ledger=None):
+		"""
+		:param dedupe: Dedupe.DedupeStore to check for duplicates, None to always run the work
+		:param result_cache: ResultCache.ResultCache to memoize results in, None to always spawn the work
+		:param retry_policy: RetryPolicy.RetryPolicy to handle failures with, None to dead letter every failure
+		:param stats: Monitor.StatsReporter to report jobs and heartbeats to, None to not report
+		:param runtime_stats: RuntimeStats.RuntimeStats to pick timeouts and leases with, None to use the config
+		:param workspaces: Workspace.WorkspaceManager to give each job its own workspace, None to share one tree
+		:param reorder: Reorder.ReorderWindow whose held messages are kept alive while work runs, None if not reordering
+		:param concurrency: Concurrency.ConcurrencyTuner that picks how many sub-tasks run at once, None for BATCH_SLOTS
+		:param host_slots: HostSlots.HostSlots shared with the other spawners on the host, None to not share
+		:param ledger: Ledger.Ledger every job is recorded in, None to not record them
+		"""
 		self.subprocess = None
+		self.dedupe = dedupe
+		self.result_cache = result_cache
+		self.retry_policy = retry_policy
+		self.stats = stats
+		self.runtime_stats = runtime_stats
+		self.workspaces = workspaces
+		self.reorder = reorder
+		self.concurrency = concurrency
+		self.host_slots = host_slots
+		self.host_slot = None  # slot of the host the work runs in, None if slots aren't shared
+		self.cores = None  # set of cores the work is pinned to, None to let it run on any
+		self.ledger = ledger
+		self.spawned_at = None  # when the work of the current job was spawned, None if it wasn't
+		self.exited_at = None  # when it exited or was stopped
+		self.output = None  # JobOutput.OutputCapture of the running work, None if its output isn't captured
+		self.container_name = None  # name of the docker container of the running work, None if it isn't docker
 
 	def pre_process(self, message):  # things that need to be done before processing work
 		return MyWork.pre_process(message)
@@ -35,29 +88,120 @@ class Spawner:
 	def get_work_cmd(self, message):
 		return MyWork.get_work_cmd(message)
 
+	def get_work_inputs(self, message):
+		return MyWork.get_work_inputs(message)
+
+	def get_work_outputs(self, message):
+		return MyWork.get_work_outputs(message)
+
+	@staticmethod
+	def get_docker_cmd(docker_id, container_name=None, workspace=None, cores=None):
+		"""
+		:param docker_id: image to run
+		:param container_name: name for the container so it can be stopped, None to let docker pick one
+		:param workspace: Workspace.Workspace mounted into the container at the same path, None to mount nothing
+		:param cores: set of cores to pin the container to, None to let it run on any
+		:return: command that runs the image
+		"""
+		cmd = ['docker', 'run', '--rm']
+		if container_name:
+			cmd += ['--name', container_name]
+		if cores:
+			cmd += ['--cpuset-cpus', ','.join(str(core) for core in sorted(cores))]
+		if workspace is not None:
+			cmd += ['--volume', workspace.path + ':' + workspace.path, '--workdir', workspace.path]
+			if not workspace.log_dir.startswith(workspace.path + os.sep):  # e.g., sub-tasks log to their batch
+				cmd += ['--volume', workspace.log_dir + ':' + workspace.log_dir]
+			for name, value in sorted(workspace.get_env().items()):
+				cmd += ['--env', name + '=' + value]
+		return cmd + [docker_id]
+
+	def get_spawn_cmd(self, message):
+		"""
+		:param message: message to be processed
+		:return: command and working directory that will be spawned for the message
+		"""
+		if 'docker_id' in message.attributes:
+			return self.get_docker_cmd(message.attributes['docker_id']), None
+		return self.get_work_cmd(message)
+
+	def popen(self, cmd, cwd, message):
+		"""
+		start the work.  its stdout and stderr are captured to files instead of going to the log of the spawner
+		unless WorkSpawnerConfig.JOB_OUTPUT_ENABLED is off
+		:param cmd: command to run
+		:param cwd: directory to run it in, None for the current directory
+		:param message: message the work is for.  if it has a workspace, the work finds its directories in the
+				environment
+		:return: None
+		"""
+		env = None
+		if message.workspace is not None:
+			env = dict(os.environ)
+			env.update(message.workspace.get_env())
+
+		self.output = None
+		if not WorkSpawnerConfig.JOB_OUTPUT_ENABLED:
+			self.subprocess = self.start(cmd, cwd, env)
+			return
+
+		JobOutput.prune()
+		output = JobOutput.OutputCapture(JobOutput.get_job_name(message))
+		self.subprocess = self.start(cmd, cwd, env, stdout=PIPE, stderr=PIPE)
+		output.start(self.subprocess)
+		self.output = output
+		logging.debug('capturing output in: ' + output.get_filename('{stdout,stderr}'))
+
+	def start(self, cmd, cwd, env, **kwargs):
+		"""
+		:return: Popen of the work, pinned to self.cores if they are set
+		"""
+		# the work gets its own session, and so its own process group, so everything it starts can be stopped with it
+		if not self.cores:
+			return Popen(cmd, cwd=cwd, env=env, start_new_session=True, **kwargs)
+
+		# the work inherits the affinity of the thread that starts it, so only this thread is pinned while it does
+		previous = os.sched_getaffinity(0)
+		os.sched_setaffinity(0, self.cores)
+		try:
+			return Popen(cmd, cwd=cwd, env=env, start_new_session=True, **kwargs)
+		finally:
+			os.sched_setaffinity(0, previous)
+
+	def collect_output(self, failed_message=None):
+		"""
+		wait for the rest of the captured output once the work has exited
+		:param failed_message: message of work that failed.  the end of the output is attached to it
+		:return: None
+		"""
+		if self.output is None:
+			return
+		self.output.join()
+		if failed_message is not None:
+			self.output.add_to_attributes(failed_message)
+
 	def spawn_docker(self, docker_id, message):
-		cmd = ['docker', 'run', '--rm', docker_id]
+		# killing the docker client doesn't stop the container, so it is named to be able to stop it
+		self.container_name = 'work-spawner-' + str(os.getpid()) + '-' + uuid.uuid4().hex[:12]
+		cmd = self.get_docker_cmd(docker_id, self.container_name, message.workspace, self.cores)
 		logging.debug('Docker cmd: ' + str(cmd))
-		self.subprocess = Popen(cmd)
+		self.popen(cmd, None, message)
 
 	def spawn_shell(self, message):
 		"""	payload: gets passed to the process"""
+		self.container_name = None
 		cmd, cwd = self.get_work_cmd(message)
 
 		logging.debug('shell cmd: ' + str(cmd))
-		self.subprocess = Popen(cmd,cwd=cwd)  # default hook to start work.
+		self.popen(cmd, cwd, message)  # default hook to start work.
 		logging.info('spawned subprocess: ' + str(self.subprocess.pid))
 
 	def is_spawn_done(self):
+		"""
+		:return: True once the subprocess has exited.  its exit code is then in self.subprocess.returncode
+		"""
 		rc = self.subprocess.poll()  # returns None if not done, else returns error code from subprocess
-		if rc is None:  # process isn't done
-			return False
-		else:  # process completed and returned a return code
-			exitcode = self.subprocess.terminate()
-			if exitcode:  # even if successfully terminated, return an error due to time out
-				raise Exception('subprocess returned an error code of: ' + str(exitcode))
-
-		return True
+		return rc is not None
 
 	def wait(self, timeout):
 		"""wait for a subprocess to be done or it times out
@@ -86,34 +230,781 @@ class Spawner:
 				process_done = True
 
 			if tracking_timeout and timeout_ctr <= 0:
-				exitcode = self.subprocess.terminate()
+				exitcode = self.terminate()
 				if not exitcode:  # even if successfully terminated, return an error due to time out
 					return -1
 
 		return exitcode
 
-	def terminate(self):
-		self.subprocess.terminate()
+	def signal_group(self, sig):
+		"""
+		:param sig: signal to send to every process in the process group of the work
+		:return: None
+		"""
+		try:
+			os.killpg(self.subprocess.pid, sig)  # the work leads its own group, so the group id is its pid
+		except ProcessLookupError:
+			pass  # everything has exited
+		except PermissionError as error:  # e.g., something in the group changed user
+			logging.error('could not signal the processes of the work: ' + str(error))
+
+	def is_group_alive(self):
+		"""
+		:return: True if the work or anything it started in its process group is still running
+		"""
+		if self.subprocess.poll() is not None:  # reaps the work if it has exited, so it doesn't count as alive
+			reap_group(self.subprocess.pid)
+		try:
+			os.killpg(self.subprocess.pid, 0)  # signal 0 only checks that the group exists
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			return True
+		return True
+
+	def wait_for_group(self, timeout):
+		"""
+		:param timeout: max seconds to wait
+		:return: True if everything in the process group exited within the timeout
+		"""
+		end_time = time.monotonic() + timeout
+		while self.is_group_alive():
+			if time.monotonic() >= end_time:
+				return False
+			time.sleep(0.1)
+		return True
 
-def work_spawner():
+	def stop_container(self, grace):
+		"""
+		start stopping the docker container of the work.  docker sends SIGTERM and SIGKILL after the grace period itself
+		:param grace: seconds the container gets to stop
+		:return: Popen of the docker stop, None if it could not be started
+		"""
+		cmd = ['docker', 'stop', '--time', str(int(grace)), self.container_name]
+		try:
+			return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		except OSError as error:
+			logging.error('could not stop container: ' + self.container_name + ' ' + str(error))
+			return None
+
+	def terminate(self, grace=None):
+		"""
+		Stop the work and everything it started: SIGTERM to its process group, SIGKILL to whatever is left after the
+		grace period.  Containers of docker work are stopped too.  Only returns once everything is gone, so the
+		slot isn't reused while the work is still burning cores.
+		:param grace: seconds the work gets to exit after SIGTERM.  defaults to WorkSpawnerConfig.TERMINATE_GRACE
+		:return: None
+		"""
+		terminate_all([self], grace)
+
+	def stop_leftovers(self):
+		"""
+		stop anything the work left running in the background once it has exited
+		:return: None
+		"""
+		if self.is_group_alive():
+			logging.warning('work left processes running after it exited, stopping them: ' + str(self.subprocess.pid))
+			self.terminate()
+
+
+def terminate_all(spawners, grace=None):
 	"""
-	Look up work queues, pull work off highest queues down to lowest queues, invoke user specific work
-	:return: none, will exit if errors out
+	Stop the work of several spawners at once: every process group gets SIGTERM (and every container a docker stop)
+	before any of them is waited for, so stopping n pieces of work takes one grace period instead of n
+	:param spawners: Spawner instances whose work is running
+	:param grace: seconds the work gets to exit after SIGTERM.  defaults to WorkSpawnerConfig.TERMINATE_GRACE
+	:return: None
 	"""
+	if grace is None:
+		grace = WorkSpawnerConfig.TERMINATE_GRACE
+
+	stops = []  # docker stops running in the background
+	for spawner in spawners:
+		if spawner.container_name:
+			stops.append(spawner.stop_container(grace))
+		spawner.signal_group(signal.SIGTERM)
+
+	end_time = time.monotonic() + grace
+	left = [spawner for spawner in spawners if not spawner.wait_for_group(max(end_time - time.monotonic(), 0))]
+	if left:
+		logging.warning('work did not exit ' + str(grace) + ' seconds after SIGTERM, killing its process groups: ' +
+						str([spawner.subprocess.pid for spawner in left]))
+		for spawner in left:
+			spawner.signal_group(signal.SIGKILL)
+		end_time = time.monotonic() + WorkSpawnerConfig.TERMINATE_KILL_WAIT
+		for spawner in left:
+			if not spawner.wait_for_group(max(end_time - time.monotonic(), 0)):  # e.g., stuck in uninterruptible io
+				logging.error('processes of the work are still running after SIGKILL: ' + str(spawner.subprocess.pid))
+
+	for stop in stops:
+		if stop is None:
+			continue
+		try:
+			stop.wait(timeout=max(end_time - time.monotonic(), 0) + WorkSpawnerConfig.TERMINATE_KILL_WAIT)
+		except subprocess.TimeoutExpired:
+			logging.error('docker stop did not finish, giving up on it: ' + str(stop.args))
+			stop.kill()
+			stop.wait()
+
+
+def become_subreaper():
+	"""
+	make the processes the work leaves behind children of this process when the work exits, instead of init,
+	so they can be reaped once they are stopped.  linux only, elsewhere they are left to init
+	:return: None
+	"""
+	try:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+		PR_SET_CHILD_SUBREAPER = 36
+		if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+			logging.debug('could not become a child subreaper: ' + os.strerror(ctypes.get_errno()))
+	except (OSError, AttributeError) as error:
+		logging.debug('could not become a child subreaper: ' + str(error))
+
+
+def reap_group(pgid):
+	"""
+	reap the zombies of a process group.  only call once the Popen that leads the group has been reaped by it,
+	otherwise its exit code would be lost
+	:param pgid: process group of the work
+	:return: None
+	"""
+	while True:
+		try:
+			pid, status = os.waitpid(-pgid, os.WNOHANG)
+		except ChildProcessError:  # none of the group are children of this process
+			return
+		if not pid:  # the rest are still running
+			return
+
+
+class Drain:
+	"""
+	Tracks a request to shut down from SIGINT or SIGTERM (e.g., when a preemptible vm is being preempted).
+	The daemons stop pulling new work as soon as a drain is requested.  Running work gets the grace period
+	to finish, after that it is killed and its message handed back so another vm can pick it up right away.
+	A second signal ends the grace period early.
+	"""
+
+	def __init__(self, grace=None):
+		"""
+		:param grace: seconds running work gets to finish.  defaults to WorkSpawnerConfig.DRAIN_GRACE
+		"""
+		self.grace = grace
+		self.requested_at = None  # time the drain was requested, None if it hasn't been
+		self.forced = False  # set by a second signal
+
+	def install(self, name):
+		"""
+		handle CTRL-C and SIGTERM by draining instead of exiting
+		:param name: name of the daemon for logging
+		:return: None
+		"""
+		def signal_handler(sig, frame):
+			if self.requested_at is None:
+				logging.info(name + ' is draining after signal: ' + str(sig))
+				self.requested_at = time.time()
+			else:
+				logging.info(name + ' is being terminated')
+				self.forced = True
+
+		signal.signal(signal.SIGINT, signal_handler)
+		signal.signal(signal.SIGTERM, signal_handler)
+
+	def is_draining(self):
+		return self.requested_at is not None
+
+	def is_out_of_time(self):
+		"""
+		:return: True if running work should be stopped and handed back
+		"""
+		if not self.is_draining():
+			return False
+
+		grace = self.grace
+		if grace is None:
+			grace = WorkSpawnerConfig.DRAIN_GRACE
+		return self.forced or time.time() - self.requested_at >= grace
+
+	def get_terminate_grace(self):
+		"""
+		:return: seconds work stopped by the drain gets after SIGTERM: WorkSpawnerConfig.TERMINATE_GRACE, but no more
+				than is left before DRAIN_DEADLINE once the SIGKILL wait is taken off
+		"""
+		left = WorkSpawnerConfig.DRAIN_DEADLINE - (time.time() - self.requested_at)
+		return min(WorkSpawnerConfig.TERMINATE_GRACE, max(left - WorkSpawnerConfig.TERMINATE_KILL_WAIT, 0))
+
+
+# signals are per process, so there is only one
+drain = Drain()
+
+# what happened to the work for a message
+WORK_SUCCEEDED = 'succeeded'  # acked
+WORK_FAILED = 'failed'  # logged as failed work and acked
+WORK_HANDED_BACK = 'handed back'  # not acked, the message will be delivered again
+
+
+def process_message(queue, spawner, message):
+	"""
+	Skip duplicate deliveries of work, otherwise run the work for the message
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance used to run the work
+	:param message: message pulled from a work topic
+	:return: WORK_SUCCEEDED, WORK_FAILED or WORK_HANDED_BACK
+	"""
+	dedupe = spawner.dedupe
+
+	if drain.is_draining():  # don't start anything new
+		queue.nack(message)
+		return WORK_HANDED_BACK
+
+	if spawner.retry_policy is not None:  # republished retries wait for their backoff
+		delay = spawner.retry_policy.get_retry_delay(message)
+		if delay > 0:
+			logging.debug('retry is not due for ' + str(int(delay)) + ' seconds: ' + str(message))
+			queue.nack(message, delay)
+			return WORK_HANDED_BACK
+
+	if dedupe is None:
+		return run_claimed_work(queue, spawner, message)
+
+	state = dedupe.check(message)
+	if state == dedupe.COMPLETED:
+		logging.info('work already completed, acking duplicate: ' + str(message))
+		queue.ack(message)
+		return WORK_SUCCEEDED
+
+	if state == dedupe.STARTED:
+		logging.info('work is already running on this host, holding back duplicate: ' + str(message))
+		queue.nack(message, WorkSpawnerConfig.DEDUPE_HOLD_SECONDS)
+		return WORK_HANDED_BACK
+
+	dedupe.mark_started(message)
+	result = run_claimed_work(queue, spawner, message)
+	if result == WORK_HANDED_BACK:
+		dedupe.forget(message)  # the next delivery has to run it
+	else:
+		dedupe.mark_completed(message)  # it was acked, so a redelivery must not run it again
+	return result
+
+
+def run_claimed_work(queue, spawner, message):
+	"""
+	run_work(), failing the message instead of the spawner if its body is in a blob store and can't be fetched
+	:return: WORK_SUCCEEDED, WORK_FAILED or WORK_HANDED_BACK
+	"""
+	try:
+		return run_work(queue, spawner, message)
+	except ClaimCheck.ClaimCheckError as error:
+		return fail_claim_check(queue, message, error)
+
+
+def fail_claim_check(queue, message, error):
+	"""
+	Dead letter a message whose body is gone from its blob store, or hand it back if the store couldn't be reached
+	:param queue: PubSub instance the message was pulled from
+	:param message: message whose body couldn't be fetched
+	:param error: ClaimCheck.ClaimCheckError
+	:return: WORK_FAILED if it was dead lettered, WORK_HANDED_BACK if it was handed back
+	"""
+	if not error.missing:
+		logging.error(str(error) + ', handing back message')
+		queue.nack(message, WorkSpawnerConfig.RETRY_BACKOFF_BASE)
+		return WORK_HANDED_BACK
+
+	logging.error(str(error) + ', dead lettering message')
+	message.body = ''  # drops the claim, so the dead letter doesn't refer to the blob and the ack doesn't release it
+	message.add_error_to_attributes('claim check: ' + str(error))
+	queue.log_failed_work(message)
+	queue.ack(message)
+	return WORK_FAILED
+
+
+def fail_work(queue, spawner, message, stage, error, exitcode=None):
+	"""
+	Retry or dead letter work that failed
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance whose retry policy handles the failure, if it has none the work is dead lettered
+	:param message: message whose work failed
+	:param stage: one of the RetryPolicy stages the failure happened in
+	:param error: string describing what went wrong
+	:param exitcode: exit code of the work for exit code failures
+	:return: WORK_HANDED_BACK if it will be retried, WORK_FAILED if it was dead lettered
+	"""
+	logging.error(error)
+
+	if spawner.retry_policy is None:
+		message.add_error_to_attributes(stage + ': ' + error)
+		queue.log_failed_work(message)
+		queue.ack(message)  # ack so that it is pulled off the queue so it won't be processed again
+		return WORK_FAILED
+
+	if spawner.retry_policy.handle_failure(queue, message, stage, error, exitcode):
+		return WORK_HANDED_BACK
+	return WORK_FAILED
+
+
+def spawn_and_wait(queue, spawner, message):
+	"""
+	Spawn the work for a message and wait for it to finish, keeping the message alive while it runs
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance used to run the work
+	:param message: message being processed
+	:return: WORK_SUCCEEDED if the work finished with a zero exit code, WORK_FAILED if it failed and was acked,
+			WORK_HANDED_BACK if it was stopped by a drain or will be retried
+	"""
+	# how long similar work has taken decides how long this work gets and how long its lease is
+	runtime_stats = spawner.runtime_stats
+	runtime_keys = []
+	timeout = WorkSpawnerConfig.WAIT_TIMEOUT
+	lease = WorkSpawnerConfig.LEASE_SECONDS
+	if runtime_stats is not None:
+		cmd, cwd = spawner.get_spawn_cmd(message)
+		runtime_keys = runtime_stats.get_keys(message, cmd)
+		timeout = runtime_stats.get_timeout(runtime_keys)
+		lease = runtime_stats.get_lease(runtime_keys)
+		logging.debug('timeout: ' + str(int(timeout)) + ' lease: ' + str(int(lease)) + ' for: ' + str(runtime_keys))
+
+	try:
+		# if there is a docker_id in the attributes, use it to spawn a docker file
+		if 'docker_id' in message.attributes:
+			docker_id = message.attributes['docker_id']
+			# spawn as a sub process
+			spawner.spawn_docker(docker_id, message)
+		else:
+			# spawn as a shell process
+			spawner.spawn_shell(message)
+	except OSError as error:  # e.g., the command doesn't exist
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.SPAWN,
+						'Could not spawn work: ' + str(error))
+
+	process_done = False
+	start_time = spawner.spawned_at = time.time()
+
+	# update so queue ack doesn't timeout.  only renewed once half of the lease has gone by
+	leases = LeaseKeeper.LeaseKeeper(queue)
+	leases.add(message, lease)
+
+	while not process_done:
+		leases.renew()
+		if spawner.reorder is not None:  # the messages waiting behind this one
+			spawner.reorder.renew()
+
+		if spawner.stats is not None:  # long running work shouldn't make the spawner look dead
+			spawner.stats.heartbeat()
+
+		time_delta = time.time() - start_time
+
+		if timeout - time_delta <= 0:
+			spawner.terminate()
+			spawner.exited_at = time.time()
+			spawner.collect_output(message)
+			if runtime_stats is not None:  # counted, but not as a duration
+				runtime_stats.record(runtime_keys, time_delta, timed_out=True)
+			return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.TIMEOUT,
+							'worker timed out after ' + str(int(time_delta)) + ' seconds')
+
+		if drain.is_out_of_time():
+			logging.info('work did not finish before shutdown, handing back message: ' + str(message))
+			queue.nack(message)  # first, so other spawners can pick it up even if the host is gone before it stops
+			spawner.terminate(drain.get_terminate_grace())
+			spawner.exited_at = time.time()
+			spawner.collect_output()
+			return WORK_HANDED_BACK
+
+		process_done = spawner.is_spawn_done()
+		if not process_done:
+			time.sleep(1 if drain.is_draining() else 5)  # how often to check the subprocess
+
+	spawner.exited_at = time.time()
+	if runtime_stats is not None:
+		runtime_stats.record(runtime_keys, time.time() - start_time)
+
+	exitcode = spawner.subprocess.returncode
+	spawner.stop_leftovers()
+	spawner.collect_output(message if exitcode else None)
+	if exitcode:
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.EXIT_CODE,
+						'subprocess returned an error code of: ' + str(exitcode), exitcode)
+
+	return WORK_SUCCEEDED
+
+
+def run_work(queue, spawner, message):
+	"""
+	Run the work for one message: pre_process, spawn the work and wait for it, post_process and ack
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance used to run the work
+	:param message: message pulled from a work topic
+	:return: WORK_SUCCEEDED, WORK_FAILED or WORK_HANDED_BACK.  the message is acked unless it is handed back
+	"""
+	if spawner.workspaces is None:
+		return run_work_in(queue, spawner, message)
+
+	try:
+		message.workspace = spawner.workspaces.create(JobOutput.get_job_name(message))
+	except OSError as error:  # e.g., the disk is full
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.PRE_PROCESS,
+						'Could not create workspace: ' + str(error))
+	try:
+		return run_work_in(queue, spawner, message)
+	finally:
+		spawner.workspaces.release(message.workspace)  # post_process has uploaded what is worth keeping
+		message.workspace = None
+
+
+def run_work_in(queue, spawner, message):
+	"""
+	Run the work for one message in its workspace, or the shared tree if it doesn't have one
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance used to run the work
+	:param message: message pulled from a work topic
+	:return: WORK_SUCCEEDED, WORK_FAILED or WORK_HANDED_BACK.  the message is acked unless it is handed back
+	"""
+	if Batch.is_batch(message):
+		return run_batch(queue, spawner, message)
+
+	result_cache = spawner.result_cache
+
+	# reset queue ack timeout.  that is how long pre_process has to finish
+	queue.keep_alive(message)
+
+	# perform any work that needs to be done before spawned. e.g., copying files etc.
+	if not spawner.pre_process(message):
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.PRE_PROCESS,
+						'Could not pre_process message: ' + str(message))
+
+	# if memoizing, a digest of the command and its inputs identifies the result of the work
+	result_key = None
+	if result_cache is not None and result_cache.is_wanted(message):
+		cmd, cwd = spawner.get_spawn_cmd(message)
+		base_dir = message.workspace.path if message.workspace is not None else None
+		result_key = result_cache.get_key(cmd, cwd, spawner.get_work_inputs(message), base_dir)
+
+	if result_key is not None and result_cache.restore(result_key, spawner.get_work_outputs(message)):
+		logging.info('using cached result instead of spawning work')
+	else:
+		result = spawn_and_wait(queue, spawner, message)
+		if result != WORK_SUCCEEDED:
+			return result
+
+		if result_key is not None:
+			result_cache.store(result_key, spawner.get_work_outputs(message))
+
+	logging.info('work finished successfully')
+
+	# reset queue ack timeout.  that is how long post_process has to finish
+	queue.keep_alive(message)
+
+	if not spawner.post_process(message):
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.POST_PROCESS,
+						'Could not post_process message: ' + str(message))
+
+	if spawner.retry_policy is not None:
+		spawner.retry_policy.handle_success(message)
+
+	queue.ack(message)  # acknowledge the message if successfully processed
+	return WORK_SUCCEEDED
+
+
+def run_batch(queue, spawner, message):
+	"""
+	Run a batch message: pre_process once, run its sub-tasks across WorkSpawnerConfig.BATCH_SLOTS local slots,
+	post_process once and ack.  Sub-tasks that failed are requeued as a smaller batch or dead lettered one by one.
+	Results are not memoized for batches.
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance used to run the work
+	:param message: batch message pulled from a work topic
+	:return: WORK_SUCCEEDED if every sub-task succeeded or will be retried, WORK_FAILED if any were dead lettered,
+			WORK_HANDED_BACK if the whole batch was handed back
+	"""
+	try:
+		tasks = Batch.get_tasks(message)
+	except (ValueError, TypeError, AttributeError) as error:
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.BATCH, 'Could not read batch: ' + str(error))
+
+	# reset queue ack timeout.  that is how long pre_process has to finish
+	queue.keep_alive(message)
+
+	if not spawner.pre_process(message):
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.PRE_PROCESS,
+						'Could not pre_process message: ' + str(message))
+
+	spawner.spawned_at = time.time()
+	failed, not_run = run_tasks(queue, spawner, message, tasks)
+	spawner.exited_at = time.time()
+	logging.info('batch finished: ' + str(len(tasks) - len(failed) - len(not_run)) + ' of ' + str(len(tasks)) +
+				' sub-tasks succeeded, ' + str(len(failed)) + ' failed, ' + str(len(not_run)) + ' not run')
+
+	# reset queue ack timeout.  that is how long post_process has to finish
+	queue.keep_alive(message)
+
+	if not spawner.post_process(message):
+		return fail_work(queue, spawner, message, RetryPolicy.RetryPolicy.POST_PROCESS,
+						'Could not post_process message: ' + str(message))
+
+	result = requeue_failed_tasks(queue, spawner, message, failed)
+
+	if spawner.retry_policy is not None:
+		spawner.retry_policy.handle_success(message)
+
+	queue.ack(message)  # the sub-tasks that have to run again were published in a new batch
+	return result
 
-	# Use instances so could parallel process in a future version
-	spawner = Spawner()
+
+def run_tasks(queue, spawner, message, tasks):
+	"""
+	Run sub-tasks in parallel, each in its own subprocess, keeping the batch message alive while they run
+	:param queue: PubSub instance the message was pulled from
+	:param spawner: Spawner instance whose hooks and services are used for every sub-task
+	:param message: batch message
+	:param tasks: Batch.Tasks to run
+	:return: (list of (task, stage, error, exitcode) for sub-tasks that failed,
+			list of tasks that were not run or were stopped because of a drain.  they have been requeued already)
+	"""
+	slots = WorkSpawnerConfig.BATCH_SLOTS or os.cpu_count() or 1
+	concurrency = spawner.concurrency
+	runtime_stats = spawner.runtime_stats
+	pending = list(tasks)  # not started yet, in order
+	running = []  # (task, Spawner running it, start time, timeout, runtime keys)
+	failed = []
+
+	leases = LeaseKeeper.LeaseKeeper(queue)
+	leases.add(message)
+
+	while pending or running:
+		leases.renew()
+		if spawner.reorder is not None:
+			spawner.reorder.renew()
+		if spawner.stats is not None:
+			spawner.stats.heartbeat()
+
+		if drain.is_out_of_time():
+			# requeue first, so other spawners can pick the sub-tasks up even if the host is gone before they stop
+			not_run = [entry[0] for entry in running] + pending
+			logging.info('batch did not finish before shutdown, requeuing ' + str(len(not_run)) + ' sub-tasks')
+			requeue_tasks(queue, message, not_run)
+			terminate_all([entry[1] for entry in running], drain.get_terminate_grace())
+			for task, task_spawner, start_time, timeout, runtime_keys in running:
+				task_spawner.collect_output()
+				release_task_workspace(spawner, task)
+				release_task_slot(spawner, task_spawner)
+			return failed, not_run
+
+		if concurrency is not None:
+			slots = concurrency.update(len(running), len(pending))
+
+		# fill the free slots, unless draining.  then only what is running gets to finish
+		while pending and len(running) < slots and not drain.is_draining():
+			task_spawner = copy.copy(spawner)  # same hooks and services, its own subprocess
+			if not take_task_slot(spawner, task_spawner, running):
+				break  # every slot on the host is taken, wait for one to be given back
+			task = pending.pop(0)
+
+			timeout = WorkSpawnerConfig.WAIT_TIMEOUT
+			runtime_keys = []
+			if runtime_stats is not None:
+				runtime_keys = runtime_stats.get_keys(task, task_spawner.get_spawn_cmd(task)[0])
+				timeout = runtime_stats.get_timeout(runtime_keys)
+
+			try:
+				create_task_workspace(spawner, message, task)
+				if 'docker_id' in task.attributes:
+					task_spawner.spawn_docker(task.attributes['docker_id'], task)
+				else:
+					task_spawner.spawn_shell(task)
+			except OSError as error:  # e.g., the command doesn't exist
+				release_task_workspace(spawner, task)
+				release_task_slot(spawner, task_spawner)
+				report_task(spawner, message, task, 0, 'Could not spawn work: ' + str(error))
+				failed.append((task, RetryPolicy.RetryPolicy.SPAWN, 'Could not spawn work: ' + str(error), None))
+				continue
+
+			running.append((task, task_spawner, time.time(), timeout, runtime_keys))
+
+		if drain.is_draining() and not running:
+			break
+
+		still_running = []
+		for entry in running:
+			task, task_spawner, start_time, timeout, runtime_keys = entry
+			duration = time.time() - start_time
+
+			if duration >= timeout:
+				task_spawner.terminate()
+				task_spawner.collect_output(task)
+				error = 'worker timed out after ' + str(int(duration)) + ' seconds'
+				failed.append((task, RetryPolicy.RetryPolicy.TIMEOUT, error, None))
+			elif task_spawner.is_spawn_done():
+				exitcode = task_spawner.subprocess.returncode
+				task_spawner.stop_leftovers()
+				task_spawner.collect_output(task if exitcode else None)
+				error = None
+				if exitcode:
+					error = 'subprocess returned an error code of: ' + str(exitcode)
+					failed.append((task, RetryPolicy.RetryPolicy.EXIT_CODE, error, exitcode))
+			else:
+				still_running.append(entry)
+				continue
+
+			release_task_workspace(spawner, task)
+			release_task_slot(spawner, task_spawner)
+			if runtime_stats is not None:
+				runtime_stats.record(runtime_keys, duration, timed_out=duration >= timeout)
+			if concurrency is not None:
+				concurrency.record(error is not None)
+			report_task(spawner, message, task, duration, error)
+
+		if len(still_running) == len(running):  # nothing finished, wait a bit before checking again
+			time.sleep(0.5)
+		running = still_running
+
+	requeue_tasks(queue, message, pending)  # drained before they could start
+	return failed, pending
+
+
+def requeue_tasks(queue, message, tasks):
+	"""
+	publish the sub-tasks that didn't get to run in a new batch, without counting an attempt
+	:param queue: PubSub instance the batch was pulled from
+	:param message: batch message
+	:param tasks: Batch.Tasks to run again
+	:return: None
+	"""
+	if tasks:
+		queue.publish(message.topic, Batch.make_retry_message(message, tasks))
+
+
+def create_task_workspace(spawner, message, task):
+	"""
+	give a sub-task its own workspace, a copy of the workspace of its batch after pre_process, logging to a
+	directory of its own in the logs of the batch so post_process uploads them with the batch
+	:param spawner: Spawner instance running the batch
+	:param message: batch message
+	:param task: Batch.Task about to be spawned
+	:return: None
+	"""
+	if spawner.workspaces is None or message.workspace is None:
+		return
+	log_dir = os.path.join(message.workspace.log_dir, 'task-' + str(task.index))
+	os.makedirs(log_dir, exist_ok=True)
+	task.workspace = spawner.workspaces.create(os.path.basename(message.workspace.path) + '-' + str(task.index),
+											message.workspace.path, log_dir)
+
+
+def release_task_workspace(spawner, task):
+	if spawner.workspaces is not None and task.workspace is not None:
+		spawner.workspaces.release(task.workspace)
+		task.workspace = None
+
+
+def take_task_slot(spawner, task_spawner, running):
+	"""
+	find a slot on the host for a sub-task.  one sub-task at a time runs in the slot of the batch, the others take
+	slots of their own
+	:param spawner: Spawner instance running the batch
+	:param task_spawner: copy of the spawner about to run the sub-task
+	:param running: sub-tasks that are running, as in run_tasks()
+	:return: True if the sub-task has a slot, False if every slot on the host is taken
+	"""
+	host_slots = spawner.host_slots
+	if host_slots is None:
+		return True
+	if all(entry[1].host_slot != spawner.host_slot for entry in running):
+		return True  # the slot of the batch is free
+	task_spawner.host_slot = host_slots.acquire()
+	if task_spawner.host_slot is None:
+		return False
+	task_spawner.cores = host_slots.get_cores(task_spawner.host_slot)
+	return True
+
+
+def release_task_slot(spawner, task_spawner):
+	if spawner.host_slots is not None and task_spawner.host_slot != spawner.host_slot:
+		spawner.host_slots.release(task_spawner.host_slot)
+
+
+def report_task(spawner, message, task, duration, error):
+	"""
+	log the result of a sub-task and report it to the monitor
+	:param spawner: Spawner instance running the batch
+	:param message: batch message
+	:param task: Batch.Task that finished
+	:param duration: seconds it ran for
+	:param error: string describing what went wrong, None if it succeeded
+	:return: None
+	"""
+	result = WORK_SUCCEEDED if error is None else WORK_FAILED
+	logging.info('sub-task ' + str(task.index) + ' ' + result + ' after ' + str(round(duration, 1)) + ' seconds: ' +
+				str(task) + ('' if error is None else ' ' + error))
+	if spawner.stats is not None:
+		spawner.stats.task_done(message.topic, duration, result)
+
+
+def requeue_failed_tasks(queue, spawner, message, failed):
+	"""
+	Publish a batch of the sub-tasks that should run again and dead letter the rest
+	:param queue: PubSub instance the batch was pulled from
+	:param spawner: Spawner instance whose retry policy decides what is retried, if it has none nothing is
+	:param message: batch message
+	:param failed: list of (task, stage, error, exitcode) from run_tasks()
+	:return: WORK_FAILED if any sub-tasks were dead lettered, WORK_SUCCEEDED otherwise
+	"""
+	retry_policy = spawner.retry_policy
+	retry = []
+	dead = []
+	for task, stage, error, exitcode in failed:
+		if (retry_policy is not None and retry_policy.classify(stage, exitcode) == retry_policy.TRANSIENT and
+				retry_policy.get_attempt(task) < retry_policy.max_attempts):
+			retry.append((task, stage, error))
+		else:
+			dead.append((task, stage, error))
+
+	for task, stage, error in dead:  # one by one, so each carries its own error and output
+		task.add_error_to_attributes(stage + ': ' + error)
+		queue.log_failed_work(task)
+
+	if retry:
+		attempt = retry_policy.get_attempt(message)
+		backoff = retry_policy.get_backoff(attempt)
+		retry_message = Batch.make_retry_message(message, [task for task, stage, error in retry])
+		retry_message.add_error_to_attributes(str(len(retry)) + ' of the sub-tasks failed, first: ' +
+											retry[0][1] + ': ' + retry[0][2])
+		retry_message.attributes[retry_policy.attempt_attribute] = str(attempt + 1)
+		retry_message.attributes[retry_policy.retry_after_attribute] = str(retry_policy.clock() + backoff)
+		logging.info('retrying ' + str(len(retry)) + ' sub-tasks in ' + str(int(backoff)) + ' seconds')
+		queue.publish(message.topic, retry_message)
+
+	return WORK_FAILED if dead else WORK_SUCCEEDED
+
+
+def sleep_unless_draining(seconds):
+	"""
+	sleep, but wake up early if a drain is requested
+	:param seconds: seconds to sleep
+	:return: None
+	"""
+	end_time = time.time() + seconds
+	while not drain.is_draining() and time.time() < end_time:
+		time.sleep(min(1, end_time - time.time()))
+
+
+def work_spawner(scheduler_mode=None):
+	"""
+	Look up work queues, pull work off the queues in the order the scheduler picks, invoke user specific work
+	:param scheduler_mode: overrides WorkSpawnerConfig.SCHEDULER_MODE if set
+	:return: none, will exit if errors out
+	"""
 
 	# get implementation specific instance
 	queue = PubSub.PubSubFactory.get_queue()
 
-	# function to call if the process gets killed or interrupted
-	def signal_handler(sig, frame):
-		logging.info('work_spawner is being terminated')
-		sys.exit(0)
+	# handle CTRL-C and SIGTERM by draining running work
+	drain.install('work_spawner')
 
-	# handle CTRL-C to stop subprocess
-	signal.signal(signal.SIGINT, signal_handler)
+	# processes the work leaves behind are re-parented here so they can be stopped and reaped
+	become_subreaper()
 
 	# interface to queue topics
 	# reads in upon instantiation
@@ -122,112 +1013,187 @@ def work_spawner():
 		logging.error('No topics found')
 		sys.exit(-1)
 
-	index = 0  # index into the list of topics
 	topics = tr.get_topic_list()
 
-	while True:
+	# remembers work that has been started and completed on this host
+	dedupe = None
+	if WorkSpawnerConfig.DEDUPE_ENABLED:
+		dedupe = Dedupe.DedupeStore()
+
+	# opt in cache of the results of deterministic work
+	result_cache = None
+	if WorkSpawnerConfig.MEMOIZE_ENABLED:
+		result_cache = ResultCache.ResultCache()
+
+	# retries transient failures and dead letters the rest
+	retry_policy = None
+	if WorkSpawnerConfig.RETRY_ENABLED:
+		retry_policy = RetryPolicy.RetryPolicy()
+
+	# reports jobs and heartbeats for the monitor
+	stats = None
+	if WorkSpawnerConfig.STATS_ENABLED:
+		stats = Monitor.StatsReporter(queue)
+
+	# learns per job timeouts and lease lengths from how long work has taken
+	runtime_stats = None
+	if WorkSpawnerConfig.RUNTIME_STATS_ENABLED:
+		runtime_stats = RuntimeStats.RuntimeStats(WorkSpawnerConfig.RUNTIME_STATS_DB_FILE)
+
+	# gives each job its own scratch copy of the work tree, so jobs don't see each other's files
+	workspaces = None
+	if WorkSpawnerConfig.WORKSPACES_ENABLED:
+		workspaces = Workspace.WorkspaceManager()
+
+	# pulls a window of messages from a topic and runs the best scored one first
+	reorder = None
+	if WorkSpawnerConfig.REORDER_WINDOW > 1:
+		reorder = Reorder.ReorderWindow(queue)
+
+	# tunes how many sub-tasks of a batch run at once
+	concurrency = None
+	if WorkSpawnerConfig.CONCURRENCY_TUNING_ENABLED:
+		concurrency = Concurrency.ConcurrencyTuner()
+
+	# slots shared with the other spawners on the host, so together they don't take on more work than it can run
+	host_slots = None
+	if WorkSpawnerConfig.HOST_SLOTS_ENABLED:
+		host_slots = HostSlots.HostSlots()
+
+	# history of every job, queried with Ledger.py
+	ledger = None
+	if WorkSpawnerConfig.LEDGER_ENABLED:
+		ledger = Ledger.Ledger()
+
+	# Use instances so could parallel process in a future version
+	spawner = Spawner(dedupe, result_cache, retry_policy, stats, runtime_stats, workspaces, reorder, concurrency,
+					host_slots, ledger)
+
+	# decides which topic to pull from next, strict priority by default
+	scheduler = Scheduler.SchedulerFactory.get_scheduler(topics, tr.get_topic_weights(), scheduler_mode)
+
+	while not drain.is_draining():
 		# TODO: always load the topics in case they have changed?
 		# uses queue.ack() when don't want message processed again.  If this process gets killed before the
 		# ack, the message will be available for another process
 
-		if index >= len(topics):  # must have gone through all of the topics without finding work
-			logging.info("No work found")
-			time.sleep(10)  # if reached the end of the topics and there was no work, then sleep for a while
-			index = 0  # reset the index for next time checking for work
-			continue  # restart the while loop
-
-		# Get the next topic from a list of topics
-		topic = topics[index]
-		logging.debug('Topic being checked: ' + topic)
+		# only pull work when there is a free slot on the host to run it in
+		if host_slots is not None:
+			spawner.host_slot = host_slots.acquire()
+			if spawner.host_slot is None:
+				logging.debug('every slot on the host is taken')
+				if stats is not None:
+					stats.heartbeat()
+				if reorder is not None:
+					reorder.renew()
+				sleep_unless_draining(WorkSpawnerConfig.HOST_SLOTS_WAIT)
+				continue
+			spawner.cores = host_slots.get_cores(spawner.host_slot)
+
+		messages = None
+		for topic in scheduler.get_topic_order():
+			logging.debug('Topic being checked: ' + topic)
+
+			# synchronously pull one message at a time
+			if reorder is not None:
+				messages = reorder.pull(topic)
+			else:
+				messages = queue.pull(topic, 1)
+			if messages:
+				break  # found work, stop checking topics
 
-		# synchronously pull one message at a time
-		messages = queue.pull(topic, 1)
+			scheduler.topic_empty(topic)  # Move to the next topic if no message
 
-		if not messages:  # if there are no messages on that queue, move to next one.
-			index += 1  # Move to lower priority topic if no message
-			continue
+		if not messages:  # must have gone through all of the topics without finding work
+			if host_slots is not None:
+				host_slots.release(spawner.host_slot)  # other spawners may have work for it
+			logging.info("No work found")
+			if stats is not None:
+				stats.heartbeat()
+			sleep_unless_draining(10)  # if reached the end of the topics and there was no work, then sleep for a while
+			continue  # restart the while loop
 
 		# If we got any messages, spawn a subprocess to handle each message in order received
-		# then start over with the highest priority topic again
+		# then ask the scheduler for the next topic again
 		for message in messages:  # loop through all of the messages and process each one
 			logging.info('working with message: ' + str(message) + ' pulled from: ' + str(topic))
 
-			# reset queue ack timeout.  that is how long pre_process has to finish
-			queue.keep_alive(message)
-
-			# perform any work that needs to be done before spawned. e.g., copying files etc.
-			if not spawner.pre_process(message):
-				logging.error('Could not pre_process message' + str(message))
-				queue.log_failed_work(message)
-				queue.ack(message)  # ack so that it is pulled off the queue so it won't be processed again
-				continue  # for message loop
-
-			# if there is a docker_id in the attributes, use it to spawn a docker file
-			if 'docker_id' in message.attributes:
-				docker_id = message.attributes['docker_id']
-				# spawn as a sub process
-				spawner.spawn_docker(docker_id, message)
-			else:
-				# spawn as a shell process
-				spawner.spawn_shell(message)
-
-			process_done = False
-			timeout_ctr = WorkSpawnerConfig.WAIT_TIMEOUT
 			start_time = time.time()
+			usage = Ledger.get_child_usage()
+			spawner.subprocess = spawner.spawned_at = spawner.exited_at = None
+			result = process_message(queue, spawner, message)
+			duration = time.time() - start_time
+
+			if ledger is not None:
+				exitcode = spawner.subprocess.returncode if spawner.subprocess is not None else None
+				attempt = max(1, int(message.delivery_attempt or 0))
+				if retry_policy is not None:
+					attempt = retry_policy.get_attempt(message)
+				ledger.record(message, result, (start_time, spawner.spawned_at, spawner.exited_at, time.time()),
+							exitcode, usage, attempt)
+
+			# charge the topic for the time the spawner spent on its work
+			scheduler.work_done(topic, duration)
+
+			if stats is not None:
+				if result == WORK_HANDED_BACK:  # nothing came off the backlog, it says nothing about job durations
+					stats.heartbeat()
+				else:
+					stats.job_done(topic, duration, result)
+
+		if host_slots is not None:
+			host_slots.release(spawner.host_slot)
+
+	if reorder is not None:
+		reorder.hand_back()  # available to other spawners right away instead of when the leases run out
+	if host_slots is not None:
+		host_slots.release_all()
+	if ledger is not None:
+		ledger.stop()
+	queue.flush()  # make sure nothing batched is lost
+	if workspaces is not None:
+		workspaces.wait()
+	logging.info('work_spawner has drained')
+
+
+def publish_scored_message(queue, tr, message, score, balancer=None):
+	"""
+	Publish a scored message on the work topic for its score and ack it
+	:param queue: PubSub instance the message was pulled from
+	:param tr: TopicReader.Topics used to look up the topic for the score
+	:param message: message pulled from the prioritization topic
+	:param score: score from MyWork.prioritize
+	:param balancer: ScoreBins.BinBalancer that tracks the scores, None if the score ranges are fixed
+	:return: None
+	"""
+	topic_to_publish_on = tr.get_topic(score)
+	if topic_to_publish_on:
+		# so spawners can order the work within the topic, see Reorder
+		message.attributes[WorkSpawnerConfig.SCORE_ATTRIBUTE] = str(score)
+		logging.info('publishing: ' + str(message) + ' on topic: ' + str(topic_to_publish_on))
+		queue.publish(topic_to_publish_on, message)
+	else:
+		logging.error('could not find a topic to send work to for score: ' + str(score))
+		queue.log_failed_work(message)
 
-			while not process_done:
-				# update so queue ack doesn't timeout
-				queue.keep_alive(message)
-
-				time_delta = time.time() - start_time
-
-				if timeout_ctr - time_delta <= 0:
-					spawner.terminate()
-					logging.error('worker timed out')
-					queue.log_failed_work(message)
-					queue.ack(message)  # ack so that it is pulled off the queue so it won't be processed again
-					process_done = True
-					continue
-
-				try:
-					process_done = spawner.is_spawn_done()
-				except Exception as error:
-					logging.error(error)
-
-				time.sleep(5)  # how often to check the subprocess
-
-			# wait for the subprocess to error or time out
-			logging.info('work finished successfully')
-
-			# reset queue ack timeout.  that is how long post_process has to finish
-			queue.keep_alive(message)
-
-			if not spawner.post_process(message):
-				logging.error('Could not post_process message: ' + str(message))
-				queue.log_failed_work(message)
-				queue.ack(message)  # ack so that it is pulled off the queue so it won't be processed again
-				continue  # for message loop
-
-			queue.ack(message)  # acknowledge the message if successfully processed
+	queue.ack(message)  # make sure it doesn't get processed again
 
-		index = 0  # reset the index back to the highest priority queue so that work is always
-					# pulled from there first
+	if balancer is not None:
+		balancer.add(score)
 
 
-def work_prioritizer():
+def work_prioritizer(workers=None):
 	"""
 	Pull work from the "work to prioritize queue"
 	Score it using a user defined function
 	Look up the appropriate work queue using the score to find priority
 	Put on the work queue
+	:param workers: number of processes to score work in.  0 scores in this process.
+			defaults to WorkSpawnerConfig.PRIORITIZER_WORKERS
 	:return: None, will exit if error
 	"""
-	def signal_handler(sig, frame):
-		logging.info('work_prioritizer is being terminated')
-		sys.exit(0)
-
-	# handle CTRL-C to stop subprocess
-	signal.signal(signal.SIGINT, signal_handler)
+	# handle CTRL-C and SIGTERM by finishing the current message and stopping
+	drain.install('work_prioritizer')
 
 	# instantiate the queue in interface
 	queue = PubSub.PubSubFactory.get_queue()
@@ -241,7 +1207,60 @@ def work_prioritizer():
 	# get the topic where work to be prioritized is queued
 	priority_topic = tr.get_priority_topic()
 
-	while True:
+	# scores of work that has been prioritized before
+	score_cache = None
+	if WorkSpawnerConfig.SCORE_CACHE_ENABLED and not getattr(MyWork, 'PRIORITIZE_IS_DETERMINISTIC', False):
+		logging.warning('not caching scores, MyWork.prioritize is not marked deterministic')
+	elif WorkSpawnerConfig.SCORE_CACHE_ENABLED:
+		db_file = WorkSpawnerConfig.SCORE_CACHE_DB_FILE if WorkSpawnerConfig.SCORE_CACHE_PERSIST else None
+		score_cache = ScoreCache.ScoreCache(db_file=db_file)
+
+	# moves the score ranges of the topics to follow the scores that are published
+	balancer = None
+	if WorkSpawnerConfig.BIN_BALANCE_MODE != ScoreBins.MODE_OFF:
+		balancer = ScoreBins.BinBalancer(tr)
+
+	if workers is None:
+		workers = WorkSpawnerConfig.PRIORITIZER_WORKERS
+	if workers:
+		prioritize_in_pool(queue, tr, priority_topic, workers, score_cache, balancer)
+	else:
+		prioritize_inline(queue, tr, priority_topic, score_cache, balancer)
+
+	if score_cache is not None:
+		logging.info('score cache: ' + str(score_cache.get_stats()))
+
+	queue.flush()  # make sure nothing batched is lost
+	logging.info('work_prioritizer has drained')
+
+
+def get_cached_score(score_cache, message):
+	"""
+	:param score_cache: ScoreCache.ScoreCache, or None if not caching
+	:param message: message to prioritize
+	:return: the cached score of the message, None if it has to be scored
+	"""
+	if score_cache is None:
+		return None
+
+	score = score_cache.get(message)
+	lookups = score_cache.hits + score_cache.misses
+	if lookups % 1000 == 0:
+		logging.info('score cache: ' + str(score_cache.get_stats()))
+	return score
+
+
+def prioritize_inline(queue, tr, priority_topic, score_cache=None, balancer=None):
+	"""
+	Score one message at a time in this process until drained
+	:param queue: PubSub instance to pull from and publish to
+	:param tr: TopicReader.Topics used to look up the topic for a score
+	:param priority_topic: topic where work to be prioritized is queued
+	:param score_cache: ScoreCache.ScoreCache to look up and save scores in, None to always score
+	:param balancer: ScoreBins.BinBalancer that tracks the scores, None if the score ranges are fixed
+	:return: None
+	"""
+	while not drain.is_draining():
 		# TODO: always load the topics in case they have changed?  wait until using memory cache
 
 		# pull next work to prioritize
@@ -250,24 +1269,116 @@ def work_prioritizer():
 
 		if not messages:  # if there are no messages on that queue, move to next one.
 			logging.debug('no work found on prioritization queue')
-			time.sleep(10)
+			sleep_unless_draining(10)
 			continue  # while loop
 
 		# If we got any messages
 		for message in messages:  # loop through all of the messages and process each one
 			logging.debug('message: ' + str(message) + ' pulled from: ' + str(priority_topic))
 
-			# use the message to extract a priority. This is done in the user specific MyWork.py.
-			score = MyWork.prioritize(message)
-			topic_to_publish_on = tr.get_topic(score)
-			if topic_to_publish_on:
-				logging.info('publishing: ' + str(message) + ' on topic: ' + str(topic_to_publish_on))
-				queue.publish(topic_to_publish_on, message)
-			else:
-				logging.error('could not find a topic to send work to for score: ' + str(score))
+			if drain.is_draining():
+				queue.nack(message)  # hand back anything not started
+				continue
+
+			try:
+				score = get_cached_score(score_cache, message)
+				if score is None:
+					# use the message to extract a priority. This is done in the user specific MyWork.py.
+					score = MyWork.prioritize(message)
+					if score_cache is not None:
+						score_cache.put(message, score)
+			except ClaimCheck.ClaimCheckError as error:
+				fail_claim_check(queue, message, error)
+				continue
+
+			publish_scored_message(queue, tr, message, score, balancer)
+
+
+def prioritize_in_pool(queue, tr, priority_topic, workers, score_cache=None, balancer=None):
+	"""
+	Score a window of messages in a pool of processes until drained, publishing each as soon as it is scored
+	:param queue: PubSub instance to pull from and publish to
+	:param tr: TopicReader.Topics used to look up the topic for a score
+	:param priority_topic: topic where work to be prioritized is queued
+	:param workers: number of scoring processes
+	:param score_cache: ScoreCache.ScoreCache to look up and save scores in, None to always score
+	:param balancer: ScoreBins.BinBalancer that tracks the scores, None if the score ranges are fixed
+	:return: None
+	"""
+	pool = ScoringPool.ScoringPool(queue, workers, WorkSpawnerConfig.PRIORITIZER_WINDOW)
+
+	while not drain.is_out_of_time() and (len(pool) or not drain.is_draining()):
+		# keep the window full
+		room = pool.get_room()
+		if room > 0 and not drain.is_draining():
+			logging.debug('Pulling up to ' + str(room) + ' messages from priority_topic: ' + priority_topic)
+			for message in queue.pull(priority_topic, room) or []:
+				try:
+					score = get_cached_score(score_cache, message)
+					if score is None:
+						pool.submit(message)
+				except ClaimCheck.ClaimCheckError as error:
+					fail_claim_check(queue, message, error)
+					continue
+				if score is not None:
+					publish_scored_message(queue, tr, message, score, balancer)
+
+		if not len(pool):
+			logging.debug('no work found on prioritization queue')
+			sleep_unless_draining(10)
+			continue
+
+		for message, score, error in pool.get_finished(timeout=1):
+			if error is not None:
+				logging.error('could not prioritize: ' + str(message) + ' ' + str(error))
+				message.add_error_to_attributes('prioritize: ' + str(error))
 				queue.log_failed_work(message)
+				queue.ack(message)
+				continue
+
+			if score_cache is not None:
+				score_cache.put(message, score)
+			publish_scored_message(queue, tr, message, score, balancer)
+
+	pool.hand_back()  # anything not scored before the drain ran out of time
+	pool.shutdown()
+
+
+def work_monitor(output_file=None):
+	"""
+	Sample the backlog of every work topic and the stats reported by spawners, estimate drain times and the
+	number of spawners needed, and write them out for an autoscaler
+	:param output_file: file to write the latest estimate to as json.  defaults to WorkSpawnerConfig.MONITOR_OUTPUT_FILE
+	:return: None
+	"""
+	# handle CTRL-C and SIGTERM by stopping after the current sample
+	drain.install('work_monitor')
+
+	queue = PubSub.PubSubFactory.get_queue()
+
+	tr = TopicReader.Topics()
+	if not tr:
+		logging.error('No topics found')
+		exit(-1)
+
+	if output_file is None:
+		output_file = WorkSpawnerConfig.MONITOR_OUTPUT_FILE
+
+	monitor = Monitor.BacklogMonitor(queue, tr.get_topic_list())
+
+	while not drain.is_draining():
+		monitor.consume_stats()
+		estimate = monitor.estimate()
+
+		print(json.dumps(estimate), flush=True)  # one json document per line for anything tailing the output
+		if output_file:
+			monitor.write_json(estimate, output_file)
+		if WorkSpawnerConfig.MONITOR_METRICS_FILE:
+			monitor.write_metrics(estimate, WorkSpawnerConfig.MONITOR_METRICS_FILE)
 
-			queue.ack(message)  # make sure it doesn't get processed again
+		sleep_unless_draining(WorkSpawnerConfig.MONITOR_INTERVAL)
+
+	logging.info('work_monitor has stopped')
 
 
 if __name__ == "__main__":
@@ -275,7 +1386,23 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--spawner", help="run the work spawner daemon", action="store_true")
 	parser.add_argument("--prioritizer", help="run the work prioritizer daemon", action="store_true")
+	parser.add_argument("--monitor", help="run the backlog monitor daemon", action="store_true")
 	parser.add_argument("--test", help="put into debug mode and use test data", action="store_true")
+	parser.add_argument("--drain-grace", help="seconds running work gets to finish on SIGINT or SIGTERM", type=float)
+	parser.add_argument("--memoize", help="reuse cached results of identical deterministic work", action="store_true")
+	parser.add_argument("--workers", help="number of processes the prioritizer scores work in, 0 for none", type=int)
+	parser.add_argument("--backend", help="queue backend to use, e.g., gcp.  third party backends can be added "
+										"with entry points, see PubSub.PubSubFactory")
+	parser.add_argument("--profile", help="sample the daemon and time the MyWork hooks.  dumped on SIGUSR1 and exit",
+						action="store_true")
+	parser.add_argument("--scheduler", help="how the spawner picks the next topic to pull from",
+						choices=sorted(Scheduler.SchedulerFactory.schedulers))
+	parser.add_argument("--balance-bins", help="move the score ranges of the topics to hit BIN_TARGET_SHARES",
+						choices=[ScoreBins.MODE_OFF, ScoreBins.MODE_PROPOSE, ScoreBins.MODE_APPLY])
+	parser.add_argument("--host-slots", help="share this many slots with the other spawners on the host, 0 for one "
+										"per core", type=int)
+	parser.add_argument("--reorder-window", help="messages the spawner pulls from a topic to run the best scored "
+										"one first, 1 for first in first out", type=int)
 
 	# get the args
 	args = parser.parse_args()
@@ -287,10 +1414,37 @@ if __name__ == "__main__":
 		logging.debug('In test mode')
 		WorkSpawnerConfig.TEST_MODE = True  # set the global state
 
+	if args.memoize:
+		WorkSpawnerConfig.MEMOIZE_ENABLED = True
+
+	if args.drain_grace is not None:
+		WorkSpawnerConfig.DRAIN_GRACE = args.drain_grace
+
+	if args.balance_bins:
+		WorkSpawnerConfig.BIN_BALANCE_MODE = args.balance_bins
+
+	if args.host_slots is not None:
+		WorkSpawnerConfig.HOST_SLOTS_ENABLED = True
+		WorkSpawnerConfig.HOST_SLOTS = args.host_slots
+
+	if args.reorder_window is not None:
+		WorkSpawnerConfig.REORDER_WINDOW = args.reorder_window
+
+	if args.backend:
+		WorkSpawnerConfig.QUEUE_BACKEND = args.backend
+
+	if args.profile:
+		daemon = 'work_spawner' if args.spawner else 'work_prioritizer' if args.prioritizer else 'work_monitor'
+		profiler = Profiler.Profiler(daemon)
+		profiler.time_hooks(MyWork)
+		profiler.start()
+
 	if args.spawner:
-		work_spawner()
+		work_spawner(args.scheduler)
 	elif args.prioritizer:
-		work_prioritizer()
+		work_prioritizer(args.workers)
+	elif args.monitor:
+		work_monitor()
 	else:
-		logging.error("Need to specify --spawner or --prioritizer")
+		logging.error("Need to specify --spawner, --prioritizer or --monitor")
 
@@ -1,4 +1,5 @@
 import logging
+import os
 
 # set the default logging format and to only log errors.  logging level is overridden in each module if desired
 logging.basicConfig(format='%(process)d: %(asctime)s: %(levelname)s: %(funcName)s: %(message)s', level=logging.ERROR)
@@ -13,13 +14,251 @@ TOPIC_FILE = 'PubSubTopics.csv'  # look in local directory for now
 # name of topic to look for work to prioritize
 priority_topic_name = "work-to-prioritize"
 failed_work_topic_name = "failed-work"
+# name of topic spawners report finished jobs and heartbeats on for the monitor
+stats_topic_name = "work-stats"
 
 # how long to wait for work before timing out in seconds...this is one hour
 WAIT_TIMEOUT = 3600
 
+# work that times out or is stopped by a drain gets SIGTERM, and this many seconds later SIGKILL, along with
+# everything it started.  docker work gets the same grace period from docker stop
+TERMINATE_GRACE = 10
+TERMINATE_KILL_WAIT = 5  # seconds to wait for the processes to be gone after SIGKILL
+
+# how the spawner picks the next topic to pull work from.  command line args can override this
+#   strict: always pull from the highest priority topic that has work
+#   drr: weighted fair sharing of spawner time between topics using the weight column in the topic file
+#   aging: strict priority, but topics that have been waiting are promoted over time so they can't starve
+SCHEDULER_MODE = 'strict'
+
+# drr: seconds of work a topic is credited with per unit of weight each scheduling round
+DRR_QUANTUM = 600
+
+# aging: seconds a topic with a weight of 1 has to wait unserved to be promoted one priority level
+AGING_INTERVAL = 1800
+
+# the prioritizer stamps the exact score of each message in this attribute
+SCORE_ATTRIBUTE = 'score'
+
+# a topic covers a range of scores and is first in first out.  with a window over 1 the spawner pulls that many
+# messages from a topic and runs the best scored one first.  1 turns reordering off.  command line args can
+# override this
+REORDER_WINDOW = 1
+# what happens to the messages in the window that weren't picked
+#   lease: held on extended leases for the next pulls from the topic
+#   nack: handed back right away
+# either way a message held too long is nacked, and every nack is another delivery.  retries count their own attempts
+# so they don't mind, but a subscription dead letter policy counts deliveries: keep its max_delivery_attempts well
+# above RETRY_MAX_ATTEMPTS when reordering, or reordered work can be dead lettered without ever running
+REORDER_HOLD = 'lease'
+REORDER_MAX_HOLD = 300  # seconds a message is held before it is handed back for other spawners
+REORDER_LOWEST_FIRST = True  # priority-1 has the lowest scores, so lower scores run first
+
+# directory where the daemons keep state that has to survive a restart
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state')
+
+# suppress duplicate deliveries of the same work on this host
+DEDUPE_ENABLED = True
+DEDUPE_DB_FILE = os.path.join(STATE_DIR, 'dedupe.db')
+DEDUPE_CACHE_SIZE = 10000  # number of recently seen messages kept in memory
+DEDUPE_RETENTION = 7 * 24 * 3600  # seconds to remember work, matches the max pub/sub message retention
+DEDUPE_HOLD_SECONDS = 600  # how long to hand back a duplicate of work that is still running. max is 600
+
+# if a publisher sets this attribute, it is used instead of the message_id to identify duplicate work
+IDEMPOTENCY_KEY_ATTRIBUTE = 'idempotency_key'
+
+# opt in memoization of the results of deterministic work.  command line args can override this
+# work with the same command, working directory and input files restores the cached output instead of running
+MEMOIZE_ENABLED = False
+RESULT_CACHE_DIR = os.path.join(STATE_DIR, 'results')
+RESULT_CACHE_MAX_BYTES = 10 * 1024 ** 3  # least recently used results are evicted above this size
+MEMOIZE_OPT_OUT_ATTRIBUTE = 'no_memoize'  # publishers set this attribute to always run the work
+
+# seconds running work gets to finish after a SIGINT or SIGTERM before it is killed and its message handed back
+# preemptible vms get 30 seconds notice, so leave time to hand back the message.  command line args can override this
+DRAIN_GRACE = 20
+# seconds after the signal until the host is gone, e.g., the preemption notice.  work stopped at the end of DRAIN_GRACE
+# gets TERMINATE_GRACE after its SIGTERM, but no more than is left of this
+DRAIN_DEADLINE = 30
+
+# retry work that failed for a transient reason, dead letter it to the failed work topic otherwise
+RETRY_ENABLED = True
+# nack: hand the message back with an ack deadline of the backoff, which pub/sub caps at 600 seconds
+# republish: publish a copy with attempt and retry_after attributes and ack the original
+RETRY_MODE = 'nack'
+RETRY_MAX_ATTEMPTS = 5  # attempts before the work is dead lettered
+RETRY_BACKOFF_BASE = 30  # seconds before the first retry, doubles with each attempt
+RETRY_BACKOFF_MAX = 3600  # longest wait between attempts
+# stages whose failures are transient.  timeouts are not retried since the work is likely to time out again
+RETRY_TRANSIENT_STAGES = ['pre_process', 'spawn', 'post_process']
+RETRY_TRANSIENT_EXIT_CODES = [75]  # work can exit with these codes to ask to be retried.  75 is EX_TEMPFAIL
+
+# seconds a keep_alive extends the lease on a message by.  pub/sub allows 10 to 600
+LEASE_SECONDS = 60
+
+# learn how long work takes, keyed by command or docker image and by topic, and use it to pick per job timeouts
+# and lease lengths.  WAIT_TIMEOUT and LEASE_SECONDS are used for work that hasn't run enough times yet, and for all
+# work while this is off
+RUNTIME_STATS_ENABLED = False
+RUNTIME_STATS_DB_FILE = os.path.join(STATE_DIR, 'runtimes.db')  # None to start from scratch on every restart
+RUNTIME_SAMPLES = 200  # most recent durations kept per command, docker image and topic
+RUNTIME_MIN_SAMPLES = 20  # durations needed before they are used
+RUNTIME_ALPHA = 0.1  # weight of the newest job in the moving average of durations
+RUNTIME_TIMEOUT_QUANTILE = 0.99  # work is stopped after this quantile of its durations times the factor
+RUNTIME_TIMEOUT_FACTOR = 3
+# a learned timeout is at most this many times the last one, starting from WAIT_TIMEOUT.  work that timed out gets
+# this many times its last timeout on its next run
+RUNTIME_TIMEOUT_GROWTH = 2
+RUNTIME_TIMEOUT_MIN = 300  # floor and ceiling on learned timeouts, in seconds
+RUNTIME_TIMEOUT_MAX = 4 * WAIT_TIMEOUT
+RUNTIME_LEASE_MIN = LEASE_SECONDS  # leases follow the average duration between these, renewed half way through
+RUNTIME_LEASE_MAX = 600
+
+# capture the stdout and stderr of each job to its own files instead of the log of the spawner.  the end of the
+# output is attached to the message of failed work in stdout_tail and stderr_tail attributes
+JOB_OUTPUT_ENABLED = True
+JOB_OUTPUT_DIR = os.path.join(STATE_DIR, 'output')
+JOB_OUTPUT_MAX_BYTES = 10 * 1024 ** 2  # a job's output file is rotated at this size
+JOB_OUTPUT_BACKUPS = 2  # rotated files kept per stream, older output is dropped
+JOB_OUTPUT_TAIL_BYTES = 16 * 1024  # end of each stream kept in memory and logged if the work fails
+JOB_OUTPUT_KEEP_FILES = 1000  # output files of older jobs are deleted
+
+# give each job its own scratch workspace built from the template, instead of running every job in the template
+# itself.  the work gets WORK_DIR, WORK_CONFIG_DIR and WORK_LOG_DIR in its environment
+WORKSPACES_ENABLED = True
+WORKSPACE_ROOT = os.path.join(STATE_DIR, 'workspaces')  # e.g., /dev/shm/workspaces to keep them on tmpfs
+WORKSPACE_TEMPLATE = '../Bug-World'  # read-only tree every workspace starts as, relative to where the spawner runs
+# hardlink: link the files of the template, work must not modify them in place.  copies them across file systems
+# copy: copy the files of the template
+WORKSPACE_MODE = 'hardlink'
+WORKSPACE_SKIP = ['.git', 'logs']  # top level files and directories of the template that aren't put in workspaces
+
+# messages with this attribute set are batches whose body is a json list of sub-tasks.  pre_process and
+# post_process run once per batch and the sub-tasks run in parallel
+BATCH_ATTRIBUTE = 'batch'
+BATCH_SLOTS = 0  # sub-tasks run at once.  0 is the number of cores
+
+# tune the number of sub-tasks run at once to what the host can take, starting from BATCH_SLOTS.  while the host is
+# healthy a slot is added or taken away each interval depending on whether throughput improves, and the slots are cut
+# by CONCURRENCY_DECREASE when the host is overloaded or too many sub-tasks fail
+CONCURRENCY_TUNING_ENABLED = True
+CONCURRENCY_MIN_SLOTS = 1
+CONCURRENCY_MAX_SLOTS = 0  # 0 is twice the number of cores
+CONCURRENCY_INTERVAL = 30  # min seconds between decisions, longer if not every slot has finished a sub-task yet
+CONCURRENCY_TOLERANCE = 0.05  # changes in throughput smaller than this fraction count as the same
+CONCURRENCY_DECREASE = 0.5  # slots are multiplied by this when the host is overloaded
+CONCURRENCY_MAX_LOAD = 1.5  # 1 minute load average per core above which the host is overloaded
+CONCURRENCY_MAX_MEMORY_PRESSURE = 10  # % of the last 10 seconds tasks stalled on memory, from /proc/pressure/memory
+CONCURRENCY_MAX_FAILURE_RATE = 0.5  # share of the sub-tasks in an interval that can fail before slots are cut
+
+# share the slots of the host between every spawner on it, e.g., when running one spawner per docker image.  a
+# spawner only pulls work when one of the slots in the table in HOST_SLOTS_FILE is free, and batches take a slot for
+# every sub-task after the first.  slots of spawners that crashed are taken back.  command line args can override this
+HOST_SLOTS_ENABLED = False
+HOST_SLOTS = 0  # slots on the host.  0 is the number of cores
+HOST_SLOTS_FILE = os.path.join(STATE_DIR, 'slots')  # memory mapped by every spawner, they must share the STATE_DIR
+HOST_SLOTS_WAIT = 5  # seconds between looks for a free slot
+HOST_SLOTS_PIN_CORES = False  # pin the work in slot i to core i modulo the number of cores
+
+# every job a spawner runs is recorded in a binary journal in LEDGER_DIR, compacted into columnar segments indexed
+# by topic and time.  query it with Ledger.py, e.g., the p95 runtime per topic over the last 24 hours
+LEDGER_ENABLED = True
+LEDGER_DIR = os.path.join(STATE_DIR, 'ledger')
+# seconds between compactions by a background thread of the spawner.  a journal is sealed for compaction once it is
+# this old.  0 leaves compaction to Ledger.py --compact, e.g., from cron
+LEDGER_COMPACT_INTERVAL = 600
+LEDGER_JOURNAL_ROWS = 10000  # a journal with this many rows is sealed right away and the next row starts a new one
+LEDGER_SEGMENT_ROWS = 1000000  # small segments are merged up to this many rows.  a merge holds them all in memory
+LEDGER_MERGE_SEGMENTS = 8  # number of small segments that starts a merge
+LEDGER_RETENTION = 30 * 24 * 3600  # seconds jobs are kept for
+
+# --profile samples the stack of the daemon and times the MyWork hooks.  dumped on SIGUSR1 and on exit
+PROFILE_DIR = os.path.join(STATE_DIR, 'profile')
+PROFILE_INTERVAL = 0.005  # seconds between samples
+PROFILE_PSTATS = False  # also run cProfile for pstats output.  much higher overhead than sampling
+
+# number of processes the prioritizer scores work in.  0 scores in the prioritizer itself, which is fine unless
+# MyWork.prioritize is CPU heavy.  command line args can override this
+PRIORITIZER_WORKERS = 0
+PRIORITIZER_WINDOW = 0  # max messages being scored at once.  0 is twice the number of workers
+
+# cache scores so the prioritizer doesn't score the same body and attributes again.  only used when MyWork sets
+# PRIORITIZE_IS_DETERMINISTIC, a cached random score would stick to every message with the same body
+SCORE_CACHE_ENABLED = False
+SCORE_CACHE_SIZE = 10000  # max scores kept in memory, least recently used are dropped
+SCORE_CACHE_TTL = 24 * 3600  # seconds a score is good for
+SCORE_CACHE_PERSIST = False  # keep scores across prioritizer restarts
+SCORE_CACHE_DB_FILE = os.path.join(STATE_DIR, 'scores.db')
+
+# track the scores the prioritizer publishes in a quantile sketch and move the low score and high score of each topic
+# so it gets its target share of the work.  command line args can override this
+#   off: keep the ranges in TOPIC_FILE
+#   propose: log the ranges that would balance the topics and write them to proposed.csv in TOPIC_TABLE_DIR
+#   apply: also write them as the next version of the topic table and bin with them.  the latest version is only
+#          loaded in this mode, the topics and weights still come from TOPIC_FILE.  off and propose go back to the
+#          ranges in TOPIC_FILE
+BIN_BALANCE_MODE = 'off'
+BIN_TARGET_SHARES = [0.2, 0.3, 0.5]  # share of the work for each topic, in the order of TOPIC_FILE
+BIN_BALANCE_INTERVAL = 3600  # seconds of scores each proposal is based on
+BIN_MIN_SAMPLES = 1000  # scores needed in an interval to propose anything
+BIN_TOLERANCE = 0.05  # ranges only change when a topic's share is further than this from its target
+BIN_SKETCH_K = 200  # size of the quantile sketch, about 3 * k scores are kept for a rank error under 1%
+TOPIC_TABLE_DIR = os.path.join(STATE_DIR, 'topics')  # versioned topic tables, topics-v<version>.csv
+TOPIC_TABLE_KEEP = 10  # older versions are deleted
+
+# sqlite queue backend.  topics get a subscription with the same name the first time they are used
+SQLITE_QUEUE_FILE = os.path.join(STATE_DIR, 'queue.db')
+
+# bodies over COMPRESSION_THRESHOLD bytes are compressed when published and the codec put in the codec attribute,
+# so pulls decompress whatever the publisher used.  bytes bodies get a body_type attribute so they stay bytes
+#   zlib: always available
+#   zstd: needs the zstandard package, can use a dictionary trained with benchmark_codecs.py --train
+#   lz4: needs the lz4 package, fastest but compresses least
+# off by default: consumers from before compression can't read compressed bodies, so upgrade every daemon that pulls
+# from the topics first
+COMPRESSION_CODEC = None
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = None  # None for the default level of the codec
+COMPRESSION_DICTIONARY_FILE = None  # zstd dictionary.  every daemon has to have the same file
+CODEC_ATTRIBUTE = 'codec'
+BODY_TYPE_ATTRIBUTE = 'body_type'
+
+# bodies over CLAIM_CHECK_THRESHOLD bytes are put in a blob store and the message carries a claim_check attribute
+# with where it is instead.  the body is fetched when it is first used after a pull, and deleted once every
+# message referring to it has been acked.  pub/sub messages are capped at 10 MB
+CLAIM_CHECK_ENABLED = True
+CLAIM_CHECK_THRESHOLD = 256 * 1024
+CLAIM_CHECK_ATTRIBUTE = 'claim_check'
+# gcp backend.  give the bucket a lifecycle rule to delete the bodies of messages that expired without an ack
+CLAIM_CHECK_BUCKET_PATH = 'gs://' + DEFAULT_BUCKET_NAME + '/claim-checks'
+CLAIM_CHECK_DIR = os.path.join(STATE_DIR, 'claim-checks')  # memory and sqlite backends
+CLAIM_CHECK_RETENTION = 7 * 24 * 3600  # seconds before bodies in CLAIM_CHECK_DIR are deleted even if not acked
+
+# spawners report every job and a heartbeat on the stats topic so the monitor can estimate drain times
+STATS_ENABLED = False
+STATS_HEARTBEAT_SECONDS = 300  # how often an idle or busy spawner lets the monitor know it is alive
+
+# monitor: estimates how long each topic will take to drain and how many spawners are needed
+MONITOR_INTERVAL = 60  # seconds between samples.  pub/sub backlog metrics are updated about once a minute
+MONITOR_TARGET_DRAIN_SECONDS = 3600  # size the spawners to drain the whole backlog in this many seconds
+MONITOR_MIN_SPAWNERS = 0
+MONITOR_MAX_SPAWNERS = 100
+MONITOR_DEFAULT_JOB_SECONDS = 600  # assumed job duration for a topic until a spawner reports one
+MONITOR_DURATION_ALPHA = 0.1  # weight of the newest job in the moving average of job durations
+MONITOR_SPAWNER_TIMEOUT = 3 * STATS_HEARTBEAT_SECONDS  # spawners not heard from for this long are not counted
+MONITOR_OUTPUT_FILE = os.path.join(STATE_DIR, 'monitor.json')  # latest estimate as json, None to only print it
+MONITOR_METRICS_FILE = None  # latest estimate in prometheus text format, e.g., for the node exporter
+
 # should run in test mode and not use actual cloud functions, command line args can override this
 TEST_MODE = False
 
+# queue the daemons pull work from and publish to, one of the PubSub.PubSubFactory backends.  test mode always
+# uses memory.  command line args can override this
+#   gcp: google cloud pub/sub
+#   memory: in memory queue for testing, nothing is shared between processes
+#   sqlite: queue in SQLITE_QUEUE_FILE shared by the daemons on a single host, no cloud needed
+QUEUE_BACKEND = 'gcp'
+
 # name of the project where resources are
 # TODO: use this to get project_id
 #  curl "http://metadata.google.internal/computeMetadata/v1/project/project-id" -H "Metadata-Flavor: Google"
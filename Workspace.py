@@ -0,0 +1,213 @@
+#
+# Per job workspaces, so jobs on the same host don't share one working tree
+#
+# Each job gets a scratch directory under WORKSPACE_ROOT built from the read-only WORKSPACE_TEMPLATE tree.  Files
+# are hardlinked instead of copied, so a workspace costs a few inodes however big the template is.  Work must not
+# modify template files in place since that changes them for every job, set WORKSPACE_MODE to copy if it does.
+# The work and the MyWork hooks find their directories in message.workspace, and the work in the environment:
+#	WORK_DIR         root of the workspace, the working directory of the work
+#	WORK_CONFIG_DIR  where pre_process puts the config of the job
+#	WORK_LOG_DIR     where the work writes the logs post_process uploads
+# Workspaces are removed in a background thread once post_process is done with them.
+#
+import logging
+import os
+import queue
+import shutil
+import threading
+
+import WorkSpawnerConfig
+
+# logging format is set in the WorkSpawnerConfig...this changes the level in this file.
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# how the template is populated into a workspace
+MODE_HARDLINK = 'hardlink'  # falls back to copying files that can't be linked, e.g., with the root on tmpfs
+MODE_COPY = 'copy'
+
+# directory under the root workspaces are moved to while they are being removed
+TRASH_DIR = '.trash'
+
+
+class Workspace:
+	"""
+	Scratch directory of one job
+	"""
+
+	def __init__(self, path, config_dir=None, log_dir=None):
+		"""
+		:param path: root of the workspace
+		:param config_dir: directory for the config of the job.  defaults to config in the workspace
+		:param log_dir: directory for the logs of the job.  defaults to logs in the workspace
+		"""
+		self.path = path
+		self.config_dir = config_dir if config_dir is not None else os.path.join(path, 'config')
+		self.log_dir = log_dir if log_dir is not None else os.path.join(path, 'logs')
+
+	def __repr__(self):
+		return 'workspace: ' + self.path
+
+	def get_env(self):
+		"""
+		:return: environment variables that tell the work where its directories are
+		"""
+		return {'WORK_DIR': self.path, 'WORK_CONFIG_DIR': self.config_dir, 'WORK_LOG_DIR': self.log_dir}
+
+
+class WorkspaceManager:
+	"""
+	Creates workspaces from the template and removes them in the background
+	"""
+
+	def __init__(self, root=None, template=None, mode=None, skip=None):
+		"""
+		:param root: directory the workspaces are created in.  defaults to WorkSpawnerConfig.WORKSPACE_ROOT
+		:param template: tree every workspace starts as a copy of.  defaults to WorkSpawnerConfig.WORKSPACE_TEMPLATE
+		:param mode: MODE_HARDLINK or MODE_COPY.  defaults to WorkSpawnerConfig.WORKSPACE_MODE
+		:param skip: names of files and directories in the template that aren't copied.
+				defaults to WorkSpawnerConfig.WORKSPACE_SKIP
+		"""
+		if root is None:
+			root = WorkSpawnerConfig.WORKSPACE_ROOT
+		if template is None:
+			template = WorkSpawnerConfig.WORKSPACE_TEMPLATE
+		if mode is None:
+			mode = WorkSpawnerConfig.WORKSPACE_MODE
+		if skip is None:
+			skip = WorkSpawnerConfig.WORKSPACE_SKIP
+		if mode not in (MODE_HARDLINK, MODE_COPY):
+			raise ValueError('unknown workspace mode: ' + str(mode))
+
+		self.root = os.path.abspath(root)
+		self.template = os.path.abspath(template) if template else None
+		self.mode = mode
+		self.skip = set(skip)
+		self.pid_dir = os.path.join(self.root, str(os.getpid()))  # workspaces of this process
+		self.trash_dir = os.path.join(self.root, TRASH_DIR)
+		self.linking = mode == MODE_HARDLINK  # turned off the first time a link fails
+		self.removals = queue.Queue()
+		self.remover = None
+
+		os.makedirs(self.trash_dir, exist_ok=True)
+		self.remove_stale()
+		os.makedirs(self.pid_dir, exist_ok=True)
+
+	def create(self, job_name, template=None, log_dir=None):
+		"""
+		:param job_name: unique name for the workspace, e.g., from JobOutput.get_job_name()
+		:param template: tree to start from instead of the template of the manager, e.g., the workspace of a batch
+		:param log_dir: directory for the logs of the job instead of logs in the workspace
+		:return: Workspace with the template populated into it
+		"""
+		path = os.path.join(self.pid_dir, job_name)
+		template = template if template is not None else self.template
+		if template:
+			self._populate(template, path)
+		os.makedirs(path, exist_ok=True)
+
+		workspace = Workspace(path, log_dir=log_dir)
+		os.makedirs(workspace.config_dir, exist_ok=True)
+		os.makedirs(workspace.log_dir, exist_ok=True)
+		logging.debug('created ' + str(workspace))
+		return workspace
+
+	def _populate(self, template, path):
+		"""
+		hardlink or copy the template tree into path.  symlinks are recreated as they are
+		"""
+		for directory, dirs, files in os.walk(template):
+			relative = os.path.relpath(directory, template)
+			if relative == '.':
+				dirs[:] = [name for name in dirs if name not in self.skip]
+				files = [name for name in files if name not in self.skip]
+			target_dir = os.path.normpath(os.path.join(path, relative))
+			os.makedirs(target_dir, exist_ok=True)
+
+			for name in list(dirs):  # os.walk doesn't follow symlinked directories, so they are recreated here
+				source = os.path.join(directory, name)
+				if os.path.islink(source):
+					os.symlink(os.readlink(source), os.path.join(target_dir, name))
+					dirs.remove(name)
+
+			for name in files:
+				source = os.path.join(directory, name)
+				target = os.path.join(target_dir, name)
+				if os.path.islink(source):
+					os.symlink(os.readlink(source), target)
+				elif self.linking:
+					try:
+						os.link(source, target)
+					except OSError as error:  # e.g., the root is on another file system, like tmpfs
+						logging.warning('could not hardlink the workspace template, copying it instead: ' + str(error))
+						self.linking = False
+						shutil.copy2(source, target)
+				else:
+					shutil.copy2(source, target)
+
+	def release(self, workspace):
+		"""
+		remove a workspace in the background once the job is done with it.  it is moved out of the way first, so
+		it is gone as far as the next job is concerned right away
+		:param workspace: Workspace from create()
+		:return: None
+		"""
+		if workspace is None or not os.path.isdir(workspace.path):
+			return
+		trash = os.path.join(self.trash_dir, str(os.getpid()) + '-' + os.path.basename(workspace.path))
+		try:
+			os.replace(workspace.path, trash)
+		except OSError as error:
+			logging.error('could not move ' + str(workspace) + ' to the trash: ' + str(error))
+			trash = workspace.path
+
+		if self.remover is None:
+			self.remover = threading.Thread(target=self._remove_loop, name='workspace-remover', daemon=True)
+			self.remover.start()
+		self.removals.put(trash)
+
+	def _remove_loop(self):
+		while True:
+			path = self.removals.get()
+			shutil.rmtree(path, ignore_errors=True)
+			self.removals.task_done()
+
+	def wait(self):
+		"""
+		wait for the background removals, e.g., before exiting
+		:return: None
+		"""
+		if self.remover is not None:
+			self.removals.join()
+
+	def remove_stale(self):
+		"""
+		remove the trash and the workspaces of processes that are gone, left behind by a crash or a kill.  several
+		spawners can share the root, so only workspaces of dead pids are removed
+		:return: None
+		"""
+		for entry in os.scandir(self.trash_dir):
+			shutil.rmtree(entry.path, ignore_errors=True)
+
+		for entry in os.scandir(self.root):
+			if not entry.is_dir() or not entry.name.isdigit():
+				continue
+			if entry.path == self.pid_dir:  # left by an earlier process with the same pid
+				shutil.rmtree(entry.path, ignore_errors=True)
+			elif not is_running(int(entry.name)):
+				logging.info('removing workspaces of pid: ' + entry.name + ' which is no longer running')
+				shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def is_running(pid):
+	"""
+	:param pid: process id
+	:return: True if a process with the pid exists on this host
+	"""
+	try:
+		os.kill(pid, 0)  # signal 0 only checks that the process exists
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
@@ -0,0 +1,182 @@
+#
+# CPU cost against bytes saved of the body compression codecs
+#
+# Compresses and decompresses sample message bodies with each codec that is installed and prints the ratio, the
+# bytes saved and the CPU time per MB, to pick COMPRESSION_CODEC and COMPRESSION_THRESHOLD, e.g.,
+#	$ python3 benchmark_codecs.py --samples bodies/
+# Without samples, synthetic JSON configs and score vectors are used.  --train writes a zstd dictionary trained on
+# the samples for COMPRESSION_DICTIONARY_FILE, which helps most when bodies are small and alike:
+#	$ python3 benchmark_codecs.py --samples bodies/ --train state/bodies.dict
+#
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import Codec
+
+# codec: levels benchmarked.  None is the default level of the codec
+LEVELS = {
+	'zlib': [1, None, 9],
+	'zstd': [1, None, 9, 19],
+	'lz4': [None, 9],
+}
+
+
+def load_samples(paths):
+	"""
+	:param paths: files, or directories whose files are read
+	:return: list of the bodies in them as bytes
+	"""
+	samples = []
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				filename = os.path.join(path, name)
+				if os.path.isfile(filename):
+					with open(filename, 'rb') as f:
+						samples.append(f.read())
+		else:
+			with open(path, 'rb') as f:
+				samples.append(f.read())
+	return samples
+
+
+def make_samples(count, seed=0):
+	"""
+	:param count: number of bodies
+	:param seed: random seed
+	:return: list of synthetic bodies, half JSON configs and half score vectors, as bytes
+	"""
+	rng = random.Random(seed)
+	samples = []
+	for index in range(count):
+		if index % 2:
+			config = {'seed': rng.randint(0, 2 ** 31), 'generations': rng.choice([100, 500, 1000]),
+					'mutation_rate': round(rng.uniform(0.001, 0.1), 4), 'world': {'width': 800, 'height': 600},
+					'genome': [rng.choice('ACGT') for _ in range(rng.randint(200, 2000))]}
+			samples.append(json.dumps(config).encode('utf-8'))
+		else:
+			scores = [round(rng.gauss(5, 2), 3) for _ in range(rng.randint(100, 5000))]
+			samples.append(json.dumps({'scores': scores}).encode('utf-8'))
+	return samples
+
+
+def make_codec(name, level, dictionary_file=None):
+	"""
+	:return: Codec, or None if the package it needs isn't installed
+	"""
+	try:
+		if name == 'zlib':
+			return Codec.make_zlib(level)
+		if name == 'zstd':
+			return Codec.make_zstd(level, dictionary_file)
+		if name == 'lz4':
+			return Codec.make_lz4(level)
+	except ImportError:
+		return None
+	raise ValueError('unknown codec: ' + name)
+
+
+def measure(codec, samples, repeat):
+	"""
+	:param codec: Codec to measure
+	:param samples: bodies as bytes
+	:param repeat: number of times to compress and decompress every sample
+	:return: dict of the compressed bytes and CPU seconds to compress and decompress the samples once
+	"""
+	compressed = [codec.compress(sample) for sample in samples]
+	for sample, data in zip(samples, compressed):
+		if codec.decompress(data) != sample:
+			raise AssertionError(codec.name + ' did not round trip')
+
+	start = time.process_time()
+	for _ in range(repeat):
+		for sample in samples:
+			codec.compress(sample)
+	compress_seconds = (time.process_time() - start) / repeat
+
+	start = time.process_time()
+	for _ in range(repeat):
+		for data in compressed:
+			codec.decompress(data)
+	decompress_seconds = (time.process_time() - start) / repeat
+
+	return {'bytes': sum(len(data) for data in compressed), 'compress_seconds': compress_seconds,
+			'decompress_seconds': decompress_seconds}
+
+
+def train_dictionary(samples, filename, size):
+	"""
+	:param samples: bodies as bytes to train on, a few hundred or more works best
+	:param filename: file to write the dictionary to
+	:param size: max bytes of the dictionary
+	:return: None
+	"""
+	import zstandard
+	dictionary = zstandard.train_dictionary(size, samples)
+	with open(filename, 'wb') as f:
+		f.write(dictionary.as_bytes())
+	print('wrote a ' + str(len(dictionary.as_bytes())) + ' byte zstd dictionary trained on ' + str(len(samples)) +
+		' samples to: ' + filename)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--samples", help="files or directories of sample bodies", nargs='*', default=[])
+	parser.add_argument("--synthetic", help="number of synthetic bodies if there are no samples", type=int,
+						default=200)
+	parser.add_argument("--codecs", help="comma separated codecs", default=','.join(LEVELS))
+	parser.add_argument("--repeat", help="number of times to compress every sample", type=int, default=5)
+	parser.add_argument("--train", help="train a zstd dictionary on the samples and write it to this file")
+	parser.add_argument("--dictionary-size", help="max bytes of a trained dictionary", type=int, default=112640)
+	parser.add_argument("--json", help="print the results as json", action="store_true")
+	args = parser.parse_args()
+
+	samples = load_samples(args.samples) if args.samples else make_samples(args.synthetic)
+	if not samples:
+		print('no samples found')
+		sys.exit(1)
+	raw_bytes = sum(len(sample) for sample in samples)
+
+	runs = []  # (label, codec name, level, dictionary file)
+	for name in args.codecs.split(','):
+		for level in LEVELS.get(name, [None]):
+			runs.append((name + (':' + str(level) if level is not None else ''), name, level, None))
+
+	if args.train:
+		try:
+			train_dictionary(samples, args.train, args.dictionary_size)
+			runs.append(('zstd+dict', 'zstd', None, args.train))
+		except ImportError:
+			print('training a dictionary needs the zstandard package')
+			sys.exit(1)
+
+	results = []
+	for label, name, level, dictionary_file in runs:
+		codec = make_codec(name, level, dictionary_file)
+		if codec is None:
+			print(label + ': not installed, skipped', file=sys.stderr)
+			continue
+		result = measure(codec, samples, args.repeat)
+		result['codec'] = label
+		results.append(result)
+
+	if args.json:
+		print(json.dumps({'samples': len(samples), 'raw_bytes': raw_bytes, 'results': results}, indent=2))
+		sys.exit(0)
+
+	megabytes = raw_bytes / 1024 ** 2
+	print(str(len(samples)) + ' samples, ' + str(raw_bytes) + ' bytes, mean ' + str(raw_bytes // len(samples)) +
+		' bytes')
+	print('codec'.ljust(12) + 'ratio'.rjust(8) + 'saved %'.rjust(10) + 'bytes saved'.rjust(14) +
+		'comp ms/MB'.rjust(12) + 'decomp ms/MB'.rjust(14))
+	for result in results:
+		saved = raw_bytes - result['bytes']
+		print(result['codec'].ljust(12) + ('%.2f' % (raw_bytes / max(result['bytes'], 1))).rjust(8) +
+			('%.1f' % (100.0 * saved / raw_bytes)).rjust(10) + str(saved).rjust(14) +
+			('%.1f' % (1000 * result['compress_seconds'] / megabytes)).rjust(12) +
+			('%.1f' % (1000 * result['decompress_seconds'] / megabytes)).rjust(14))
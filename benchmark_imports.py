@@ -0,0 +1,71 @@
+#
+# Import time benchmark for the modules every daemon and MyWork hook imports
+#
+# Each module is imported in a fresh interpreter several times.  Fails if the median import time is over the
+# budget, or if importing it pulls in a queue backend that should only be imported on first use (e.g., the
+# google cloud libraries).  Meant to be run in CI:
+#	$ python3 benchmark_imports.py --budget 0.2
+#
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# modules that must stay cheap to import
+MODULES = ['PubSub', 'MyWork', 'WorkSpawner']
+
+# modules that are only imported by the backend that needs them
+LAZY_MODULES = ['google.cloud.pubsub_v1', 'google.cloud.storage', 'PubSubGCP', 'PubSubSQLite', 'zstandard', 'lz4']
+
+# run in the child interpreter
+CHILD_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {lazy!r} if name in sys.modules]}}))
+'''
+
+
+def time_import(module, repeat):
+	"""
+	:param module: name of the module to import
+	:param repeat: number of fresh interpreters to import it in
+	:return: (list of import times in seconds, list of lazy modules that were imported)
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	times = []
+	loaded = set()
+	for _ in range(repeat):
+		output = subprocess.check_output([sys.executable, '-c', CHILD_CODE.format(module=module, lazy=LAZY_MODULES)],
+										cwd=here)
+		result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+		times.append(result['seconds'])
+		loaded.update(result['loaded'])
+	return times, sorted(loaded)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--repeat", help="number of times to import each module", type=int, default=5)
+	parser.add_argument("--budget", help="max median seconds to import each module", type=float, default=0.2)
+	args = parser.parse_args()
+
+	failed = False
+	for module in MODULES:
+		times, loaded = time_import(module, args.repeat)
+		median = statistics.median(times)
+		print(module + ': median ' + str(round(median * 1000, 1)) + ' ms, min ' + str(round(min(times) * 1000, 1)) +
+			' ms over ' + str(len(times)) + ' imports')
+
+		if median > args.budget:
+			print('  FAIL: over the budget of ' + str(round(args.budget * 1000, 1)) + ' ms')
+			failed = True
+		if loaded:
+			print('  FAIL: imported lazy modules: ' + str(loaded))
+			failed = True
+
+	sys.exit(1 if failed else 0)
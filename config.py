@@ -9,6 +9,11 @@ subscription_name = topic_name  # default subscription name matches topic
 # name of the bucket where work files will be stored long term
 bucket_name = 'ws-proto-bucket-1'
 
+# blobs per listing request, GCS allows up to 1000
+list_page_size = 1000
+# threads listing, deleting or copying blobs at once
+list_workers = 16
+
 # use the directory where the simulation is running
 local_dir = os.path.dirname(__file__)
 